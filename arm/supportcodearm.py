@@ -219,6 +219,8 @@ def get_main(outarm):
 
         configs = parse_args(argv, "-C", "--model-config", many=True)
 
+        call_profile_file = parse_args(argv, "--call-profile")
+
         repeat = parse_args(argv, "--repeat")
         repeats = 1
         if repeat:
@@ -254,7 +256,7 @@ def get_main(outarm):
                 configname, value = config.split('=', 2)
                 value = parseint(value)
                 print "setting config value", configname, "to", hex(value)
-                outarm.func_z__SetConfig(machine, configname, bitvector.Integer.fromint(value))
+                outarm.func_z__SetConfig(machine, configname, value, None)
 
             machine.g.cycle_count = 0
             if objectmodel.we_are_translated():
@@ -274,6 +276,11 @@ def get_main(outarm):
             finally:
                 t2 = time.time()
                 print "ran for %s(s), %s instructions, KIPS: %s" % (t2 - t1, machine.g.cycle_count, machine.g.cycle_count / (t2 - t1) / 1000)
+                if call_profile_file and i == repeats - 1:
+                    if machine.write_call_profile(call_profile_file):
+                        print "written call profile", call_profile_file
+                    else:
+                        print "can't write call profile, the code was generated without call counting"
         return 0
     main.mod = outarm
     return main
@@ -317,8 +324,7 @@ def load_raw_single(machine, offset, fn):
     f = open(fn, 'rb')
     try:
         content = f.read()
-        for i, byte in enumerate(content):
-            machine.g.mem.write(offset + i, 1, r_uint(ord(byte)))
+        machine.g.mem.write_bytes(r_uint(offset), content)
     finally:
         f.close()
 
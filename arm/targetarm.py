@@ -2,6 +2,7 @@ import sys
 import os
 from os.path import dirname
 from pydrofoil.makecode import parse_and_make_code
+from pydrofoil.callprofile import profile_from_env
 toplevel = dirname(dirname(__file__))
 armir = os.path.join(toplevel, "arm", "armv9.ir")
 outarm = os.path.join(toplevel, "arm", "generated", "outarm.py")
@@ -15,14 +16,27 @@ z__supported_pa_sizze
 z__block_bbm_implemented
 """.split())
 
+ENTRYPOINTS = "zstep_model z__SetThisInstrDetails zmain z__SetConfig z__ListConfig".split()
+
 def make_code(regen=True):
     from arm import supportcodearm
     outarm = _make_code(regen)
     return supportcodearm.get_main(outarm)
 
-def should_inline(name):
+def should_inline_hooks(name):
+    # these must never be inlined, profile or not
     if "step_model" in name:
         return False
+    if name == "z__SetThisInstrDetails":
+        return False # hook for the JIT
+    if name == "z__CheckForEmulatorTermination":
+        return False # for cleanly exiting
+
+def should_inline(name):
+    # hand-written heuristics, only used if there is no call profile
+    res = should_inline_hooks(name)
+    if res is not None:
+        return res
     if "subrange_subrange" in name:
         return True
     if "slice_mask" in name:
@@ -55,10 +69,6 @@ def should_inline(name):
         return True
     if "zAArch64_PAMax" in name:
         return True # risky, several callers
-    if name == "z__SetThisInstrDetails":
-        return False # hook for the JIT
-    if name == "z__CheckForEmulatorTermination":
-        return False # for cleanly exiting
 
 
 def _make_code(regen=True):
@@ -67,11 +77,21 @@ def _make_code(regen=True):
     if regen:
         with open(armir, "rb") as f:
             s = f.read()
-        entrypoints = "zstep_model z__SetThisInstrDetails zmain z__SetConfig z__ListConfig".split()
         support_code = "from arm import supportcodearm as supportcode"
+        parallelism = int(os.getenv("PYDROFOIL_OPTIMIZE_PROCESSES", "1"))
+        cache_dir = os.getenv("PYDROFOIL_CACHE_DIR")
+        # a profile written by a build made with PYDROFOIL_INSTRUMENT_CALLS=1
+        # and run with --call-profile <file>
+        call_profile = profile_from_env()
+        if call_profile is not None:
+            print "using call profile", os.getenv("PYDROFOIL_CALL_PROFILE")
         res = parse_and_make_code(s, support_code, PROMOTED_REGISTERS,
-                                  should_inline=should_inline,
-                                  entrypoints=entrypoints)
+                                  should_inline=should_inline if call_profile is None else should_inline_hooks,
+                                  entrypoints=ENTRYPOINTS,
+                                  parallelism=parallelism,
+                                  cache_dir=cache_dir,
+                                  call_profile=call_profile,
+                                  instrument_calls=bool(os.getenv("PYDROFOIL_INSTRUMENT_CALLS")))
         with open(outarm, "w") as f:
             f.write(res)
         print "written file", outarm, "importing now"
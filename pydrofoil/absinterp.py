@@ -1,6 +1,8 @@
 import sys
 from collections import defaultdict
 
+from rpython.rlib.rarithmetic import r_uint
+
 from pydrofoil import ir, types
 
 MININT = -sys.maxint-1
@@ -135,6 +137,17 @@ class Range(object):
             return Range(min(values), max(values))
         return UNBOUNDED
 
+    def intersect(self, other):
+        low, high = self.low, self.high
+        if other.low is not None and (low is None or other.low > low):
+            low = other.low
+        if other.high is not None and (high is None or other.high < high):
+            high = other.high
+        if low is not None and high is not None and low > high:
+            # can't happen for correct ranges, be conservative
+            return self
+        return Range(low, high)
+
     def union(self, other):
         low = high = None
         if self.low is not None and other.low is not None:
@@ -237,6 +250,8 @@ class AbstractInterpreter(object):
         self.graph = graph
         self.codegen = codegen
         self.values = {} # block -> value -> Range
+        # calls whose range comes from the summary of the called function
+        self.summarized_calls = set()
 
     def _builtinname(self, name):
         return self.codegen.builtin_names.get(name, name)
@@ -292,7 +307,7 @@ class AbstractInterpreter(object):
     def analyze(self):
         startblock_values = {}
         for arg in self.graph.args:
-            startblock_values[arg] = UNBOUNDED
+            startblock_values[arg] = self._argument_value(arg)
         self.values[self.graph.startblock] = startblock_values
 
         for block in ir.topo_order(self.graph):
@@ -308,6 +323,9 @@ class AbstractInterpreter(object):
 
         return self.values
 
+    def _argument_value(self, arg):
+        return UNBOUNDED
+
     def analyze_link(self, block):
         if isinstance(block.next, ir.Goto):
             self._merge_values(self.current_values, block.next.target)
@@ -359,9 +377,20 @@ class AbstractInterpreter(object):
     def analyze_Operation(self, op):
         name = op.name.lstrip("@$")
         name = self._builtinname(name)
-        meth = getattr(self, "analyze_" + name, self.analyze_default)
+        meth = getattr(self, "analyze_" + name, None)
+        if meth is None:
+            return self._analyze_call(op)
         return meth(op)
 
+    def _analyze_call(self, op):
+        # use the range of the results of the called function, if known
+        return_ranges = getattr(self.codegen, "return_ranges", None)
+        if return_ranges and op.name in return_ranges:
+            self.summarized_calls.add(op)
+            self.codegen.return_range_dependencies[op.name].add(self.graph)
+            return return_ranges[op.name]
+        return self.analyze_default(op)
+
     def analyze_Phi(self, op):
         if op.resolved_type not in RELEVANT_TYPES:
             return
@@ -588,6 +617,10 @@ class IntOpOptimizer(ir.LocalOptimizer):
             return ir.BooleanConstant.FALSE
 
     def _optimize_op(self, block, index, op):
+        if op in self.absinterp.summarized_calls:
+            # the call can have side effects, so it must stay. its range is
+            # still used when optimizing the operations using its result
+            return ir.LocalOptimizer._optimize_op(self, block, index, op)
         if op.resolved_type is types.Bool():
             res = self._known_boolean_value(op)
             if res is not None:
@@ -672,3 +705,485 @@ def optimize_with_range_info(graph, codegen):
     absinterp.analyze()
     opt = IntOpOptimizer(graph, codegen, absinterp)
     return opt.optimize()
+
+def compute_return_range(graph, codegen):
+    """ Compute the range of all the values graph can return. Returns None
+    if nothing useful is known. """
+    if graph.has_loop:
+        return None
+    if graph.has_more_than_n_blocks(1000):
+        return None
+    res = None
+    absinterp = AbstractInterpreter(graph, codegen)
+    values = absinterp.analyze()
+    for block in graph.iterblocks():
+        if not isinstance(block.next, ir.Return) or block not in values:
+            continue
+        value = block.next.value
+        if value is None or value.resolved_type not in RELEVANT_TYPES:
+            return None
+        absinterp.current_values = values[block]
+        bounds = absinterp._bounds(value, must_exist=False)
+        if bounds is None:
+            return None
+        if res is None:
+            res = bounds
+        else:
+            res = res.union(bounds)
+    if res is None or res == UNBOUNDED or res == absinterp.analyze_default(value):
+        return None
+    return res
+
+
+# known bits of small bitvectors
+
+def _width_mask(width):
+    return (1 << width) - 1
+
+class KnownBits(object):
+    """ Abstract value of a small bitvector of a fixed width. The bits set in
+    zeros are known to be 0, the bits set in ones are known to be 1, all
+    other bits are unknown. """
+
+    def __init__(self, width, zeros=0, ones=0):
+        mask = _width_mask(width)
+        zeros = int(zeros) & mask
+        ones = int(ones) & mask
+        assert not zeros & ones
+        self.width = width
+        self.zeros = zeros
+        self.ones = ones
+
+    @staticmethod
+    def fromconst(width, value):
+        value = int(value)
+        return KnownBits(width, ~value, value)
+
+    @staticmethod
+    def unknown(width):
+        return KnownBits(width)
+
+    def __repr__(self):
+        res = []
+        for i in range(self.width - 1, -1, -1):
+            if self.zeros & (1 << i):
+                res.append("0")
+            elif self.ones & (1 << i):
+                res.append("1")
+            else:
+                res.append("?")
+        return "<KnownBits %s>" % ("".join(res), )
+
+    def __eq__(self, other):
+        return (isinstance(other, KnownBits) and self.width == other.width and
+                self.zeros == other.zeros and self.ones == other.ones)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def known(self):
+        return self.zeros | self.ones
+
+    def isconstant(self):
+        return self.known() == _width_mask(self.width)
+
+    def union(self, other):
+        assert self.width == other.width
+        return KnownBits(self.width, self.zeros & other.zeros, self.ones & other.ones)
+
+    def intersect(self, other):
+        assert self.width == other.width
+        zeros = self.zeros | other.zeros
+        ones = self.ones | other.ones
+        if zeros & ones:
+            # contradiction, the path can't be taken
+            return self
+        return KnownBits(self.width, zeros, ones)
+
+    def and_(self, other):
+        return KnownBits(self.width, self.zeros | other.zeros, self.ones & other.ones)
+
+    def or_(self, other):
+        return KnownBits(self.width, self.zeros & other.zeros, self.ones | other.ones)
+
+    def xor(self, other):
+        known = self.known() & other.known()
+        ones = (self.ones ^ other.ones) & known
+        return KnownBits(self.width, known & ~ones, ones)
+
+    def invert(self):
+        return KnownBits(self.width, self.ones, self.zeros)
+
+    def lshift(self, shift):
+        if shift >= self.width:
+            return KnownBits.fromconst(self.width, 0)
+        return KnownBits(self.width, (self.zeros << shift) | _width_mask(shift),
+                         self.ones << shift)
+
+    def rshift(self, shift):
+        if shift >= self.width:
+            return KnownBits.fromconst(self.width, 0)
+        mask = _width_mask(self.width)
+        return KnownBits(self.width, (self.zeros >> shift) | (mask & ~(mask >> shift)),
+                         self.ones >> shift)
+
+    def subrange(self, n, m):
+        return KnownBits(n - m + 1, self.zeros >> m, self.ones >> m)
+
+    def concat(self, other):
+        return KnownBits(self.width + other.width,
+                         (self.zeros << other.width) | other.zeros,
+                         (self.ones << other.width) | other.ones)
+
+    def zero_extend(self, width):
+        extension = _width_mask(width) & ~_width_mask(self.width)
+        return KnownBits(width, self.zeros | extension, self.ones)
+
+    def sign_extend(self, width):
+        if not self.width:
+            return self.zero_extend(width)
+        extension = _width_mask(width) & ~_width_mask(self.width)
+        sign = 1 << (self.width - 1)
+        if self.zeros & sign:
+            return KnownBits(width, self.zeros | extension, self.ones)
+        if self.ones & sign:
+            return KnownBits(width, self.zeros, self.ones | extension)
+        return KnownBits(width, self.zeros, self.ones)
+
+    def truncate(self, width):
+        return KnownBits(width, self.zeros, self.ones)
+
+    def eq(self, other):
+        """ Returns TRUE or FALSE if the result of comparing self and other
+        is known, BOOL otherwise. """
+        if (self.zeros & other.ones) or (self.ones & other.zeros):
+            return FALSE
+        if self.isconstant() and other.isconstant():
+            return TRUE
+        return BOOL
+
+    def make_eq_const(self, mask, value):
+        """ Refine self with the knowledge that (self & mask) == value """
+        return self.intersect(KnownBits(self.width, mask & ~value, mask & value))
+
+
+def _is_bitvector(value):
+    return isinstance(value.resolved_type, types.SmallFixedBitVector)
+
+class KnownBitsInterpreter(AbstractInterpreter):
+    """ Forward analysis computing the known bits of all the small bitvectors
+    of a graph. Follows the conditions of the graph like the range analysis,
+    in particular comparisons of (parts of) a bitvector with a constant, the
+    way instruction decoders do it. The results of boolean operations are
+    stored as Ranges. """
+
+    def _argument_value(self, arg):
+        if _is_bitvector(arg):
+            return KnownBits.unknown(arg.resolved_type.width)
+        return UNBOUNDED
+
+    def analyze_block(self, block):
+        for op in block.operations:
+            if not _is_bitvector(op) and op.resolved_type is not types.Bool():
+                continue
+            if isinstance(op, ir.Phi):
+                res = self.analyze_Phi(op)
+            elif type(op) is ir.Operation:
+                name = self._builtinname(op.name).lstrip("@")
+                meth = getattr(self, "analyze_bits_" + name, None)
+                if meth is None:
+                    res = self.analyze_default(op)
+                else:
+                    res = meth(op)
+            else:
+                res = self.analyze_default(op)
+            assert res is not None
+            self.current_values[op] = res
+
+    def analyze_default(self, op):
+        if _is_bitvector(op):
+            return KnownBits.unknown(op.resolved_type.width)
+        return AbstractInterpreter.analyze_default(self, op)
+
+    def analyze_Phi(self, op):
+        res = None
+        for prevblock, value in zip(op.prevblocks, op.prevvalues):
+            b = self._bounds(value, must_exist=False, block=prevblock)
+            if res is None:
+                res = b
+            elif b is not None:
+                res = res.union(b)
+        if res is None:
+            return self.analyze_default(op)
+        return res
+
+    def _bounds(self, op, must_exist=True, block=None):
+        if isinstance(op, ir.SmallBitVectorConstant):
+            return KnownBits.fromconst(op.resolved_type.width, op.value)
+        if isinstance(op, ir.BooleanConstant):
+            return AbstractInterpreter._bounds(self, op)
+        if not _is_bitvector(op) and op.resolved_type is not types.Bool():
+            return None
+        if isinstance(op, (ir.DefaultValue, ir.Constant)):
+            return self.analyze_default(op)
+        block_values = self.current_values
+        if block is not None:
+            block_values = self.values.get(block, None)
+            if not block_values:
+                return None
+        if not must_exist:
+            return block_values.get(op, None)
+        res = block_values.get(op, None)
+        if res is None:
+            # e.g. the result of a cast
+            return self.analyze_default(op)
+        return res
+
+    def _constant_args(self, op, *indexes):
+        res = []
+        for index in indexes:
+            arg = op.args[index]
+            if not isinstance(arg, ir.MachineIntConstant):
+                return None
+            res.append(arg.number)
+        return res
+
+    def analyze_bits_and_vec_bv_bv(self, op):
+        arg0, arg1 = self._argbounds(op)
+        return arg0.and_(arg1)
+
+    def analyze_bits_or_vec_bv_bv(self, op):
+        arg0, arg1 = self._argbounds(op)
+        return arg0.or_(arg1)
+
+    def analyze_bits_xor_vec_bv_bv(self, op):
+        arg0, arg1 = self._argbounds(op)
+        return arg0.xor(arg1)
+
+    def analyze_bits_not_vec_bv(self, op):
+        return self._bounds(op.args[0]).invert()
+
+    def analyze_bits_shiftl_bv_i(self, op):
+        shift = self._constant_args(op, 2)
+        if shift is None or shift[0] < 0:
+            return self.analyze_default(op)
+        return self._bounds(op.args[0]).lshift(shift[0])
+
+    def analyze_bits_shiftr_bv_i(self, op):
+        shift = self._constant_args(op, 2)
+        if shift is None or shift[0] < 0:
+            return self.analyze_default(op)
+        return self._bounds(op.args[0]).rshift(shift[0])
+
+    def analyze_bits_vector_subrange_fixed_bv_i_i(self, op):
+        indexes = self._constant_args(op, 1, 2)
+        if indexes is None:
+            return self.analyze_default(op)
+        n, m = indexes
+        return self._bounds(op.args[0]).subrange(n, m)
+
+    def analyze_bits_slice_fixed_bv_i_i(self, op):
+        indexes = self._constant_args(op, 1, 2)
+        if indexes is None:
+            return self.analyze_default(op)
+        start, length = indexes
+        return self._bounds(op.args[0]).subrange(start + length - 1, start)
+
+    def analyze_bits_bitvector_concat_bv_bv(self, op):
+        arg0 = self._bounds(op.args[0])
+        arg1 = self._bounds(op.args[2])
+        return arg0.concat(arg1)
+
+    def analyze_bits_zero_extend_bv_i_i(self, op):
+        return self._bounds(op.args[0]).zero_extend(op.resolved_type.width)
+
+    def analyze_bits_sign_extend_bv_i_i(self, op):
+        return self._bounds(op.args[0]).sign_extend(op.resolved_type.width)
+
+    def analyze_bits_truncate_bv_i(self, op):
+        return self._bounds(op.args[0]).truncate(op.resolved_type.width)
+
+    def analyze_bits_eq_bits_bv_bv(self, op):
+        arg0, arg1 = self._argbounds(op)
+        return arg0.eq(arg1)
+
+    def analyze_bits_neq_bits_bv_bv(self, op):
+        res = self.analyze_bits_eq_bits_bv_bv(op)
+        if res == TRUE:
+            return FALSE
+        if res == FALSE:
+            return TRUE
+        return BOOL
+
+    def analyze_bits_not(self, op):
+        res = self._bounds(op.args[0])
+        if res == TRUE:
+            return FALSE
+        if res == FALSE:
+            return TRUE
+        return BOOL
+
+    def analyze_condition(self, op):
+        truevalues = self.current_values.copy()
+        falsevalues = self.current_values.copy()
+        if type(op) is not ir.Operation:
+            return truevalues, falsevalues
+        name = self._builtinname(op.name).lstrip("@")
+        if name == "not":
+            falsevalues, truevalues = self.analyze_condition(op.args[0])
+            falsevalues[op.args[0]] = TRUE
+            truevalues[op.args[0]] = FALSE
+        elif name == "eq_bits_bv_bv":
+            self._refine_eq(truevalues, op.args[0], op.args[1])
+            self._refine_eq(truevalues, op.args[1], op.args[0])
+        elif name == "neq_bits_bv_bv":
+            self._refine_eq(falsevalues, op.args[0], op.args[1])
+            self._refine_eq(falsevalues, op.args[1], op.args[0])
+        return truevalues, falsevalues
+
+    def _refine_eq(self, values, arg, other):
+        """ store in values what is known about arg if arg == other """
+        if isinstance(arg, ir.Constant):
+            return
+        bits = self._bounds(arg).intersect(self._bounds(other))
+        values[arg] = bits
+        if type(arg) is not ir.Operation:
+            return
+        # push the knowledge into the argument of masks and subranges, to be
+        # able to use it for the later tests of a decoder
+        name = self._builtinname(arg.name).lstrip("@")
+        mask = _width_mask(bits.width)
+        if name == "and_vec_bv_bv":
+            for index in range(2):
+                argmask = arg.args[1 - index]
+                if isinstance(argmask, ir.SmallBitVectorConstant):
+                    mask = int(argmask.value)
+                    self._refine_masked(
+                        values, arg.args[index], mask, bits, 0)
+                    break
+        elif name == "vector_subrange_fixed_bv_i_i":
+            indexes = self._constant_args(arg, 1, 2)
+            if indexes is not None:
+                self._refine_masked(values, arg.args[0], mask, bits, indexes[1])
+        elif name == "slice_fixed_bv_i_i":
+            indexes = self._constant_args(arg, 1, 2)
+            if indexes is not None:
+                self._refine_masked(values, arg.args[0], mask, bits, indexes[0])
+
+    def _refine_masked(self, values, arg, mask, bits, shift):
+        if isinstance(arg, ir.Constant):
+            return
+        mask &= bits.known()
+        argbits = values.get(arg, None)
+        if argbits is None:
+            argbits = self._bounds(arg)
+        values[arg] = argbits.make_eq_const(mask << shift, bits.ones << shift)
+
+
+class KnownBitsOptimizer(object):
+    """ Uses the results of the KnownBitsInterpreter to replace bitvector
+    operations with fully known results by constants, to remove masking
+    operations that don't change their argument and to fold comparisons. """
+
+    def __init__(self, graph, codegen, absinterp):
+        self.graph = graph
+        self.codegen = codegen
+        self.absinterp = absinterp
+        self.values = absinterp.values
+
+    def _builtinname(self, name):
+        return self.codegen.builtin_names.get(name, name)
+
+    def _as_constant(self, value, current_values):
+        if isinstance(value, ir.Constant):
+            return None
+        if _is_bitvector(value):
+            bits = current_values.get(value, None)
+            if bits is not None and bits.isconstant():
+                return ir.SmallBitVectorConstant(r_uint(bits.ones), value.resolved_type)
+        elif value.resolved_type is types.Bool():
+            bits = current_values.get(value, None)
+            if bits == TRUE:
+                return ir.BooleanConstant.TRUE
+            if bits == FALSE:
+                return ir.BooleanConstant.FALSE
+        return None
+
+    def _superfluous_mask(self, op, current_values):
+        """ checks whether op is an and/or with a constant that doesn't
+        change the other argument. returns that argument if so. """
+        name = self._builtinname(op.name).lstrip("@")
+        if name not in ("and_vec_bv_bv", "or_vec_bv_bv"):
+            return None
+        for index in range(2):
+            mask = op.args[1 - index]
+            if not isinstance(mask, ir.SmallBitVectorConstant):
+                continue
+            arg = op.args[index]
+            bits = self.absinterp._bounds(arg, must_exist=False, block=self.current_block)
+            if bits is None:
+                continue
+            mask = int(mask.value)
+            if name == "and_vec_bv_bv":
+                # all the bits cleared by the mask are 0 already
+                if not ~mask & _width_mask(bits.width) & ~bits.zeros:
+                    return arg
+            else:
+                # all the bits set by the mask are 1 already
+                if not mask & ~bits.ones:
+                    return arg
+        return None
+
+    def optimize(self):
+        replacements = {}
+        changed = False
+        for block in self.graph.iterblocks():
+            if block not in self.values:
+                continue
+            self.current_block = block
+            current_values = self.values[block]
+            newoperations = []
+            for op in block.operations:
+                if not isinstance(op, ir.Phi):
+                    for index, arg in enumerate(op.args):
+                        const = self._as_constant(arg, current_values)
+                        if const is not None:
+                            op.args[index] = const
+                            changed = True
+                if type(op) is ir.Operation:
+                    name = self._builtinname(op.name).lstrip("@")
+                    if hasattr(self.absinterp, "analyze_bits_" + name):
+                        res = self._as_constant(op, current_values)
+                        if res is None:
+                            res = self._superfluous_mask(op, current_values)
+                        if res is not None:
+                            replacements[op] = res
+                            continue
+                newoperations.append(op)
+            if len(newoperations) != len(block.operations):
+                block.operations = newoperations
+            for value in block.next.getargs():
+                const = self._as_constant(value, current_values)
+                if const is not None:
+                    block.next.replace_ops({value: const})
+                    changed = True
+        if replacements:
+            # a mask can be replaced by another mask that is removed too
+            for key, value in replacements.items():
+                while value in replacements:
+                    value = replacements[value]
+                replacements[key] = value
+            self.graph.replace_ops(replacements)
+            changed = True
+        return changed
+
+@ir.timed
+def optimize_with_known_bits(graph, codegen):
+    if graph.has_loop:
+        return False
+    if graph.has_more_than_n_blocks(1000):
+        return False
+    absinterp = KnownBitsInterpreter(graph, codegen)
+    absinterp.analyze()
+    opt = KnownBitsOptimizer(graph, codegen, absinterp)
+    return opt.optimize()
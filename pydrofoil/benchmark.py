@@ -0,0 +1,266 @@
+""" Benchmark of the code generation pipeline.
+
+Runs parsing, type inference, SSA construction, the optimizations and
+specialization, and the emission of the Python code for the models that are
+available in the checkout. Writes a JSON report with the wall time and the
+peak RSS of every phase, the time, number of iterations and the sizes of the
+graphs before and after every optimization pass, and the size of the result.
+The report can be compared against a stored baseline:
+
+    python -m pydrofoil.benchmark -o report.json --baseline baseline.json
+
+The exit status is 1 if any of the numbers got worse by more than the
+threshold.
+
+Every model is benchmarked in a fresh process, so that the peak RSS of a
+phase is the peak of that model up to the end of the phase, not of whatever
+ran before it.
+"""
+
+import os
+import sys
+import time
+import json
+import resource
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+from pydrofoil import parse, ir, makecode
+
+toplevel = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REPORT_VERSION = 1
+
+# timings below that are too noisy to compare
+MIN_SECONDS = 0.5
+
+
+class Model(object):
+    def __init__(self, name, filename, support_code, get_options):
+        self.name = name
+        self.filename = os.path.join(toplevel, filename)
+        self.support_code = support_code
+        self.get_options = get_options # -> keyword arguments for make_codegen
+
+    def available(self):
+        return os.path.exists(self.filename)
+
+
+def _nand_options():
+    return {}
+
+def _riscv_options():
+    from riscv import targetriscv
+    return dict(promoted_registers=targetriscv.PROMOTED_REGISTERS,
+                entrypoints=targetriscv.ENTRYPOINTS)
+
+def _arm_options():
+    from arm import targetarm
+    return dict(promoted_registers=targetarm.PROMOTED_REGISTERS,
+                entrypoints=targetarm.ENTRYPOINTS,
+                should_inline=targetarm.should_inline)
+
+MODELS = [
+    Model("nand2tetris", "pydrofoil/test/nand2tetris/generated/nand2tetris.jib",
+          "from pydrofoil.test.nand2tetris import supportcodenand as supportcode",
+          _nand_options),
+    Model("riscv64", "riscv/riscv_model_RV64.ir",
+          "from riscv import supportcoderiscv as supportcode",
+          _riscv_options),
+    Model("riscv32", "riscv/riscv_model_RV32.ir",
+          "from riscv import supportcoderiscv as supportcode",
+          _riscv_options),
+    Model("arm", "arm/armv9.ir",
+          "from arm import supportcodearm as supportcode",
+          _arm_options),
+]
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux, but in bytes on OS X
+    res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        res //= 1024
+    return res
+
+@contextmanager
+def _phase(phases, name):
+    t1 = time.time()
+    yield
+    t2 = time.time()
+    phases[name] = {"time": t2 - t1, "peak_rss_kb": peak_rss_kb()}
+
+def benchmark_model(model):
+    from pydrofoil.infer import infer
+    with open(model.filename, "rb") as f:
+        s = f.read()
+    options = model.get_options()
+    phases = {}
+    ir.reset_stats()
+    ir.MEASURE_GRAPH_SIZES = True
+    try:
+        with _phase(phases, "parse"):
+            ast = parse.parser.parse(parse.lexer.lex(s))
+        with _phase(phases, "infer"):
+            infer(ast)
+        entrypoints = options.get("entrypoints")
+        if entrypoints is not None:
+            with _phase(phases, "remove_unreachable"):
+                ast.remove_unreachable_functions(entrypoints + ["zinitializze_registers"])
+        codegen = makecode.make_codegen(model.support_code, **options)
+        with _phase(phases, "build_ssa"):
+            ast.make_code(codegen)
+        with _phase(phases, "specialize"):
+            codegen.specialize_all()
+        number_blocks = number_ops = 0
+        for graph in codegen.all_graph_by_name.itervalues():
+            blocks, ops = ir.graph_size(graph)
+            number_blocks += blocks
+            number_ops += ops
+        with _phase(phases, "emit"):
+            code = codegen.getcode()
+    finally:
+        ir.MEASURE_GRAPH_SIZES = False
+    passes = {}
+    for name, t in ir.TIMINGS.iteritems():
+        passes[name] = {
+            "time": t,
+            "iterations": ir.COUNTS[name],
+            "ops_before": ir.OPS_BEFORE[name],
+            "ops_after": ir.OPS_AFTER[name],
+        }
+    return {
+        "phases": phases,
+        "total_time": sum(phase["time"] for phase in phases.itervalues()),
+        "passes": passes,
+        "graphs": {
+            "number": len(codegen.all_graph_by_name),
+            "blocks": number_blocks,
+            "ops": number_ops,
+        },
+        "output_lines": code.count("\n") + 1,
+    }
+
+def benchmark_model_in_subprocess(model):
+    fd, filename = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        subprocess.check_call([sys.executable, "-m", "pydrofoil.benchmark",
+                               "--single-model-output", filename, model.name],
+                              cwd=toplevel)
+        with open(filename) as f:
+            return json.load(f)
+    finally:
+        os.unlink(filename)
+
+def run(models, fresh_process=True):
+    report = {"version": REPORT_VERSION, "python": sys.version.split()[0], "models": {}}
+    for model in models:
+        print "benchmarking", model.name
+        if fresh_process:
+            result = benchmark_model_in_subprocess(model)
+        else:
+            result = benchmark_model(model)
+        report["models"][model.name] = result
+    return report
+
+
+def compare_reports(baseline, report, threshold=0.25):
+    """ Compare report against baseline, return a list of the regressions
+    as strings. A time, memory or size counts as a regression if it grew by
+    more than threshold (a fraction). """
+    regressions = []
+
+    def check(what, old, new, min_old=0):
+        if old is None or new is None or old < min_old:
+            return
+        if new > old * (1 + threshold):
+            regressions.append("%s: %s -> %s (+%.1f%%)" % (
+                what, _format(old), _format(new), (new - old) * 100.0 / old if old else float("inf")))
+
+    for name, new in sorted(report["models"].iteritems()):
+        old = baseline.get("models", {}).get(name)
+        if old is None:
+            continue
+        check("%s total time" % name, old.get("total_time"), new["total_time"], MIN_SECONDS)
+        for phasename, phase in sorted(new["phases"].iteritems()):
+            oldphase = old.get("phases", {}).get(phasename)
+            if oldphase is None:
+                continue
+            check("%s %s time" % (name, phasename), oldphase.get("time"), phase["time"], MIN_SECONDS)
+            check("%s %s peak rss [kb]" % (name, phasename), oldphase.get("peak_rss_kb"), phase["peak_rss_kb"])
+        for passname, pas in sorted(new["passes"].iteritems()):
+            oldpass = old.get("passes", {}).get(passname)
+            if oldpass is None:
+                continue
+            check("%s pass %s time" % (name, passname), oldpass.get("time"), pas["time"], MIN_SECONDS)
+        check("%s ops after optimization" % name, old.get("graphs", {}).get("ops"), new["graphs"]["ops"])
+        check("%s output lines" % name, old.get("output_lines"), new["output_lines"])
+    return regressions
+
+def _format(value):
+    if isinstance(value, float):
+        return "%.2f" % (value, )
+    return str(value)
+
+
+def print_report(report):
+    for name, result in sorted(report["models"].iteritems()):
+        print
+        print name, "total time:", round(result["total_time"], 2), "output lines:", result["output_lines"]
+        for phasename, phase in sorted(result["phases"].iteritems(), key=lambda item: -item[1]["time"]):
+            print "   ", phasename.ljust(20), "time:", round(phase["time"], 2), "peak rss [kb]:", phase["peak_rss_kb"]
+        passes = sorted(result["passes"].iteritems(), key=lambda item: -item[1]["time"])
+        for passname, pas in passes[:20]:
+            print "   ", passname.rjust(32), "time:", round(pas["time"], 2), "iterations:", pas["iterations"], "ops:", pas["ops_before"], "->", pas["ops_after"]
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the code generation of the models in the checkout")
+    parser.add_argument("models", nargs="*", help="names of the models to benchmark (default: all available ones): %s" % (
+        ", ".join(model.name for model in MODELS)))
+    parser.add_argument("-o", "--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="compare against this JSON report")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed relative growth of times and sizes (default: 0.25)")
+    # used by benchmark_model_in_subprocess
+    parser.add_argument("--single-model-output", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+    if args.models:
+        models_by_name = {model.name: model for model in MODELS}
+        for name in args.models:
+            if name not in models_by_name:
+                parser.error("unknown model %r" % (name, ))
+        models = [models_by_name[name] for name in args.models]
+    else:
+        models = MODELS
+    for model in models:
+        if not model.available():
+            print "skipping %s, %s does not exist" % (model.name, model.filename)
+    models = [model for model in models if model.available()]
+    if args.single_model_output:
+        model, = models
+        with open(args.single_model_output, "w") as f:
+            json.dump(benchmark_model(model), f)
+        return 0
+    report = run(models)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print "written report", args.output
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.threshold)
+        if regressions:
+            print "REGRESSIONS compared to", args.baseline
+            for line in regressions:
+                print "   ", line
+            return 1
+        print "no regressions compared to", args.baseline
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -29,6 +29,8 @@ def bigint_divrem1(a, n):
 def from_ruint(size, val):
     if size <= 64:
         return SmallBitVector(size, val, True)
+    if size <= 128:
+        return TwoWordBitVector(size, val, r_uint(0))
     return SparseBitVector(size, val)
 
 @always_inline
@@ -36,6 +38,10 @@ def from_bigint(size, rval):
     if size <= 64:
         value = rbigint_extract_ruint(rval, 0)
         return SmallBitVector(size, value, True)
+    if size <= 128:
+        low = rbigint_extract_ruint(rval, 0)
+        high = rbigint_extract_ruint(rval, 64)
+        return TwoWordBitVector(size, low, high, True)
     return GenericBitVector.from_bigint(size, rval)
 
 @always_inline
@@ -117,6 +123,11 @@ class BitVector(object):
     def append_64(self, ui):
         raise NotImplementedError("abstract base class")
 
+    def two_words(self):
+        """ return the lower and the upper word of a bitvector of width <=
+        128, as a tuple of r_uints """
+        raise NotImplementedError("abstract base class")
+
     def lshift_bits(self, other):
         return self.lshift(other.toint())
 
@@ -128,6 +139,10 @@ class BitVector(object):
         if size <= 64:
             assert data is None
             return SmallBitVector(size, val)
+        elif size <= 128:
+            if data is None:
+                return TwoWordBitVector(size, val, r_uint(0))
+            return TwoWordBitVector(size, data[0], data[1])
         elif data is None:
             return SparseBitVector(size, val)
         else:
@@ -254,13 +269,16 @@ class SmallBitVector(BitVector):
         if i == size:
             return self
 
-        if i > 64:
+        if i > 128:
             if self.read_bit(size - 1):
                 return GenericBitVector._sign_extend(size, [self.val], i)
             else:
                 return SparseBitVector(i, self.val)
         m = r_uint(1) << (self.size() - 1)
-        return SmallBitVector(i, (self.val ^ m) - m, True)
+        low = (self.val ^ m) - m
+        if i > 64:
+            return TwoWordBitVector(i, low, r_uint(intmask(low) >> 63), True)
+        return SmallBitVector(i, low, True)
 
     def read_bit(self, pos):
         assert pos < self.size()
@@ -316,9 +334,15 @@ class SmallBitVector(BitVector):
 
     def append(self, other):
         ressize = self.size() + other.size()
-        if ressize > 64 or not isinstance(other, SmallBitVector):
+        if not isinstance(other, SmallBitVector):
             return BitVector.append(self, other)
-        return from_ruint(ressize, (self.val << other.size()) | other.val)
+        shift = other.size()
+        if ressize <= 64:
+            return from_ruint(ressize, (self.val << shift) | other.val)
+        if ressize <= 128 and shift < 64:
+            low = (self.val << shift) | other.val
+            return TwoWordBitVector(ressize, low, self.val >> (64 - shift))
+        return BitVector.append(self, other)
 
     def replicate(self, i):
         size = self.size()
@@ -343,7 +367,10 @@ class SmallBitVector(BitVector):
     def append_64(self, ui):
         if not self.val:
             return from_ruint(self.size() + 64, ui)
-        return GenericBitVector(self.size() + 64, [ui, self.val])
+        return TwoWordBitVector(self.size() + 64, ui, self.val)
+
+    def two_words(self):
+        return self.val, r_uint(0)
 
     def pack(self):
         return (self.size(), self.val, None)
@@ -478,7 +505,7 @@ class SparseBitVector(BitVector):
             res = r_uint(0)
         else:
             res = self.val >> m
-        return SparseBitVector(width, res)
+        return from_ruint(width, res)
 
     def subrange_unwrapped_res(self, n, m):
         assert 0 <= m <= n < self.size()
@@ -572,7 +599,9 @@ class SparseBitVector(BitVector):
         assert i <= self.size()
         if i <= 64:
             return SmallBitVector(i, ruint_mask(i, self.val), normalize=True)
-        return SparseBitVector(i, self.val)
+        if i == self.size():
+            return self
+        return from_ruint(i, self.val)
 
     def append_64(self, ui):
         newsize = self.size() + 64
@@ -584,9 +613,290 @@ class SparseBitVector(BitVector):
         resdata[0] = ui
         return GenericBitVector(newsize, resdata, normalize=False)
 
+    def two_words(self):
+        return self.val, r_uint(0)
+
     def pack(self):
         return (self.size(), self.val, None)
 
+class TwoWordBitVector(BitVector):
+    """ A bitvector of width 65-128, stored in two machine words. """
+    _immutable_fields_ = ['low', 'high']
+
+    def __init__(self, size, low, high, normalize=False):
+        BitVector.__init__(self, size)
+        assert 64 < size <= 128
+        assert isinstance(low, r_uint)
+        assert isinstance(high, r_uint)
+        if normalize:
+            high = ruint_mask(size - 64, high)
+        else:
+            # XXX disable after translation, later
+            if size < 128:
+                assert high >> (size - 64) == r_uint(0)
+        self.low = low # r_uint
+        self.high = high # r_uint
+
+    def __repr__(self):
+        return "<TwoWordBitVector %s 0x%x%016x>" % (self.size(), self.high, self.low)
+
+    def make(self, low, high, normalize=False):
+        return TwoWordBitVector(self.size(), low, high, normalize)
+
+    def two_words(self):
+        return self.low, self.high
+
+    @staticmethod
+    @always_inline
+    def _words_of_int(i):
+        # the lowest 128 bits of the two's complement of i
+        if isinstance(i, SmallInteger):
+            return r_uint(i.val), r_uint(i.val >> 63)
+        assert isinstance(i, BigInteger)
+        return i.slice_unwrapped_res(64, 0), i.slice_unwrapped_res(64, 64)
+
+    @staticmethod
+    @always_inline
+    def _lshift_words(low, high, i):
+        assert 0 <= i < 128
+        if i >= 64:
+            return r_uint(0), low << (i - 64)
+        if i == 0:
+            return low, high
+        return low << i, (high << i) | (low >> (64 - i))
+
+    @staticmethod
+    @always_inline
+    def _rshift_words(low, high, i):
+        assert 0 <= i < 128
+        if i >= 64:
+            return high >> (i - 64), r_uint(0)
+        if i == 0:
+            return low, high
+        return (low >> i) | (high << (64 - i)), high >> i
+
+    def _add_words(self, otherlow, otherhigh):
+        low = self.low + otherlow
+        carry = r_uint(low < otherlow)
+        return self.make(low, self.high + otherhigh + carry, True)
+
+    def _sub_words(self, otherlow, otherhigh):
+        borrow = r_uint(self.low < otherlow)
+        return self.make(self.low - otherlow, self.high - otherhigh - borrow, True)
+
+    def add_int(self, i):
+        low, high = self._words_of_int(i)
+        return self._add_words(low, high)
+
+    def add_bits(self, other):
+        assert self.size() == other.size()
+        low, high = other.two_words()
+        return self._add_words(low, high)
+
+    def sub_bits(self, other):
+        assert self.size() == other.size()
+        low, high = other.two_words()
+        return self._sub_words(low, high)
+
+    def sub_int(self, i):
+        low, high = self._words_of_int(i)
+        return self._sub_words(low, high)
+
+    def lshift(self, i):
+        if i < 0:
+            raise ValueError("negative shift count")
+        if i >= self.size():
+            return self.make(r_uint(0), r_uint(0))
+        low, high = self._lshift_words(self.low, self.high, i)
+        return self.make(low, high, True)
+
+    def rshift(self, i):
+        if i < 0:
+            raise ValueError("negative shift count")
+        if i >= self.size():
+            return self.make(r_uint(0), r_uint(0))
+        low, high = self._rshift_words(self.low, self.high, i)
+        return self.make(low, high)
+
+    def _signed_high(self):
+        # the upper word, sign-extended from bit size - 1 to 64 bits
+        m = r_uint(1) << (self.size() - 65)
+        return (self.high ^ m) - m
+
+    def arith_rshift(self, i):
+        if i < 0:
+            raise ValueError("negative shift count")
+        size = self.size()
+        if i >= size:
+            i = size - 1
+        high = self._signed_high()
+        if i >= 64:
+            low = r_uint(intmask(high) >> (i - 64))
+            high = r_uint(intmask(high) >> 63)
+        elif i:
+            low = (self.low >> i) | (high << (64 - i))
+            high = r_uint(intmask(high) >> i)
+        else:
+            return self
+        return self.make(low, high, True)
+
+    def xor(self, other):
+        assert self.size() == other.size()
+        low, high = other.two_words()
+        return self.make(self.low ^ low, self.high ^ high)
+
+    def and_(self, other):
+        assert self.size() == other.size()
+        low, high = other.two_words()
+        return self.make(self.low & low, self.high & high)
+
+    def or_(self, other):
+        assert self.size() == other.size()
+        low, high = other.two_words()
+        return self.make(self.low | low, self.high | high)
+
+    def invert(self):
+        return self.make(~self.low, ~self.high, True)
+
+    def subrange(self, n, m):
+        assert 0 <= m <= n < self.size()
+        width = n - m + 1
+        if width <= 64:
+            return SmallBitVector(width, self.subrange_unwrapped_res(n, m))
+        low, high = self._rshift_words(self.low, self.high, m)
+        return TwoWordBitVector(width, low, high, normalize=True)
+
+    def subrange_unwrapped_res(self, n, m):
+        assert 0 <= m <= n < self.size()
+        width = n - m + 1
+        assert 0 < width <= 64
+        low, _ = self._rshift_words(self.low, self.high, m)
+        return ruint_mask(width, low)
+
+    def zero_extend(self, i):
+        if i == self.size():
+            return self
+        assert i > self.size()
+        if i <= 128:
+            return TwoWordBitVector(i, self.low, self.high)
+        if not self.high:
+            return SparseBitVector(i, self.low)
+        resdata = [r_uint(0)] * GenericBitVector._data_size(i)
+        resdata[0] = self.low
+        resdata[1] = self.high
+        return GenericBitVector(i, resdata)
+
+    def sign_extend(self, i):
+        size = self.size()
+        if i == size:
+            return self
+        assert i > size
+        if i <= 128:
+            return TwoWordBitVector(i, self.low, self._signed_high(), normalize=True)
+        if not self.read_bit(size - 1):
+            return self.zero_extend(i)
+        return GenericBitVector._sign_extend(size, [self.low, self.high], i)
+
+    def read_bit(self, pos):
+        assert pos < self.size()
+        if pos >= 64:
+            return bool((self.high >> (pos - 64)) & 1)
+        return bool((self.low >> pos) & 1)
+
+    def update_bit(self, pos, bit):
+        assert pos < self.size()
+        low, high = self.low, self.high
+        if pos >= 64:
+            mask = r_uint(1) << (pos - 64)
+            high = (high | mask) if bit else (high & ~mask)
+        else:
+            mask = r_uint(1) << pos
+            low = (low | mask) if bit else (low & ~mask)
+        return self.make(low, high)
+
+    def update_subrange(self, n, m, s):
+        width = s.size()
+        assert width <= self.size()
+        slow, shigh = s.two_words()
+        if width == self.size():
+            return self.make(slow, shigh)
+        assert width == n - m + 1
+        if width > 64:
+            masklow, maskhigh = r_uint(-1), ruint_mask(width - 64, r_uint(-1))
+        else:
+            masklow, maskhigh = ruint_mask(width, r_uint(-1)), r_uint(0)
+        masklow, maskhigh = self._lshift_words(masklow, maskhigh, m)
+        slow, shigh = self._lshift_words(slow, shigh, m)
+        return self.make((self.low & ~masklow) | slow, (self.high & ~maskhigh) | shigh)
+
+    def signed(self):
+        high = self._signed_high()
+        if not high:
+            return Integer.from_ruint(self.low)
+        if high == r_uint(-1) and self.low >> 63:
+            return SmallInteger(intmask(self.low))
+        if not high >> 63:
+            return Integer.from_data_and_sign([self.low, high], 1)
+        # negate the two's complement value to get the absolute value
+        neglow = -self.low
+        neghigh = ~high + r_uint(not self.low)
+        return Integer.from_data_and_sign([neglow, neghigh], -1)
+
+    def unsigned(self):
+        if not self.high:
+            return Integer.from_ruint(self.low)
+        return Integer.from_data_and_sign([self.low, self.high], 1)
+
+    def eq(self, other):
+        assert self.size() == other.size()
+        low, high = other.two_words()
+        return self.low == low and self.high == high
+
+    def toint(self):
+        if self.high or self.low >> 63:
+            raise ValueError
+        return intmask(self.low)
+
+    def touint(self, expected_width=0):
+        if expected_width:
+            assert self.size() == expected_width
+        if self.high:
+            raise ValueError
+        return self.low
+
+    def tobigint(self):
+        jit.jit_debug("TwoWordBitVector.tobigint")
+        return rbigint_from_array([self.low, self.high])
+
+    @jit.unroll_safe
+    def replicate(self, i):
+        size = self.size()
+        jit.jit_debug("TwoWordBitVector.replicate")
+        res = val = self.tobigint()
+        for _ in range(i - 1):
+            res = res.lshift(size).or_(val)
+        return from_bigint(size * i, res)
+
+    def truncate(self, i):
+        size = self.size()
+        assert i <= size
+        if i <= 64:
+            return SmallBitVector(i, self.low, normalize=True)
+        if i == size:
+            return self
+        return TwoWordBitVector(i, self.low, self.high, normalize=True)
+
+    def append_64(self, ui):
+        newsize = self.size() + 64
+        if not self.low and not self.high:
+            return SparseBitVector(newsize, ui)
+        return GenericBitVector(newsize, [ui, self.low, self.high])
+
+    def pack(self):
+        if not self.high:
+            return (self.size(), self.low, None)
+        return (self.size(), r_uint(0xdeaddead), [self.low, self.high])
+
 def array_from_rbigint(size, rval):
     from rpython.rlib.rbigint import SHIFT
     res = []
@@ -670,6 +980,10 @@ class GenericBitVector(BitVector):
         data[wordindex] = ruint_mask(bitindex + 1, data[wordindex])
         return data
 
+    def _to_twoword(self):
+        low, high = self.two_words()
+        return TwoWordBitVector(self.size(), low, high)
+
     def add_int(self, i):
         if isinstance(i, SmallInteger):
             if i.val >= 0:
@@ -704,6 +1018,8 @@ class GenericBitVector(BitVector):
                 carry += res < othervalue
                 resdata[i] = res
             return self.make(resdata, True)
+        elif isinstance(other, TwoWordBitVector):
+            return self._to_twoword().add_bits(other)
         else:
             assert isinstance(other, SparseBitVector)
             return self._add_ruint(other.val)
@@ -731,6 +1047,8 @@ class GenericBitVector(BitVector):
                 carry += selfvalue < value
                 resdata[i] = selfvalue - value
             return self.make(resdata, True)
+        if isinstance(other, TwoWordBitVector):
+            return self._to_twoword().sub_bits(other)
         assert isinstance(other, SparseBitVector)
         return self._sub_ruint(other.val)
 
@@ -851,6 +1169,8 @@ class GenericBitVector(BitVector):
 
     @jit.unroll_safe
     def xor(self, other):
+        if isinstance(other, TwoWordBitVector):
+            return self._to_twoword().xor(other)
         resdata = self.data[:]
         if isinstance(other, GenericBitVector):
             for i, value in enumerate(other.data):
@@ -862,6 +1182,8 @@ class GenericBitVector(BitVector):
 
     @jit.unroll_safe
     def or_(self, other):
+        if isinstance(other, TwoWordBitVector):
+            return self._to_twoword().or_(other)
         resdata = self.data[:]
         if isinstance(other, GenericBitVector):
             for i, value in enumerate(other.data):
@@ -878,6 +1200,8 @@ class GenericBitVector(BitVector):
             for i, value in enumerate(other.data):
                 resdata[i] &= value
             return self.make(resdata)
+        elif isinstance(other, TwoWordBitVector):
+            return self._to_twoword().and_(other)
         else:
             assert isinstance(other, SparseBitVector)
             return SparseBitVector(self.size(), self.data[0] & other.val)
@@ -896,25 +1220,16 @@ class GenericBitVector(BitVector):
         return self.rshift(m).truncate(width) # XXX do it in one call
 
     def subrange_unwrapped_res(self, n, m):
-        width = n - m + 1
-        assert 0 < width <= 64
-        wordshift, bitshift = _data_indexes(m)
-        size = self.size()
-        data = self.data
-        res = data[wordshift]
-        if bitshift:
-            res >>= bitshift
-            if wordshift + 1 < len(data):
-                antibitshift = 64 - bitshift
-                assert 0 <= antibitshift < 64
-                res |= (data[wordshift + 1] << antibitshift)
-        return ruint_mask(width, res)
+        return _data_subrange_unwrapped_res(self.data, n, m)
 
     @jit.unroll_safe
     def zero_extend(self, i):
         if i == self.size():
             return self
         assert i > self.size()
+        if 64 < i <= 128:
+            low, high = self.two_words()
+            return TwoWordBitVector(i, low, high)
         wordsize, bitsize = _data_indexes(i)
         targetsize = wordsize + bool(bitsize)
         resdata = [r_uint(0)] * targetsize
@@ -960,45 +1275,10 @@ class GenericBitVector(BitVector):
         resdata[wordindex] = newword
         return GenericBitVector(self.size(), resdata)
 
-    @jit.unroll_safe
     def update_subrange(self, n, m, other):
-        width = other.size()
-        assert width == n - m + 1
-
-        start_wordindex, start_bitindex = _data_indexes(m)
-        end_wordindex, end_bitindex = _data_indexes(n + 1) # exclusive
-        if width <= 64:
-            assert isinstance(other, SmallBitVector)
-            otherdata = [other.val]
-        else:
-            if isinstance(other, SparseBitVector):
-                otherdata = other._to_generic().data
-            else:
-                assert isinstance(other, GenericBitVector)
-                otherdata = other.data
+        assert other.size() == n - m + 1
         resdata = self.data[:]
-        if not start_bitindex:
-            j = 0
-            for index in range(start_wordindex, end_wordindex):
-                resdata[index] = otherdata[j]
-                j += 1
-            accum = r_uint(0)
-        else:
-            accum = self.data[start_wordindex] & ((1 << start_bitindex) - 1)
-            antibitshift = 64 - start_bitindex
-            j = 0
-            for index in range(start_wordindex, end_wordindex):
-                digit = otherdata[j]
-                accum |= digit << start_bitindex
-                resdata[index] = accum
-                accum = digit >> antibitshift
-                j += 1
-        if end_bitindex:
-            mask = ~((r_uint(1) << end_bitindex) - 1)
-            last_digit = (resdata[end_wordindex] & mask) | accum
-            if start_bitindex < end_bitindex:
-                last_digit |= otherdata[j] << start_bitindex
-            resdata[end_wordindex] = last_digit
+        _data_update_subrange(resdata, n, m, _bitvector_words(other))
         return GenericBitVector(self.size(), resdata, normalize=False)
 
     def signed(self):
@@ -1023,6 +1303,8 @@ class GenericBitVector(BitVector):
         assert self.size() == other.size()
         if isinstance(other, GenericBitVector):
             return self.data == other.data
+        elif isinstance(other, TwoWordBitVector):
+            return other.eq(self)
         else:
             assert isinstance(other, SparseBitVector)
             for i in range(1, len(self.data)):
@@ -1060,7 +1342,7 @@ class GenericBitVector(BitVector):
         res = val = self.tobigint()
         for _ in range(i - 1):
             res = res.lshift(size).or_(val)
-        return GenericBitVector.from_bigint(size * i, res)
+        return from_bigint(size * i, res)
 
     def truncate(self, i):
         assert i >= 0
@@ -1070,6 +1352,8 @@ class GenericBitVector(BitVector):
             return SmallBitVector(i, self.data[0], normalize=True)
         if i == size:
             return self
+        if i <= 128:
+            return TwoWordBitVector(i, self.data[0], self.data[1], normalize=True)
         length = GenericBitVector._data_size(i)
         assert length >= 0
         return GenericBitVector(i, self.data[:length], normalize=True)
@@ -1082,6 +1366,8 @@ class GenericBitVector(BitVector):
             assert other.size() != 64 # caught by the case in BitVector.append
         res = self.zero_extend(self.size() + other.size()).lshift(other.size())
         assert not isinstance(res, SmallBitVector)
+        if isinstance(res, TwoWordBitVector):
+            return res.or_(other.zero_extend(res.size()))
         if isinstance(res, SparseBitVector):
             if isinstance(other, SmallBitVector):
                 res.val |= other.val
@@ -1093,6 +1379,10 @@ class GenericBitVector(BitVector):
         if isinstance(other, SparseBitVector):
             res.data[0] |= other.val
             return res
+        if isinstance(other, TwoWordBitVector):
+            res.data[0] |= other.low
+            res.data[1] |= other.high
+            return res
         assert isinstance(other, GenericBitVector)
         for index, otherdata in enumerate(other.data):
             res.data[index] |= otherdata
@@ -1101,10 +1391,94 @@ class GenericBitVector(BitVector):
     def append_64(self, ui):
         return GenericBitVector(self.size() + 64, [ui] + self.data)
 
+    def two_words(self):
+        data = self.data
+        assert len(data) <= 2
+        if len(data) == 1:
+            return data[0], r_uint(0)
+        return data[0], data[1]
+
     def pack(self):
         return (self.size(), r_uint(0xdeaddead), self.data)
 
 
+class BitVectorRegister(object):
+    """ Mutable storage for a register holding a bitvector wider than 128
+    bits (eg a vector register). Subranges of it (like the elements of a
+    vector register) are read and updated in place, without building a new
+    GenericBitVector of the full width for every element write.
+
+    Reading the whole register shares the list of words with the returned
+    (immutable) GenericBitVector, the next in-place update then first makes
+    a copy of the list. """
+    _immutable_fields_ = ['width']
+
+    def __init__(self, width, data=None):
+        assert width > 128
+        self.width = width
+        if data is None:
+            data = [r_uint(0)] * GenericBitVector._data_size(width)
+        self.data = data # list of r_uint, mutable
+        self.shared = False
+
+    def __repr__(self):
+        return "<BitVectorRegister %s %s>" % (self.width, GenericBitVector(self.width, self.data[:]))
+
+    def copy(self):
+        return BitVectorRegister(self.width, self.data[:])
+
+    def read(self):
+        self.shared = True
+        return GenericBitVector(self.width, self.data)
+
+    def write(self, bv):
+        assert bv.size() == self.width
+        if isinstance(bv, GenericBitVector):
+            self.data = bv.data
+            self.shared = True
+        else:
+            assert isinstance(bv, SparseBitVector)
+            self.data = bv._to_generic().data
+            self.shared = False
+
+    def _own_data(self):
+        if self.shared:
+            self.data = self.data[:]
+            self.shared = False
+        return self.data
+
+    def update_subrange(self, n, m, s):
+        width = n - m + 1
+        assert s.size() == width
+        data = self._own_data()
+        wordindex, bitindex = _data_indexes(m)
+        if width <= 64 and (n >> 6) == wordindex:
+            # the common case of an element that does not cross a word
+            # boundary
+            assert isinstance(s, SmallBitVector)
+            if width == 64:
+                data[wordindex] = s.val
+            else:
+                mask = ((r_uint(1) << width) - 1) << bitindex
+                data[wordindex] = (data[wordindex] & ~mask) | (s.val << bitindex)
+            return
+        _data_update_subrange(data, n, m, _bitvector_words(s))
+
+    def subrange_unwrapped_res(self, n, m):
+        return _data_subrange_unwrapped_res(self.data, n, m)
+
+    def subrange(self, n, m):
+        width = n - m + 1
+        if width <= 64:
+            return SmallBitVector(width, self.subrange_unwrapped_res(n, m))
+        if width == self.width:
+            return self.read()
+        resdata = _data_extract(self.data, m, width)
+        if width <= 128:
+            return TwoWordBitVector(width, resdata[0], resdata[1])
+        return GenericBitVector(width, resdata)
+
+
 class Integer(object):
     _attrs_ = []
 
@@ -1200,12 +1574,14 @@ class SmallInteger(Integer):
             return from_ruint(len, self.slice_unwrapped_res(len, start))
         if start >= 64:
             if self.val >= 0:
-                return SparseBitVector(len, r_uint(0))
+                return from_ruint(len, r_uint(0))
             n = -1
         else:
             n = self.val >> start
         if n > 0:
-            return SparseBitVector(len, r_uint(n))
+            return from_ruint(len, r_uint(n))
+        if len <= 128:
+            return TwoWordBitVector(len, r_uint(n), r_uint(n >> 63), True)
         jit.jit_debug("SmallInteger.slice large width negative case")
         return from_bigint(len, rbigint.fromint(n))
 
@@ -1825,6 +2201,72 @@ class BigInteger(Integer):
 def _data_indexes(pos):
     return pos >> 6, pos & 63
 
+def _bitvector_words(bv):
+    if isinstance(bv, SmallBitVector):
+        return [bv.val]
+    if isinstance(bv, SparseBitVector):
+        return bv._to_generic().data
+    if isinstance(bv, TwoWordBitVector):
+        return [bv.low, bv.high]
+    assert isinstance(bv, GenericBitVector)
+    return bv.data
+
+def _data_subrange_unwrapped_res(data, n, m):
+    width = n - m + 1
+    assert 0 < width <= 64
+    wordshift, bitshift = _data_indexes(m)
+    res = data[wordshift]
+    if bitshift:
+        res >>= bitshift
+        if wordshift + 1 < len(data):
+            antibitshift = 64 - bitshift
+            assert 0 <= antibitshift < 64
+            res |= (data[wordshift + 1] << antibitshift)
+    return ruint_mask(width, res)
+
+@jit.unroll_safe
+def _data_extract(data, m, width):
+    # the words of the width bits starting at bit m
+    wordshift, bitshift = _data_indexes(m)
+    lastindex, lastbits = _data_indexes(width)
+    resdata = [r_uint(0)] * (lastindex + bool(lastbits))
+    for index in range(len(resdata)):
+        word = data[wordshift + index] >> bitshift
+        if bitshift and wordshift + index + 1 < len(data):
+            word |= data[wordshift + index + 1] << (64 - bitshift)
+        resdata[index] = word
+    if lastbits:
+        resdata[lastindex] = ruint_mask(lastbits, resdata[lastindex])
+    return resdata
+
+@jit.unroll_safe
+def _data_update_subrange(data, n, m, otherdata):
+    # overwrite the bits n..m of data with the words in otherdata, in place
+    start_wordindex, start_bitindex = _data_indexes(m)
+    end_wordindex, end_bitindex = _data_indexes(n + 1) # exclusive
+    if not start_bitindex:
+        j = 0
+        for index in range(start_wordindex, end_wordindex):
+            data[index] = otherdata[j]
+            j += 1
+        accum = r_uint(0)
+    else:
+        accum = data[start_wordindex] & ((1 << start_bitindex) - 1)
+        antibitshift = 64 - start_bitindex
+        j = 0
+        for index in range(start_wordindex, end_wordindex):
+            digit = otherdata[j]
+            accum |= digit << start_bitindex
+            data[index] = accum
+            accum = digit >> antibitshift
+            j += 1
+    if end_bitindex:
+        mask = ~((r_uint(1) << end_bitindex) - 1)
+        last_digit = (data[end_wordindex] & mask) | accum
+        if start_bitindex < end_bitindex:
+            last_digit |= otherdata[j] << start_bitindex
+        data[end_wordindex] = last_digit
+
 def intsign(i):
     if i == 0:
         return 0
@@ -0,0 +1,119 @@
+""" Call profiles of guest runs, used to drive inlining and specialization
+decisions during code generation.
+
+A build generated with instrument_calls=True counts how often every function
+is called and how often every function calls every other function. Running
+it with --call-profile <file> writes the counts to a text file with lines of
+the form
+
+    f <function> <count>
+    c <caller> <callee> <count>
+
+Function names are the names of the Sail functions. The counts of all the
+specialized copies of a function are attributed to the function itself,
+because the specializations can differ from build to build. The instrumented
+build inlines nothing, so that every call is counted. Functions that don't
+appear in the profile at all were not counted, nothing is known about them. """
+
+import hashlib
+import os
+
+# a function is hot if it is called at least this fraction of the number of
+# calls of the most frequently called function
+HOT_FRACTION = 0.001
+
+# size limits for inlining functions with only one caller, and for inlining
+# hot functions with a few callers
+SINGLE_CALLER_MAX_OPS = 200
+HOT_MAX_CALLERS = 4
+HOT_MAX_BLOCKS = 8
+HOT_MAX_OPS = 60
+
+
+def base_name(name):
+    """ Return the name of the Sail function that the graph with the given
+    name was specialized from. """
+    return name.split("_specialized_", 1)[0]
+
+
+class CallProfile(object):
+    def __init__(self, function_counts=None, site_counts=None):
+        self.function_counts = function_counts if function_counts is not None else {}
+        self.site_counts = site_counts if site_counts is not None else {} # (caller, callee) -> count
+        self.callers = {} # callee -> {caller: count}
+        for (caller, callee), count in self.site_counts.iteritems():
+            self.callers.setdefault(callee, {})[caller] = count
+        maxcount = max(self.function_counts.values()) if self.function_counts else 0
+        self.hot_threshold = max(1, int(maxcount * HOT_FRACTION))
+
+    @staticmethod
+    def parse(s):
+        function_counts = {}
+        site_counts = {}
+        for lineno, line in enumerate(s.splitlines()):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            try:
+                if parts[0] == "f" and len(parts) == 3:
+                    name = base_name(parts[1])
+                    function_counts[name] = function_counts.get(name, 0) + int(parts[2])
+                    continue
+                if parts[0] == "c" and len(parts) == 4:
+                    key = base_name(parts[1]), base_name(parts[2])
+                    site_counts[key] = site_counts.get(key, 0) + int(parts[3])
+                    continue
+            except ValueError:
+                pass
+            raise ValueError("malformed line %s in call profile: %r" % (lineno + 1, line))
+        return CallProfile(function_counts, site_counts)
+
+    @staticmethod
+    def read(filename):
+        with open(filename) as f:
+            return CallProfile.parse(f.read())
+
+    def fingerprint(self):
+        """ A hash of the counts, for the cache key of the optimized graphs. """
+        h = hashlib.sha1()
+        h.update(repr(sorted(self.function_counts.iteritems())))
+        h.update(repr(sorted(self.site_counts.iteritems())))
+        return h.hexdigest()
+
+    def count(self, name):
+        return self.function_counts.get(base_name(name), 0)
+
+    def number_of_callers(self, name):
+        callers = self.callers.get(base_name(name), {})
+        return len([count for count in callers.itervalues() if count])
+
+    def is_cold(self, name):
+        """ True if the function was never called during the profiled run.
+        Functions that the profile doesn't know about are not cold. """
+        return self.function_counts.get(base_name(name), -1) == 0
+
+    def is_hot(self, name):
+        return self.count(name) >= self.hot_threshold
+
+    def should_inline(self, name, number_blocks, number_ops):
+        """ Return True, False or None (meaning: use the static heuristic). """
+        if not self.function_counts:
+            return None
+        if self.is_cold(name):
+            # never called, inlining would only make the code bigger
+            return False
+        callers = self.number_of_callers(name)
+        if callers == 1 and number_ops < SINGLE_CALLER_MAX_OPS:
+            return True
+        if (self.is_hot(name) and callers <= HOT_MAX_CALLERS and
+                number_blocks <= HOT_MAX_BLOCKS and number_ops < HOT_MAX_OPS):
+            return True
+        return None
+
+
+def profile_from_env(varname="PYDROFOIL_CALL_PROFILE"):
+    filename = os.getenv(varname)
+    if not filename:
+        return None
+    return CallProfile.read(filename)
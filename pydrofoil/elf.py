@@ -808,9 +808,9 @@ def elf_read_process_image(mem, file_obj):
         file_obj.seek(intmask(phdr.offset))
         content = file_obj.read(intmask(phdr.filesz))
         start_addr = r_uint(phdr.paddr)
-        for i in range(phdr.filesz):
-            mem.write(start_addr + i, 1, r_uint(0xff & ord(content[i])))
+        mem.write_bytes(start_addr, content)
         # fill rest with 0
-        for i in range(phdr.filesz, phdr.memsz):
-            mem.write(start_addr + i, 1, r_uint(0))
+        if phdr.memsz > phdr.filesz:
+            mem.zero_range(start_addr + r_uint(phdr.filesz),
+                           intmask(phdr.memsz - phdr.filesz))
     return ehdr.entry
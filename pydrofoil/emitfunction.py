@@ -7,11 +7,32 @@ from pydrofoil import ir, parse, types, supportcode
 def emit_function_code(graph, functionast, codegen):
     CodeEmitter(graph, functionast, codegen).emit()
 
+def unboxed_int_parameters(args):
+    """ The generated functions take their Int arguments unboxed, as the two
+    values that Integer.pack returns. A box is then only allocated by the
+    callee, where the JIT and the malloc removal can see all its uses.
+    Returns the parameter names and the lines that make the boxes at the
+    start of the function. """
+    params = []
+    lines = []
+    for arg in args:
+        if arg.resolved_type is types.Int():
+            params.append("ival_%s, idata_%s" % (arg.name, arg.name))
+            lines.append("%s = bitvector.Integer.unpack(ival_%s, idata_%s)" % (
+                arg.name, arg.name, arg.name))
+        else:
+            params.append(arg.name)
+    return params, lines
+
 class CodeEmitter(object):
     def __init__(self, graph, functionast, codegen):
         self.graph = graph
         self.functionast = functionast
         self.codegen = codegen
+        ir.compile_decision_trees(graph, codegen)
+        ir.use_register_storage(graph, codegen)
+        # print the graph after the rewrites above, so that the comment shows
+        # the graph that the code is emitted from
         self.graph_construction_code = ir.print_graph_construction(self.graph, codegen)
         remove_critical_edges(graph)
 
@@ -23,6 +44,8 @@ class CodeEmitter(object):
         for i, block in enumerate(blocks):
             block._pc = i
         self.blocks = blocks
+        self._unboxed_int_casts = self._find_unboxed_int_casts()
+        self._unboxed_int_temps = 0
 
         self.entrymap = graph.make_entrymap()
         self.emitted = set()
@@ -39,6 +62,8 @@ class CodeEmitter(object):
             pass
         for comment in self.graph_construction_code:
             codegen.emit("# " + comment)
+        if getattr(codegen, "instrument_calls", False):
+            codegen.emit_call_counter(self.graph.name)
         if len(self.blocks) == 1:
             self.emit_block_ops(self.blocks[0])
             return
@@ -51,6 +76,12 @@ class CodeEmitter(object):
             for index, op in enumerate(block.operations):
                 unique_suffix = "_%s_%s" % (block._pc, index)
                 self._get_print_varname(op, unique_suffix)
+        structure = structure_graph(self.graph, self.entrymap)
+        if structure is not None:
+            self.emit_structured(structure)
+            return
+        # irreducible or otherwise unstructured control flow, use a dispatch
+        # loop over the pcs of the blocks
         codegen.emit("pc = 0")
         with codegen.emit_indent("while 1:"):
             for block in self.blocks:
@@ -62,11 +93,59 @@ class CodeEmitter(object):
                     self.emit_block_ops(block)
 
     def emit_block_ops(self, block):
+        self.emit_operations(block)
+        getattr(self, "emit_next_" + block.next.__class__.__name__, self.emit_next_default)(block.next)
+
+    def emit_operations(self, block):
         self.emitted.add(block)
-        codegen = self.codegen
         for i, op in enumerate(block.operations):
             getattr(self, "emit_op_" + op.__class__.__name__, self.emit_op_default)(op)
-        getattr(self, "emit_next_" + block.next.__class__.__name__, self.emit_next_default)(block.next)
+
+    def emit_structured(self, items):
+        """ emit the nested if/while structure computed by structure_graph """
+        codegen = self.codegen
+        start = len(codegen.code)
+        for index, item in enumerate(items):
+            kind = item[0]
+            if kind == "block":
+                self.emit_operations(item[1])
+            elif kind == "next":
+                next = item[1].next
+                getattr(self, "emit_next_" + next.__class__.__name__, self.emit_next_default)(next)
+            elif kind == "if":
+                _, block, thenitems, elseitems = item
+                res = self._get_arg(block.next.booleanvalue)
+                self._emit_next_helper(block.next, "if %s:" % (res, ))
+                with codegen.emit_indent():
+                    self.emit_structured(thenitems)
+                if _only_empty_blocks(elseitems):
+                    # e.g. the empty block on a critical edge, no else needed
+                    for _, elseblock in elseitems:
+                        self.emit_operations(elseblock)
+                    continue
+                if _ends_with_jump(thenitems):
+                    # no else needed, keeps long if chains flat
+                    self.emit_structured(elseitems)
+                else:
+                    with codegen.emit_indent("else:"):
+                        self.emit_structured(elseitems)
+            elif kind == "loop":
+                with codegen.emit_indent("while 1:"):
+                    self.emit_structured(item[1])
+            elif kind == "break":
+                codegen.emit("break")
+            elif kind == "continue":
+                codegen.emit("continue")
+            else:
+                assert 0, "unreachable"
+        # the items can produce nothing but comments, e.g. for the empty
+        # blocks that remove_critical_edges inserts
+        for line in codegen.code[start:]:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                break
+        else:
+            codegen.emit("pass")
 
     # ________________________________________________
     # operations
@@ -146,6 +225,44 @@ class CodeEmitter(object):
     def _get_args(self, args):
         return ", ".join([self._get_arg(arg) for arg in args])
 
+    def _passes_ints_unboxed(self, op):
+        unboxed_int_graphs = getattr(self.codegen, "unboxed_int_graphs", None)
+        if not unboxed_int_graphs or type(op) is not ir.Operation:
+            return False
+        return self.codegen.all_graph_by_name.get(op.name) in unboxed_int_graphs
+
+    def _find_unboxed_int_casts(self):
+        # machine ints that are turned into an Int only to be passed to a
+        # function that takes it unboxed never need a box
+        res = set()
+        for block in self.blocks:
+            for op in block.operations:
+                if not self._passes_ints_unboxed(op):
+                    continue
+                for arg in op.args:
+                    if (type(arg) is ir.Operation and
+                            self.use_count_ops[arg] == 1 and
+                            self.codegen.builtin_names.get(arg.name, arg.name) == "int64_to_int"):
+                        res.add(arg)
+        return res
+
+    def _get_unboxed_int_args(self, args):
+        res = []
+        for arg in args:
+            if arg.resolved_type is not types.Int():
+                res.append(self._get_arg(arg))
+            elif arg in self._unboxed_int_casts:
+                res.append("%s, None" % (self._get_arg(arg.args[0]), ))
+            elif isinstance(arg, ir.IntConstant) and isinstance(arg.number, int):
+                res.append("%s, None" % (arg.number, ))
+            else:
+                index = self._unboxed_int_temps
+                self._unboxed_int_temps += 1
+                names = "ival_%s, idata_%s" % (index, index)
+                self.codegen.emit("%s = %s.pack()" % (names, self._get_arg(arg)))
+                res.append(names)
+        return ", ".join(res)
+
     def _op_helper(self, op, svalue):
         assert isinstance(svalue, str)
         use_count = self.use_count_ops[op]
@@ -166,6 +283,8 @@ class CodeEmitter(object):
         import pdb; pdb.set_trace()
 
     def emit_op_Operation(self, op):
+        if op in self._unboxed_int_casts:
+            return # passed unboxed to the call, see _get_unboxed_int_args
         codegen = self.codegen
         name = op.name
         argtyps = [arg.resolved_type for arg in op.args]
@@ -184,9 +303,14 @@ class CodeEmitter(object):
                 res = meth(self.codegen, [self._get_arg(arg) for arg in op.args], argtyps, restyp)
                 self._op_helper(op, res)
                 return
-        args = self._get_args(op.args)
+        if self._passes_ints_unboxed(op):
+            args = self._get_unboxed_int_args(op.args)
+        else:
+            args = self._get_args(op.args)
         opname = codegen.getname(name)
         info = codegen.getinfo(name)
+        if getattr(codegen, "instrument_calls", False) and op.name in codegen.all_graph_by_name:
+            codegen.emit_call_counter(self.graph.name, op.name)
         if isinstance(info.typ, types.Function) or opname.startswith("supportcode."):
             # pass machine, even to supportcode functions
             res = "%s(machine, %s)" % (opname, args)
@@ -342,6 +466,216 @@ class CodeEmitter(object):
     def emit_next_default(self, next):
         import pdb; pdb.set_trace()
 
+# ________________________________________________
+# structured control flow
+
+MAX_NESTING = 50 # stay well below the indentation limit of Python
+MAX_LOOP_NESTING = 10 # Python allows at most 20 statically nested blocks
+
+class Unstructured(Exception):
+    pass
+
+def _ends_with_jump(items):
+    if not items:
+        return False
+    kind = items[-1][0]
+    if kind in ("break", "continue"):
+        return True
+    if kind == "next":
+        return not isinstance(items[-1][1].next, ir.JustStop)
+    if kind == "if":
+        _, _, thenitems, elseitems = items[-1]
+        return _ends_with_jump(thenitems) and _ends_with_jump(elseitems)
+    return False
+
+def _only_empty_blocks(items):
+    for item in items:
+        if item[0] != "block":
+            return False
+        for op in item[1].operations:
+            if not isinstance(op, ir.Comment):
+                return False
+    return True
+
+def structure_graph(graph, entrymap=None):
+    """ Turn the control flow graph of graph into a tree of nested ifs and
+    while loops. Needs to run after remove_critical_edges and remove_phis.
+    Returns None if the graph can't be structured that way, e.g. because it
+    is irreducible or has loops with several exit blocks.
+
+    The result is a list of items:
+    - ("block", block): the operations of block
+    - ("next", block): block.next, which is a Return, Raise or JustStop
+    - ("if", block, thenitems, elseitems): block ends with a ConditionalGoto
+    - ("loop", bodyitems): a while 1 loop
+    - ("break", ) and ("continue", )
+    """
+    if entrymap is None:
+        entrymap = graph.make_entrymap()
+    try:
+        return _Structurer(graph, entrymap).structure()
+    except Unstructured:
+        return None
+
+class _Loop(object):
+    def __init__(self, header, body, exit, parent):
+        self.header = header
+        self.body = body
+        self.exit = exit
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 1
+
+class _Structurer(object):
+    def __init__(self, graph, entrymap):
+        self.graph = graph
+        self.entrymap = entrymap
+        self.idom = graph.immediate_dominators()
+        self.ipdom = self._immediate_postdominators()
+        self.loops = self._find_loops()
+        self.seen = set()
+
+    def _dominates(self, block, otherblock):
+        while 1:
+            if otherblock is block:
+                return True
+            parent = self.idom[otherblock]
+            if parent is otherblock:
+                return False
+            otherblock = parent
+
+    def _immediate_postdominators(self):
+        from pydrofoil import graphalgorithms
+        exit = ir.Block() # virtual exit, reached from all the returns
+        reversed_graph = {exit: []}
+        successors = {exit: []}
+        for block in self.entrymap:
+            next_blocks = block.next.next_blocks()
+            if not next_blocks:
+                reversed_graph[exit].append(block)
+                next_blocks = [exit]
+            successors[block] = next_blocks
+            reversed_graph[block] = self.entrymap[block]
+        ipdom = graphalgorithms.immediate_dominators(reversed_graph, exit, successors)
+        res = {}
+        for block, postdom in ipdom.iteritems():
+            if block is not exit:
+                res[block] = postdom if postdom is not exit else None
+        return res
+
+    def _find_loops(self):
+        backedges = defaultdict(list) # header -> sources of back edges
+        for block, preds in self.entrymap.iteritems():
+            for pred in preds:
+                if self._dominates(block, pred):
+                    backedges[block].append(pred)
+        self._check_reducible(backedges)
+        loops = {}
+        for header, sources in backedges.iteritems():
+            body = {header}
+            todo = list(sources)
+            while todo:
+                block = todo.pop()
+                if block in body:
+                    continue
+                body.add(block)
+                todo.extend(self.entrymap[block])
+            exits = set()
+            for block in body:
+                for nextblock in block.next.next_blocks():
+                    if nextblock not in body:
+                        exits.add(nextblock)
+            if len(exits) > 1:
+                raise Unstructured
+            loops[header] = (body, exits.pop() if exits else None)
+        return loops
+
+    def _check_reducible(self, backedges):
+        # the graph is reducible if removing the back edges makes it acyclic
+        isbackedge = {(source, header) for header, sources in backedges.iteritems()
+                      for source in sources}
+        indegree = {}
+        for block, preds in self.entrymap.iteritems():
+            indegree[block] = len({pred for pred in preds if (pred, block) not in isbackedge})
+        todo = [block for block, degree in indegree.iteritems() if degree == 0]
+        count = 0
+        while todo:
+            block = todo.pop()
+            count += 1
+            for nextblock in set(block.next.next_blocks()):
+                if (block, nextblock) in isbackedge:
+                    continue
+                indegree[nextblock] -= 1
+                if not indegree[nextblock]:
+                    todo.append(nextblock)
+        if count != len(indegree):
+            raise Unstructured
+
+    def structure(self):
+        return self._sequence(self.graph.startblock, None, None, 0)
+
+    def _sequence(self, block, follow, loop, nesting):
+        if nesting > MAX_NESTING:
+            raise Unstructured
+        items = []
+        while block is not follow:
+            if loop is not None:
+                if block is loop.header:
+                    items.append(("continue", ))
+                    return items
+                if block is loop.exit:
+                    items.append(("break", ))
+                    return items
+            if block in self.seen:
+                # a merge point that isn't the end of an if
+                raise Unstructured
+            if block in self.loops:
+                body, exit = self.loops[block]
+                newloop = _Loop(block, body, exit, loop)
+                if newloop.depth > MAX_LOOP_NESTING:
+                    raise Unstructured
+                items.append(("loop", self._loop_body(newloop, nesting + 1)))
+                if exit is None:
+                    return items
+                block = exit
+                continue
+            self.seen.add(block)
+            items.append(("block", block))
+            block = self._next(block, loop, items, nesting)
+            if block is None:
+                return items
+        return items
+
+    def _loop_body(self, loop, nesting):
+        header = loop.header
+        self.seen.add(header)
+        items = [("block", header)]
+        block = self._next(header, loop, items, nesting)
+        if block is not None:
+            items.extend(self._sequence(block, None, loop, nesting))
+        return items
+
+    def _next(self, block, loop, items, nesting):
+        """ add the items for block.next, return the block where the sequence
+        continues (or None) """
+        next = block.next
+        if isinstance(next, ir.Goto):
+            return next.target
+        if isinstance(next, ir.ConditionalGoto):
+            join = self.ipdom.get(block, None)
+            if loop is not None and join is not None and join not in loop.body:
+                # the arms leave the loop themselves
+                join = None
+            thenitems = self._sequence(next.truetarget, join, loop, nesting + 1)
+            elseitems = self._sequence(next.falsetarget, join, loop, nesting + 1)
+            items.append(("if", block, thenitems, elseitems))
+            return join
+        if isinstance(next, ir.JustStop):
+            # falling off the end is only fine in single-block graphs
+            raise Unstructured
+        items.append(("next", block))
+        return None
+
+
 def remove_critical_edges(graph):
     entrymap = graph.make_entrymap()
     for block in list(graph.iterblocks()):
@@ -358,6 +692,7 @@ def remove_critical_edges(graph):
             new_block.next = ir.Goto(next_block)
             block.next.replace_next(next_block, new_block)
             next_block.replace_prev(block, new_block)
+            graph.cfg_changed()
 
 def remove_phis(graph):
     all_newops = defaultdict(list)
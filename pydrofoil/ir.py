@@ -455,7 +455,9 @@ def extract_global_value(graph, name):
 # graph
 
 class Block(object):
-    _pc = -1 # assigned later in emitfunction
+    # the ir classes use __slots__ to keep the memory use of the graphs of
+    # big models down
+    __slots__ = ('operations', 'next', '_pc')
 
     def __init__(self, operations=None, next=None):
         if operations is None:
@@ -463,6 +465,7 @@ class Block(object):
         assert isinstance(operations, list)
         self.operations = operations
         self.next = next
+        self._pc = -1 # assigned later in emitfunction
         
     def __repr__(self):
         return "<Block operations=%s next=%s>" % (self.operations, self.next.__class__.__name__)
@@ -582,6 +585,7 @@ class Block(object):
         return str(id(self))
 
     def split(self, index, keep_op):
+        # changes the control flow, the caller must call graph.cfg_changed()
         startindex = index
         if not keep_op:
             startindex += 1
@@ -602,10 +606,28 @@ class Graph(object):
         self.args = args
         self.startblock = startblock
         self.has_loop = has_loop
+        self._analysis_cache = {}
+        self._analysis_cache_key = None
 
     def __repr__(self):
         return "<Graph %s %s>" % (self.name, self.args)
 
+    def cfg_changed(self):
+        """ Drop the cached control flow analyses (entry map, dominators,
+        topological order). Must be called by everything that changes
+        Block.next or the targets of a Goto/ConditionalGoto of the graph. """
+        self._analysis_cache = {}
+
+    def _cached_analysis(self, name, compute):
+        # the result is shared between all callers and must not be mutated
+        if self._analysis_cache_key is not self.startblock:
+            self._analysis_cache = {}
+            self._analysis_cache_key = self.startblock
+        res = self._analysis_cache.get(name, None)
+        if res is None:
+            res = self._analysis_cache[name] = compute(self)
+        return res
+
     def __getitem__(self, node): # compatibility with the networkx algos
         assert isinstance(node, Block)
         return node.next.next_blocks()
@@ -708,6 +730,16 @@ class Graph(object):
         return res
 
     def make_entrymap(self):
+        # returns a fresh copy, the callers are free to change it
+        entry = defaultdict(list)
+        for block, prevblocks in self._entrymap().iteritems():
+            entry[block] = prevblocks[:]
+        return entry
+
+    def _entrymap(self):
+        return self._cached_analysis("entrymap", Graph._compute_entrymap)
+
+    def _compute_entrymap(self):
         todo = [self.startblock]
         seen = set()
         entry = defaultdict(list)
@@ -719,20 +751,44 @@ class Graph(object):
                 if next not in seen:
                     todo.append(next)
         entry[self.startblock] = []
-        return entry
+        return dict(entry)
 
     def idoms_and_entrymap(self, startblock=None):
-        from pydrofoil import graphalgorithms
-        startblock = self.startblock
-        entrymap = self.make_entrymap()
-        return graphalgorithms.immediate_dominators(self, startblock, entrymap), entrymap
+        return self.immediate_dominators(), self.make_entrymap()
 
     def immediate_dominators(self):
-        return self.idoms_and_entrymap()[0]
+        return dict(self._immediate_dominators())
+
+    def _immediate_dominators(self):
+        return self._cached_analysis("idom", Graph._compute_immediate_dominators)
+
+    def _compute_immediate_dominators(self):
+        from pydrofoil import graphalgorithms
+        return graphalgorithms.immediate_dominators(self, self.startblock, self._entrymap())
+
+    def _dominators(self):
+        return self._cached_analysis("dominators", Graph._compute_dominators)
+
+    def _compute_dominators(self):
+        # every block is dominated by itself and by the dominators of its
+        # immediate dominator, which is visited earlier breadth first
+        idom = self._immediate_dominators()
+        dominators = {}
+        for block in self.iterblocks_breadth_first():
+            if block is self.startblock:
+                dominators[block] = {block}
+            else:
+                dominators[block] = dominators[idom[block]].union([block])
+        return dominators
 
     def check(self):
         # minimal consistency check, will add things later
-        idom, entrymap = self.idoms_and_entrymap()
+        if (self._analysis_cache_key is self.startblock and
+                "entrymap" in self._analysis_cache):
+            assert self._analysis_cache["entrymap"] == self._compute_entrymap(), \
+                "stale cached analyses, a missing cfg_changed call"
+        idom = self._immediate_dominators()
+        entrymap = self._entrymap()
         defined_vars_per_block = {} # block -> set of values
         # first compute vars defined directly in all blocks
         #all_phi_prevblocks_ids = {}
@@ -750,8 +806,10 @@ class Graph(object):
                 for prevblock in op.prevblocks:
                     assert prevblock in entrymap
                     assert prevblock in entry
-        # check that all the used values are defined somewhere
-        for block in entrymap:
+        # check that all the used values are defined somewhere. the immediate
+        # dominator of a block is visited earlier breadth first, so its set
+        # is complete by the time it is used
+        for block in self.iterblocks_breadth_first():
             defined_vars = defined_vars_per_block[block]
             if block is not self.startblock:
                 defined_vars.update(defined_vars_per_block[idom[block]])
@@ -768,13 +826,18 @@ class Graph(object):
             for value in block.next.getargs():
                 assert value in defined_vars or isinstance(value, Constant)
 
-    def replace_ops(self, replacements):
+    def replace_ops(self, replacements, changed_blocks=None):
         res = False
         for block in self.iterblocks():
+            blockres = False
             for op in block.operations:
                 assert op not in replacements # must have been removed already
-                res = op.replace_ops(replacements) or res
-            res = block.next.replace_ops(replacements) or res
+                blockres = op.replace_ops(replacements) or blockres
+            blockres = block.next.replace_ops(replacements) or blockres
+            if blockres:
+                res = True
+                if changed_blocks is not None:
+                    changed_blocks.add(block)
         return res
 
     def replace_op(self, oldop, newop):
@@ -783,6 +846,8 @@ class Graph(object):
 # values
 
 class Value(object):
+    __slots__ = ()
+
     def _repr(self, print_varnames):
         return repr(self)
 
@@ -804,6 +869,8 @@ class Value(object):
         return "<%s %x>" % (self.__class__.__name__, id(self))
 
 class Argument(Value):
+    __slots__ = ('name', 'resolved_type')
+
     def __init__(self, name, resolved_type):
         self.resolved_type = resolved_type
         self.name = name
@@ -815,11 +882,16 @@ class Argument(Value):
         return self.name
 
 class Operation(Value):
+    # the subclasses must not add slots, Block.emit and copy_operations
+    # assign __class__, which needs the same layout
+    __slots__ = ('name', 'args', 'resolved_type', 'sourcepos', 'varname_hint')
     can_have_side_effects = True
 
     def __init__(self, name, args, resolved_type, sourcepos=None, varname_hint=None):
         for arg in args:
             assert isinstance(arg, Value)
+        if type(name) is str:
+            name = intern(name) # there are a lot of ops with the same name
         self.name = name
         self.args = args
         self.resolved_type = resolved_type
@@ -846,6 +918,7 @@ class Operation(Value):
         return res
 
 class Cast(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __init__(self, arg, resolved_type, sourcepos=None, varname_hint=None):
@@ -855,6 +928,7 @@ class Cast(Operation):
         return "Cast(%r, %r, %r)" % (self.args[0], self.resolved_type, self.sourcepos)
 
 class Allocate(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __init__(self, resolved_type, sourcepos):
@@ -864,18 +938,21 @@ class Allocate(Operation):
         return "Allocate(%r, %r)" % (self.resolved_type, self.sourcepos, )
 
 class StructConstruction(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __repr__(self):
         return "StructConstruction(%r, %r, %r)" % (self.name, self.args, self.resolved_type)
 
 class FieldAccess(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __repr__(self):
         return "FieldAccess(%r, %r, %r)" % (self.name, self.args, self.resolved_type)
 
 class FieldWrite(Operation):
+    __slots__ = ()
     def __init__(self, name, args, resolved_type=None, sourcepos=None, varname_hint=None):
         if resolved_type is None:
             resolved_type = types.Unit()
@@ -885,16 +962,19 @@ class FieldWrite(Operation):
         return "FieldWrite(%r, %r)" % (self.name, self.args)
 
 class UnionVariantCheck(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __repr__(self):
         return "UnionVariantCheck(%r, %r, %r)" % (self.name, self.args, self.resolved_type)
 
 class UnionCast(Operation):
+    __slots__ = ()
     def __repr__(self):
         return "UnionCast(%r, %r, %r)" % (self.name, self.args, self.resolved_type)
 
 class GlobalRead(Operation):
+    __slots__ = ()
     can_have_side_effects = False
     def __init__(self, name, resolved_type):
         Operation.__init__(self, name, [], resolved_type, None)
@@ -903,10 +983,12 @@ class GlobalRead(Operation):
         return "GlobalRead(%r, %r)" % (self.name, self.resolved_type)
 
 class GlobalWrite(Operation):
+    __slots__ = ()
     def __repr__(self):
         return "GlobalWrite(%r, %r, %r)" % (self.name, self.args, self.resolved_type)
 
 class RefAssignment(Operation):
+    __slots__ = ()
     def __init__(self, args, resolved_type, sourcepos):
         Operation.__init__(self, "$ref-assign", args, resolved_type, sourcepos)
 
@@ -914,6 +996,7 @@ class RefAssignment(Operation):
         return "RefAssignment(%r, %r, %r)" % (self.args, self.resolved_type, self.sourcepos, )
 
 class RefOf(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __init__(self, args, resolved_type, sourcepos=None):
@@ -923,6 +1006,7 @@ class RefOf(Operation):
         return "RefOf(%r, %r, %r)" % (self.args, self.resolved_type, self.sourcepos, )
 
 class VectorInit(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __init__(self, size, resolved_type, sourcepos):
@@ -932,6 +1016,7 @@ class VectorInit(Operation):
         return "VectorInit(%r, %r, %r)" % (self.args[0], self.resolved_type, self.sourcepos, )
 
 class VectorUpdate(Operation):
+    __slots__ = ()
     can_have_side_effects = False
 
     def __init__(self, args, resolved_type, sourcepos):
@@ -941,6 +1026,7 @@ class VectorUpdate(Operation):
         return "VectorUpdate(%r, %r, %r)" % (self.args, self.resolved_type, self.sourcepos, )
 
 class NonSSAAssignment(Operation):
+    __slots__ = ()
     def __init__(self, lhs, rhs):
         Operation.__init__(self, "non_ssa_assign", [lhs, rhs], types.Unit(), None)
 
@@ -948,10 +1034,12 @@ class NonSSAAssignment(Operation):
         return "NonSSAAssignment(%r, %r)" % (self.args[0], self.args[1])
 
 class Comment(Operation):
+    __slots__ = ()
     def __init__(self, comment):
         Operation.__init__(self, comment, [], types.Unit())
 
 class Phi(Value):
+    __slots__ = ('prevblocks', 'prevvalues', 'resolved_type')
     can_have_side_effects = False
 
     def __init__(self, prevblocks, prevvalues, resolved_type):
@@ -979,9 +1067,11 @@ class Phi(Value):
         return res
 
 class Constant(Value):
-    pass
+    __slots__ = ()
 
 class BooleanConstant(Constant):
+    __slots__ = ('value', 'resolved_type')
+
     def __init__(self, value):
         assert isinstance(value, bool)
         self.value = value
@@ -1005,6 +1095,7 @@ BooleanConstant.FALSE = BooleanConstant(False)
 
 
 class MachineIntConstant(Constant):
+    __slots__ = ('number', )
     resolved_type = types.MachineInt()
     def __init__(self, number):
         assert isinstance(number, int)
@@ -1021,6 +1112,7 @@ class MachineIntConstant(Constant):
 
 
 class IntConstant(Constant):
+    __slots__ = ('number', )
     resolved_type = types.Int()
     def __init__(self, number):
         self.number = number
@@ -1036,6 +1128,8 @@ class IntConstant(Constant):
 
 
 class SmallBitVectorConstant(Constant):
+    __slots__ = ('value', 'resolved_type')
+
     def __init__(self, value, resolved_type):
         if isinstance(value, int):
             value = r_uint(value)
@@ -1065,6 +1159,7 @@ class SmallBitVectorConstant(Constant):
 
 
 class GenericBitVectorConstant(Constant):
+    __slots__ = ('value', )
     resolved_type = types.GenericBitVector()
 
     def __init__(self, value):
@@ -1087,6 +1182,8 @@ class GenericBitVectorConstant(Constant):
         #import pdb;pdb.set_trace()
         if isinstance(self.value, (bitvector.SparseBitVector, bitvector.SmallBitVector)):
             return "bitvector.from_ruint(%s, r_uint(%s))" % (size, self.value.val)
+        if isinstance(self.value, bitvector.TwoWordBitVector) and not self.value.high:
+            return "bitvector.from_ruint(%s, r_uint(%s))" % (size, self.value.low)
         return "bitvector.from_bigint(%s, rbigint.fromlong(%s))" % (size, value)
 
     def __repr__(self):
@@ -1094,6 +1191,7 @@ class GenericBitVectorConstant(Constant):
 
 
 class DefaultValue(Constant):
+    __slots__ = ('resolved_type', )
 
     def __init__(self, resolved_type):
         self.resolved_type = resolved_type
@@ -1106,6 +1204,8 @@ class DefaultValue(Constant):
 
 
 class EnumConstant(Constant):
+    __slots__ = ('variant', 'resolved_type')
+
     def __init__(self, variant, resolved_type):
         self.variant = variant
         self.resolved_type = resolved_type
@@ -1118,6 +1218,7 @@ class EnumConstant(Constant):
 
 
 class StringConstant(Constant):
+    __slots__ = ('string', )
     resolved_type = types.String()
 
     def __init__(self, string):
@@ -1131,6 +1232,7 @@ class StringConstant(Constant):
 
 
 class UnitConstant(Constant):
+    __slots__ = ()
     resolved_type = types.Unit()
     def __repr__(self):
         return "UnitConstant.UNIT"
@@ -1140,6 +1242,8 @@ UnitConstant.UNIT = UnitConstant()
 # next
 
 class Next(object):
+    __slots__ = ('sourcepos', )
+
     def __init__(self, sourcepos):
         self.sourcepos = sourcepos
 
@@ -1159,6 +1263,8 @@ class Next(object):
         return self.__class__.__name__
 
 class Return(Next):
+    __slots__ = ('value', )
+
     def __init__(self, value, sourcepos=None):
         assert isinstance(value, Value) or value is None
         self.value = value
@@ -1177,6 +1283,8 @@ class Return(Next):
         return "Return(%s, %r)" % (None if self.value is None else self.value._repr(print_varnames), self.sourcepos)
 
 class Raise(Next):
+    __slots__ = ('kind', )
+
     def __init__(self, kind, sourcepos=None):
         self.kind = kind
         self.sourcepos = sourcepos
@@ -1194,6 +1302,8 @@ class Raise(Next):
         return "Raise(%s, %r)" % (self.kind, self.sourcepos)
 
 class JustStop(Next):
+    __slots__ = ()
+
     def __init__(self):
         self.sourcepos = None
 
@@ -1202,6 +1312,8 @@ class JustStop(Next):
 
 
 class Goto(Next):
+    __slots__ = ('target', )
+
     def __init__(self, target, sourcepos=None):
         assert isinstance(target, Block)
         self.target = target
@@ -1221,6 +1333,8 @@ class Goto(Next):
 
 
 class ConditionalGoto(Next):
+    __slots__ = ('booleanvalue', 'truetarget', 'falsetarget')
+
     def __init__(self, booleanvalue, truetarget, falsetarget, sourcepos=None):
         assert isinstance(truetarget, Block)
         assert isinstance(falsetarget, Block)
@@ -1322,12 +1436,123 @@ class GraphPage(BaseGraphPage):
             self.links[arg.name] = str(arg.resolved_type)
 
 
+# serialization
+
+# graphs are serialized into a flat structure of lists and tuples, to be able
+# to pickle huge graphs without recursing along the chains of blocks. values
+# are referred to by their index in the list of arguments + operations,
+# constants are stored directly
+
+def serialize_graph(graph):
+    blocks = list(graph.iterblocks())
+    blockindex = {block: index for index, block in enumerate(blocks)}
+    values = list(graph.args)
+    for block in blocks:
+        values.extend(block.operations)
+    valueindex = {value: index for index, value in enumerate(values)}
+
+    def ser(value):
+        if not isinstance(value, Value) or isinstance(value, Constant):
+            return value # None, constants, Raise kinds that are strings
+        return valueindex[value]
+
+    blockdata = []
+    for block in blocks:
+        opsdata = []
+        for op in block.operations:
+            if isinstance(op, Phi):
+                opsdata.append((Phi, [blockindex[prevblock] for prevblock in op.prevblocks],
+                                [ser(value) for value in op.prevvalues], op.resolved_type))
+            else:
+                opsdata.append((type(op), op.name, [ser(arg) for arg in op.args],
+                                op.resolved_type, op.sourcepos, op.varname_hint))
+        next = block.next
+        if isinstance(next, Goto):
+            nextdata = (Goto, blockindex[next.target], next.sourcepos)
+        elif isinstance(next, ConditionalGoto):
+            nextdata = (ConditionalGoto, ser(next.booleanvalue), blockindex[next.truetarget],
+                        blockindex[next.falsetarget], next.sourcepos)
+        elif isinstance(next, Return):
+            nextdata = (Return, ser(next.value), next.sourcepos)
+        elif isinstance(next, Raise):
+            nextdata = (Raise, ser(next.kind), next.sourcepos)
+        else:
+            assert isinstance(next, JustStop)
+            nextdata = (JustStop, )
+        blockdata.append((opsdata, nextdata))
+    argdata = [(arg.name, arg.resolved_type) for arg in graph.args]
+    return graph.name, argdata, blockdata, graph.has_loop
+
+def deserialize_graph(data):
+    name, argdata, blockdata, has_loop = data
+    args = [Argument(argname, typ) for argname, typ in argdata]
+    values = args[:]
+    blocks = [Block() for _ in blockdata]
+    # first create all the operations, then fill in the arguments, phis can
+    # refer to later operations
+    for (opsdata, _), block in zip(blockdata, blocks):
+        for opdata in opsdata:
+            if opdata[0] is Phi:
+                op = Phi([blocks[index] for index in opdata[1]], [], opdata[3])
+            else:
+                cls, opname, _, resolved_type, sourcepos, varname_hint = opdata
+                op = Operation(opname, [], resolved_type, sourcepos, varname_hint)
+                op.__class__ = cls
+            block.operations.append(op)
+            values.append(op)
+
+    def deser(ref):
+        if isinstance(ref, int):
+            return values[ref]
+        return ref
+
+    for (opsdata, nextdata), block in zip(blockdata, blocks):
+        for opdata, op in zip(opsdata, block.operations):
+            if isinstance(op, Phi):
+                op.prevvalues = [deser(ref) for ref in opdata[2]]
+            else:
+                op.args = [deser(ref) for ref in opdata[2]]
+        cls = nextdata[0]
+        if cls is Goto:
+            block.next = Goto(blocks[nextdata[1]], nextdata[2])
+        elif cls is ConditionalGoto:
+            block.next = ConditionalGoto(deser(nextdata[1]), blocks[nextdata[2]],
+                                         blocks[nextdata[3]], nextdata[4])
+        elif cls is Return:
+            block.next = Return(deser(nextdata[1]), nextdata[2])
+        elif cls is Raise:
+            block.next = Raise(deser(nextdata[1]), nextdata[2])
+        else:
+            assert cls is JustStop
+            block.next = JustStop()
+    return Graph(name, args, blocks[0], has_loop)
+
+
 # some simple graph simplifications
 
 
 TIMINGS = defaultdict(float)
 COUNTS = defaultdict(int)
 STACK_START_TIMES = []
+# if True, repeat also sums up the number of operations of the graphs before
+# and after every pass. costs some time, used by pydrofoil.benchmark
+MEASURE_GRAPH_SIZES = False
+OPS_BEFORE = defaultdict(int)
+OPS_AFTER = defaultdict(int)
+
+def reset_stats():
+    TIMINGS.clear()
+    COUNTS.clear()
+    OPS_BEFORE.clear()
+    OPS_AFTER.clear()
+
+def graph_size(graph):
+    """ return the number of blocks and operations of graph """
+    number_blocks = number_ops = 0
+    for block in graph.iterblocks():
+        number_blocks += 1
+        number_ops += len(block.operations)
+    return number_blocks, number_ops
 
 def print_stats():
     print "OPTIMIZATION STATISTICS"
@@ -1348,6 +1573,8 @@ DEBUG_REPEAT = False
 
 def repeat(func):
     def repeated(graph, codegen, *args, **kwargs):
+        if MEASURE_GRAPH_SIZES:
+            OPS_BEFORE[func.func_name] += graph_size(graph)[1]
         t1_proper = time.time()
         STACK_START_TIMES.append(t1_proper)
         ever_changed = False
@@ -1400,12 +1627,36 @@ def repeat(func):
         COUNTS[func.func_name] += i + 1
         if STACK_START_TIMES: # parent optimization overcounts, so add t2 - t1_proper to start time
             STACK_START_TIMES[-1] += t2 - t1_proper
+        if MEASURE_GRAPH_SIZES:
+            OPS_AFTER[func.func_name] += graph_size(graph)[1]
         if ever_changed:
             ever_changed = func.func_name
         return ever_changed
     return repeated
 repeat.debug_list = None
 
+def timed(func):
+    """ record the time and graph sizes of a pass that runs only once, like
+    repeat does for the passes that run until nothing changes """
+    def timed_func(graph, codegen, *args, **kwargs):
+        if MEASURE_GRAPH_SIZES:
+            OPS_BEFORE[func.func_name] += graph_size(graph)[1]
+        t1_proper = time.time()
+        STACK_START_TIMES.append(t1_proper)
+        try:
+            return func(graph, codegen, *args, **kwargs)
+        finally:
+            t2 = time.time()
+            t1 = STACK_START_TIMES.pop()
+            assert t2 - t1 >= 0
+            TIMINGS[func.func_name] += t2 - t1
+            COUNTS[func.func_name] += 1
+            if STACK_START_TIMES: # see repeat
+                STACK_START_TIMES[-1] += t2 - t1_proper
+            if MEASURE_GRAPH_SIZES:
+                OPS_AFTER[func.func_name] += graph_size(graph)[1]
+    return timed_func
+
 def light_simplify(graph, codegen):
     # in particular, don't specialize
     codegen.print_debug_msg("simplifying ssa")
@@ -1431,7 +1682,7 @@ def optimize(graph, codegen):
     return res
 
 def _bare_optimize(graph, codegen):
-    from pydrofoil.absinterp import optimize_with_range_info
+    from pydrofoil.absinterp import optimize_with_range_info, optimize_with_known_bits
     res = False
     res = propagate_equality(graph, codegen) or res
     res = join_blocks(graph, codegen) or res
@@ -1443,12 +1694,16 @@ def _bare_optimize(graph, codegen):
     res = remove_empty_blocks(graph, codegen) or res
     res = swap_not(graph, codegen) or res
     res = optimize_with_range_info(graph, codegen) or res
+    res = optimize_with_known_bits(graph, codegen) or res
     res = cse_global_reads(graph, codegen) or res
     res = remove_superfluous_union_checks(graph, codegen) or res
     res = localopt(graph, codegen, do_double_casts=True) or res
     res = remove_if_phi_constant(graph, codegen) or res
     res = remove_superfluous_enum_cases(graph, codegen) or res
     res = remove_useless_switch(graph, codegen) or res
+    res = sccp(graph, codegen) or res
+    res = gvn(graph, codegen) or res
+    res = licm(graph, codegen) or res
     partial_allocation_removal(graph, codegen)
     return res
 
@@ -1456,7 +1711,22 @@ _optimize = repeat(_bare_optimize)
 
 @repeat
 def localopt(graph, codegen, do_double_casts=True):
-    return LocalOptimizer(graph, codegen, do_double_casts).optimize()
+    optimizer = LocalOptimizer(graph, codegen, do_double_casts)
+    res = optimizer.optimize()
+    # instead of optimizing the whole graph again, only revisit the blocks
+    # that changed or that use replaced values, until there are none left. the
+    # next iteration of @repeat optimizes the full graph again, so nothing is
+    # missed
+    for i in range(1000):
+        blocks = optimizer.changed_blocks
+        if not blocks:
+            break
+        optimizer = LocalOptimizer(graph, codegen, do_double_casts)
+        if not optimizer.optimize(blocks):
+            break
+    else:
+        codegen.print_debug_msg("LIMIT REACHED!", graph, "localopt")
+    return res
 
 @repeat
 def remove_dead(graph, codegen):
@@ -1508,6 +1778,8 @@ def remove_empty_blocks(graph, codegen):
             block.next.replace_next(nextblock, nextblock.next.target)
             nextblock.next.target.replace_prev(nextblock, block)
             changed = True
+    if changed:
+        graph.cfg_changed()
     return changed
 
 @repeat
@@ -1531,6 +1803,8 @@ def join_blocks(graph, codegen):
             block.next = nextblock.next
             for nextnextblock in block.next.next_blocks():
                 nextnextblock.replace_prev(nextblock, block)
+    if changed:
+        graph.cfg_changed()
     return changed
 
 @repeat
@@ -1546,6 +1820,7 @@ def swap_not(graph, codegen):
         cond.truetarget, cond.falsetarget = cond.falsetarget, cond.truetarget
         changed = True
     if changed:
+        graph.cfg_changed()
         remove_dead(graph, codegen)
     return changed
 
@@ -1581,6 +1856,7 @@ def remove_if_true_false(graph, codegen):
         block.next = Goto(takenblock)
         changed = True
     if changed:
+        graph.cfg_changed()
         # need to remove Phi arguments
         _remove_unreachable_phi_prevvalues(graph)
     return changed
@@ -1647,12 +1923,227 @@ def remove_if_phi_constant(graph, codegen):
             op.prevvalues = prevvalues
             op.prevblocks = prevblocks
     if res:
+        graph.cfg_changed()
         _remove_unreachable_phi_prevvalues(graph)
         simplify_phis(graph, codegen)
         join_blocks(graph, codegen)
     return res
 
 
+# sparse conditional constant propagation
+
+_OVERDEFINED = "overdefined"
+
+def _sccp_meet(oldvalue, value):
+    if oldvalue is None:
+        return value
+    if oldvalue is _OVERDEFINED or value is _OVERDEFINED:
+        return _OVERDEFINED
+    if oldvalue.comparison_key() == value.comparison_key():
+        return oldvalue
+    return _OVERDEFINED
+
+def _sccp_evaluate(op, args, codegen):
+    # args are the lattice values of the arguments, all known. a few
+    # operations are folded here directly, the pure ones from supportcode are
+    # folded with the same generic constant folding that the LocalOptimizer
+    # uses
+    name = codegen.builtin_names.get(op.name, op.name).lstrip("$@")
+    if any(arg is _OVERDEFINED for arg in args):
+        return _OVERDEFINED
+    if name in ("not", "not_"):
+        arg0, = args
+        if isinstance(arg0, BooleanConstant):
+            return BooleanConstant.frombool(not arg0.value)
+        return _OVERDEFINED
+    elif name in ("eq", "eq_bool"):
+        arg0, arg1 = args
+        if isinstance(arg0, MachineIntConstant) and isinstance(arg1, MachineIntConstant):
+            return BooleanConstant.frombool(arg0.number == arg1.number)
+        if isinstance(arg0, EnumConstant) and isinstance(arg1, EnumConstant):
+            return BooleanConstant.frombool(arg0.variant == arg1.variant)
+        if isinstance(arg0, BooleanConstant) and isinstance(arg1, BooleanConstant):
+            return BooleanConstant.frombool(arg0.value == arg1.value)
+        return _OVERDEFINED
+    if name not in supportcode.purefunctions or "undefined" in name:
+        return _OVERDEFINED
+    func = getattr(supportcode, name, None)
+    if not func or op.resolved_type is types.Real():
+        return _OVERDEFINED
+    res = _try_fold(name, func, args, op.resolved_type, op)
+    if res is None:
+        return _OVERDEFINED
+    return res
+
+def _try_fold(name, func, args, resolved_type, op):
+    runtimeargs = []
+    for arg in args:
+        if isinstance(arg, IntConstant):
+            if not isinstance(arg.number, int):
+                return None # XXX can be improved
+            runtimeargs.append(bitvector.Integer.fromint(arg.number))
+        elif isinstance(arg, MachineIntConstant):
+            runtimeargs.append(arg.number)
+        elif isinstance(arg, SmallBitVectorConstant):
+            runtimeargs.append(arg.value)
+        elif isinstance(arg, GenericBitVectorConstant):
+            runtimeargs.append(arg.value)
+        elif arg.resolved_type is types.Real():
+            return # later
+        elif arg.resolved_type is types.Unit():
+            runtimeargs.append(())
+        elif arg.resolved_type is types.String():
+            runtimeargs.append(arg.string)
+        else:
+            return None
+    try:
+        res = func("constfolding", *runtimeargs)
+    except (Exception, AssertionError) as e:
+        print "generict const-folding failed", name, op, "with error", e, "arguments", args
+        return None
+    if resolved_type is types.MachineInt():
+        assert isinstance(res, int)
+        return MachineIntConstant(res)
+    if resolved_type is types.Int():
+        return IntConstant(int(res.tolong()))
+    if isinstance(resolved_type, types.SmallFixedBitVector):
+        assert isinstance(res, r_uint)
+        return SmallBitVectorConstant.from_ruint(resolved_type.width, res)
+    if resolved_type is types.Bool():
+        assert isinstance(res, bool)
+        return BooleanConstant.frombool(res)
+    if resolved_type is types.String():
+        assert isinstance(res, str)
+        return StringConstant(res)
+    if resolved_type is types.GenericBitVector():
+        assert isinstance(res, bitvector.BitVector)
+        return GenericBitVectorConstant(res)
+    # XXX other types? import pdb;pdb.set_trace()
+
+@timed
+def sccp(graph, codegen):
+    """ Sparse conditional constant propagation (Wegman & Zadeck). Computes
+    the values that are constant on all the paths that can execute together
+    with the blocks that can be reached at all, which finds more constants in
+    phis and more dead branches than doing the two separately. """
+    users = defaultdict(list) # value -> [(op or None for the next, block)]
+    for block in graph.iterblocks():
+        for op in block.operations:
+            for arg in op.getargs():
+                users[arg].append((op, block))
+        for arg in block.next.getargs():
+            users[arg].append((None, block))
+
+    values = {} # value -> constant or _OVERDEFINED, missing means unknown
+    for arg in graph.args:
+        values[arg] = _OVERDEFINED
+
+    def getvalue(value):
+        if isinstance(value, Constant):
+            return value
+        return values.get(value, None)
+
+    executable_blocks = set()
+    executable_edges = set()
+    blocktodo = [graph.startblock]
+    optodo = [] # (op or None for the next, block)
+
+    def mark_edge(prevblock, block):
+        if (prevblock, block) in executable_edges:
+            return
+        executable_edges.add((prevblock, block))
+        if block not in executable_blocks:
+            blocktodo.append(block)
+        else:
+            for op in block.operations:
+                if isinstance(op, Phi):
+                    optodo.append((op, block))
+
+    while blocktodo or optodo:
+        if blocktodo:
+            block = blocktodo.pop()
+            if block in executable_blocks:
+                continue
+            executable_blocks.add(block)
+            optodo.extend((op, block) for op in block.operations)
+            optodo.append((None, block))
+            continue
+        op, block = optodo.pop()
+        if op is None:
+            next = block.next
+            if isinstance(next, Goto):
+                mark_edge(block, next.target)
+            elif isinstance(next, ConditionalGoto):
+                cond = getvalue(next.booleanvalue)
+                if cond is None:
+                    continue
+                if cond is _OVERDEFINED or cond.value:
+                    mark_edge(block, next.truetarget)
+                if cond is _OVERDEFINED or not cond.value:
+                    mark_edge(block, next.falsetarget)
+            continue
+        if isinstance(op, Phi):
+            newvalue = None
+            for prevblock, prevvalue in zip(op.prevblocks, op.prevvalues):
+                if (prevblock, block) in executable_edges:
+                    value = getvalue(prevvalue)
+                    if value is not None:
+                        newvalue = _sccp_meet(newvalue, value)
+            if newvalue is None:
+                continue
+        elif type(op) is Operation:
+            args = [getvalue(arg) for arg in op.args]
+            if None in args:
+                continue
+            newvalue = _sccp_evaluate(op, args, codegen)
+        else:
+            newvalue = _OVERDEFINED
+        oldvalue = values.get(op, None)
+        if oldvalue is not None:
+            newvalue = _sccp_meet(oldvalue, newvalue)
+            if newvalue is oldvalue:
+                continue
+        values[op] = newvalue
+        for user in users[op]:
+            if user[1] in executable_blocks:
+                optodo.append(user)
+
+    # rewrite the graph
+    replacements = {}
+    changed = False
+    for block in executable_blocks:
+        if isinstance(block.next, ConditionalGoto):
+            if getvalue(block.next.booleanvalue) is None:
+                return False # can't happen for valid graphs, be safe
+    for block in executable_blocks:
+        newoperations = []
+        for op in block.operations:
+            value = values.get(op, None)
+            if isinstance(value, Constant):
+                replacements[op] = value
+            else:
+                newoperations.append(op)
+        if len(newoperations) != len(block.operations):
+            block.operations = newoperations
+        next = block.next
+        if isinstance(next, ConditionalGoto):
+            cond = getvalue(next.booleanvalue)
+            if isinstance(cond, BooleanConstant):
+                if cond.value:
+                    takenblock = next.truetarget
+                else:
+                    takenblock = next.falsetarget
+                block.next = Goto(takenblock)
+                graph.cfg_changed()
+                changed = True
+    if replacements:
+        graph.replace_ops(replacements)
+        changed = True
+    if changed:
+        _remove_unreachable_phi_prevvalues(graph)
+    return changed
+
+
 @repeat
 def convert_sail_assert_to_exception(graph, codegen):
     res = False
@@ -1672,6 +2163,7 @@ def convert_sail_assert_to_exception(graph, codegen):
                 assert_str += ' ' + op.args[1].string
                 block.operations.append(Comment(assert_str))
             block.next = ConditionalGoto(op.args[0], newblock, failblock, op.sourcepos)
+            graph.cfg_changed()
             res = True
             # try with the next blocks, but if there are multiple asserts in
             # this one we need to repeat
@@ -1724,6 +2216,7 @@ def duplicate_end_blocks(graph, codegen):
                 # need a new block, the previous block has several successors
                 newblock = Block(ops)
                 predblock.next.replace_next(block, newblock)
+                graph.cfg_changed()
             if isinstance(next, Return):
                 newblock.next = Return(replacements.get(next.value, next.value), next.sourcepos)
             elif isinstance(next, Raise):
@@ -1839,10 +2332,239 @@ def remove_useless_switch(graph, codegen):
             block.next = Goto(block.next.truetarget, block.next.sourcepos)
             res = True
     if res:
+        graph.cfg_changed()
         remove_dead(graph, codegen)
     return res
 
 
+# decision trees for chains of comparisons, as produced by decoders
+
+MIN_DECISION_TREE_CASES = 8
+DECISION_TREE_LEAF_CASES = 3
+
+def _comparison_with_constant(block):
+    """ if block ends with a jump on comparing a small bitvector with a
+    constant, return (comparison, value, constant), otherwise None """
+    next = block.next
+    if not isinstance(next, ConditionalGoto) or next.truetarget is next.falsetarget:
+        return None
+    cond = next.booleanvalue
+    if type(cond) is not Operation or cond.name != "@eq_bits_bv_bv":
+        return None
+    value, const = cond.args
+    if isinstance(value, SmallBitVectorConstant):
+        value, const = const, value
+    if isinstance(value, Constant) or not isinstance(const, SmallBitVectorConstant):
+        return None
+    return cond, value, const
+
+@timed
+def compile_decision_trees(graph, codegen):
+    """ Turn long chains of comparisons of the same bitvector with different
+    constants (if x == a: ... elif x == b: ... elif ...) into a binary
+    decision tree over the constants, to need a logarithmic number of
+    comparisons instead of a linear one. """
+    from pydrofoil.emitfunction import count_uses
+    uses = count_uses(graph)
+    entrymap = graph.make_entrymap()
+
+    def chain_link(block, value):
+        # a block that does nothing but continuing the chain
+        if len(entrymap[block]) != 1:
+            return None
+        res = _comparison_with_constant(block)
+        if res is None:
+            return None
+        cond, othervalue, const = res
+        if othervalue is not value or block.operations != [cond] or uses[cond] != 1:
+            return None
+        return const
+
+    res = False
+    for block in list(graph.iterblocks()):
+        info = _comparison_with_constant(block)
+        if info is None:
+            continue
+        cond, value, const = info
+        prevblocks = entrymap[block]
+        if len(prevblocks) == 1:
+            previnfo = _comparison_with_constant(prevblocks[0])
+            if (previnfo is not None and previnfo[1] is value and
+                    prevblocks[0].next.falsetarget is block and
+                    chain_link(block, value) is not None):
+                continue # not the start of a chain
+        chain = [(block, const)]
+        current = block
+        while 1:
+            nextblock = current.next.falsetarget
+            nextconst = chain_link(nextblock, value)
+            if nextconst is None:
+                break
+            chain.append((nextblock, nextconst))
+            current = nextblock
+        if len(chain) < MIN_DECISION_TREE_CASES:
+            continue
+        _build_decision_tree(graph, chain, value, current.next.falsetarget, uses)
+        res = True
+    if res:
+        graph.cfg_changed()
+        _remove_unreachable_phi_prevvalues(graph)
+    return res
+
+def _build_decision_tree(graph, chain, value, default, uses):
+    startblock = chain[0][0]
+    lastblock = chain[-1][0]
+    sourcepos = startblock.next.sourcepos
+    # jump via new empty blocks to the targets, to not have to change the
+    # phis of the target blocks more than replacing the previous block
+    cases = {} # constant value -> (constant, block)
+    for block, const in chain:
+        if const.value in cases:
+            continue # can never match, the earlier comparison wins
+        target = block.next.truetarget
+        newblock = Block()
+        newblock.next = Goto(target)
+        target.replace_prev(block, newblock)
+        cases[const.value] = const, newblock
+    defaultblock = Block()
+    defaultblock.next = Goto(default)
+    default.replace_prev(lastblock, defaultblock)
+
+    def build(cases):
+        if len(cases) <= DECISION_TREE_LEAF_CASES:
+            firstblock = None
+            prevblock = None
+            for const, target in cases:
+                block = Block()
+                cond = block.emit(Operation, "@eq_bits_bv_bv", [value, const], types.Bool(), sourcepos)
+                block.next = ConditionalGoto(cond, target, defaultblock, sourcepos)
+                if prevblock is None:
+                    firstblock = block
+                else:
+                    prevblock.next.falsetarget = block
+                prevblock = block
+            return firstblock
+        middle = len(cases) // 2
+        block = Block()
+        cond = block.emit(Operation, "@ult_bits_bv_bv", [value, cases[middle][0]], types.Bool(), sourcepos)
+        block.next = ConditionalGoto(cond, build(cases[:middle]), build(cases[middle:]), sourcepos)
+        return block
+
+    tree = build([cases[key] for key in sorted(cases)])
+    cond = startblock.next.booleanvalue
+    if uses[cond] == 1:
+        startblock.operations.remove(cond)
+    startblock.next = Goto(tree, sourcepos)
+
+
+REGISTER_STORAGE_OPS = {
+    "@vector_subrange_o_i_i": "@helper_register_subrange_o_i_i",
+    "@vector_subrange_o_i_i_unwrapped_res": "@helper_register_subrange_o_i_i_unwrapped_res",
+    "@slice_o_i_i": "@helper_register_slice_o_i_i",
+    "@vector_slice_o_i_i_unwrapped_res": "@helper_register_slice_o_i_i_unwrapped_res",
+}
+
+def use_register_storage(graph, codegen):
+    """ Wide bitvector registers are stored in a mutable
+    bitvector.BitVectorRegister (see parse.Register.make_code). Turn reading
+    a subrange of such a register into a direct read of its words, and
+    writing back an updated subrange of it into an in-place update, instead
+    of building a new bitvector of the full width every time. """
+    from pydrofoil.emitfunction import count_uses
+    storage_registers = getattr(codegen, "storage_registers", None)
+    if not storage_registers:
+        return False
+    uses = count_uses(graph)
+    # the ops that the rewritten ops used, they may be dead now
+    maybe_dead = []
+    for block in graph.iterblocks():
+        ops = block.operations
+        for index, op in enumerate(ops):
+            if isinstance(op, GlobalWrite):
+                if op.name not in storage_registers:
+                    continue
+                value, = op.args
+                cast = None
+                if isinstance(value, Cast) and uses[value] == 1:
+                    cast = value
+                    value, = value.args
+                if (type(value) is not Operation or
+                        value.name != "@vector_update_subrange_o_i_i_o" or
+                        uses[value] != 1):
+                    continue
+                if not _register_unchanged(ops, value.args[0], index, op.name, codegen):
+                    continue
+                ops[index] = Operation(
+                    "@helper_register_update_subrange_o_i_i_o",
+                    [StringConstant(storage_registers[op.name])] + value.args[1:],
+                    types.Unit(), value.sourcepos)
+                if cast is not None:
+                    maybe_dead.append(cast)
+                maybe_dead.append(value)
+                _add_register_read(maybe_dead, value.args[0])
+            elif type(op) is Operation and op.name in REGISTER_STORAGE_OPS:
+                reg = op.args[0]
+                if isinstance(reg, Cast):
+                    reg, = reg.args
+                if not isinstance(reg, GlobalRead) or reg.name not in storage_registers:
+                    continue
+                if not _register_unchanged(ops, reg, index, reg.name, codegen):
+                    continue
+                newop = Operation(
+                    REGISTER_STORAGE_OPS[op.name],
+                    [StringConstant(storage_registers[reg.name])] + op.args[1:],
+                    op.resolved_type, op.sourcepos, op.varname_hint)
+                ops[index] = newop
+                graph.replace_op(op, newop)
+                _add_register_read(maybe_dead, op.args[0])
+    if not maybe_dead:
+        return False
+    _remove_unused_register_reads(graph, maybe_dead)
+    return True
+
+def _add_register_read(maybe_dead, value):
+    if isinstance(value, Cast):
+        maybe_dead.append(value)
+        value, = value.args
+    maybe_dead.append(value)
+
+def _register_unchanged(ops, value, index, name, codegen):
+    # check that the register name is read in the same block as
+    # ops[index], and not changed in between
+    if isinstance(value, Cast):
+        value, = value.args
+    if not isinstance(value, GlobalRead) or value.name != name:
+        return False
+    for startindex in range(index - 1, -1, -1):
+        if ops[startindex] is value:
+            break
+    else:
+        return False
+    for op in ops[startindex + 1:index]:
+        if type(op) is Operation and op.name in REGISTER_STORAGE_OPS.values():
+            continue # only reads
+        if not _leaves_globals_alone(op, codegen):
+            return False
+    return True
+
+def _remove_unused_register_reads(graph, maybe_dead):
+    # the rewritten reads and updates don't need the full value of the
+    # register any more. reading it needlessly would also make the next
+    # in-place update copy the words of the register. only the register
+    # reads, casts and updates that the rewritten ops used are removed, once
+    # nothing else uses them
+    from pydrofoil.emitfunction import count_uses
+    maybe_dead = set(maybe_dead)
+    while 1:
+        uses = count_uses(graph)
+        dead = set([op for op in maybe_dead if not uses[op]])
+        if not dead:
+            return
+        maybe_dead -= dead
+        for block in graph.iterblocks():
+            if any(op in dead for op in block.operations):
+                block.operations = [op for op in block.operations if op not in dead]
+
 class NoMatchException(Exception):
     pass
 
@@ -1861,6 +2583,22 @@ def symmetric(func):
 
 REMOVE = "REMOVE"
 
+def _cse_can_replace(op, codegen):
+    if isinstance(op, Cast):
+        return True
+    if isinstance(op, UnionCast):
+        return True
+    if isinstance(op, UnionVariantCheck):
+        return True
+    if isinstance(op, FieldAccess):
+        typ = op.args[0].resolved_type
+        return isinstance(typ, types.Struct) and typ.tuplestruct
+    if op.name == "@not":
+        return True
+    name = codegen.builtin_names.get(op.name, op.name)
+    name = name.lstrip('@')
+    return type(op) is Operation and name in supportcode.purefunctions
+
 class BaseOptimizer(object):
     def __init__(self, graph, codegen, do_double_casts=True):
         self.graph = graph
@@ -1881,6 +2619,8 @@ class BaseOptimizer(object):
         # cse attributes
         self.cse_op_available = {} # block -> block -> prev_op
         self.cse_op_available_in_block = None
+        # blocks that changed or use replaced values
+        self.changed_blocks = set()
 
     def __repr__(self):
         return "<%s %s>" % (self.__class__.__name__, self.graph)
@@ -1888,15 +2628,19 @@ class BaseOptimizer(object):
     def view(self):
         self.graph.view(self.codegen)
 
-    def optimize(self):
+    def optimize(self, blocks=None):
+        """ Optimize the graph. If blocks is given, only those blocks are
+        optimized. """
         self.replacements = {}
         for block in topo_order_best_attempt(self.graph):
+            if blocks is not None and block not in blocks:
+                continue
             self.current_block = block
             self.optimize_block(block)
         if self.replacements:
             # XXX do them all in one go
             while 1:
-                changed = self.graph.replace_ops(self.replacements)
+                changed = self.graph.replace_ops(self.replacements, self.changed_blocks)
                 if not changed:
                     break
             self.replacements.clear()
@@ -1931,7 +2675,11 @@ class BaseOptimizer(object):
                 else:
                     takenblock = cond.falsetarget
                 block.next = Goto(takenblock)
+                self.graph.cfg_changed()
                 self._dead_blocks = True
+                self.changed_blocks.add(block)
+        if self.newoperations != block.operations:
+            self.changed_blocks.add(block)
         block.operations = self.newoperations
         self.newoperations = None
         self.cse_op_available_in_block = None
@@ -1943,7 +2691,9 @@ class BaseOptimizer(object):
             if len(prev_blocks) == 1:
                 prev_block, = prev_blocks
                 nextblocks_of_prevblock = self.nextblocks[prev_block]
-                available_in_block = self.cse_op_available[prev_blocks[0]]
+                # the previous block was not optimized if only some blocks
+                # are being optimized
+                available_in_block = self.cse_op_available.get(prev_block, {})
                 if len(nextblocks_of_prevblock) > 1:
                     available_in_block = available_in_block.copy()
             else:
@@ -2011,19 +2761,7 @@ class BaseOptimizer(object):
         return self._cse_is_tuplestruct_typ(op.args[0].resolved_type)
 
     def _cse_can_replace(self, op):
-        if isinstance(op, Cast):
-            return True
-        if isinstance(op, UnionCast):
-            return True
-        if isinstance(op, UnionVariantCheck):
-            return True
-        if isinstance(op, FieldAccess) and self._cse_is_tuplestruct(op):
-            return True
-        if op.name == "@not":
-            return True
-        name = self.codegen.builtin_names.get(op.name, op.name)
-        name = name.lstrip('@')
-        return type(op) is Operation and name in supportcode.purefunctions
+        return _cse_can_replace(op, self.codegen)
 
     def _cse_comparison_tuple(self, valuelist):
         return tuple(self.replacements.get(arg, arg).comparison_key() for arg in valuelist)
@@ -2237,52 +2975,7 @@ class LocalOptimizer(BaseOptimizer):
             return
         if not all(isinstance(arg, Constant) for arg in args):
             return self._try_fold_phi(name, func, args, op.resolved_type, op)
-        return self._try_fold(name, func, args, op.resolved_type, op)
-
-    def _try_fold(self, name, func, args, resolved_type, op):
-        runtimeargs = []
-        for arg in args:
-            if isinstance(arg, IntConstant):
-                if not isinstance(arg.number, int):
-                    return None # XXX can be improved
-                runtimeargs.append(bitvector.Integer.fromint(arg.number))
-            elif isinstance(arg, MachineIntConstant):
-                runtimeargs.append(arg.number)
-            elif isinstance(arg, SmallBitVectorConstant):
-                runtimeargs.append(arg.value)
-            elif isinstance(arg, GenericBitVectorConstant):
-                runtimeargs.append(arg.value)
-            elif arg.resolved_type is types.Real():
-                return # later
-            elif arg.resolved_type is types.Unit():
-                runtimeargs.append(())
-            elif arg.resolved_type is types.String():
-                runtimeargs.append(arg.string)
-            else:
-                return None
-        try:
-            res = func("constfolding", *runtimeargs)
-        except (Exception, AssertionError) as e:
-            print "generict const-folding failed", name, op, "with error", e, "arguments", args
-            return None
-        if resolved_type is types.MachineInt():
-            assert isinstance(res, int)
-            return MachineIntConstant(res)
-        if resolved_type is types.Int():
-            return IntConstant(int(res.tolong()))
-        if isinstance(resolved_type, types.SmallFixedBitVector):
-            assert isinstance(res, r_uint)
-            return SmallBitVectorConstant.from_ruint(resolved_type.width, res)
-        if resolved_type is types.Bool():
-            assert isinstance(res, bool)
-            return BooleanConstant.frombool(res)
-        if resolved_type is types.String():
-            assert isinstance(res, str)
-            return StringConstant(res)
-        if resolved_type is types.GenericBitVector():
-            assert isinstance(res, bitvector.BitVector)
-            return GenericBitVectorConstant(res)
-        # XXX other types? import pdb;pdb.set_trace()
+        return _try_fold(name, func, args, op.resolved_type, op)
 
     def _try_fold_phi(self, name, func, args, resolved_type, op):
         phi_index = -1
@@ -2306,7 +2999,7 @@ class LocalOptimizer(BaseOptimizer):
         for value in phi.prevvalues:
             newargs = args[:]
             newargs[phi_index] = value
-            res = self._try_fold(name, func, newargs, resolved_type, op)
+            res = _try_fold(name, func, newargs, resolved_type, op)
             if res is None:
                 return
             if not results:
@@ -3943,6 +4636,7 @@ def _inline(graph, codegen, block, index, subgraph, add_comment=True):
     res, = return_block.operations
     assert return_block.next is None
     return_block.next = Goto(newblock)
+    graph.cfg_changed()
     graph.replace_op(op, return_block.operations[0])
     _remove_unreachable_phi_prevvalues(graph)
     simplify_phis(graph, codegen)
@@ -3994,7 +4688,7 @@ def copy_blocks(graph, op):
 
     return blocks[graph.startblock], returnblock
 
-def should_inline(graph, model_specific_should_inline=None):
+def should_inline(graph, model_specific_should_inline=None, call_profile=None):
     if model_specific_should_inline:
         res = model_specific_should_inline(graph.name)
         if res is not None:
@@ -4008,10 +4702,18 @@ def should_inline(graph, model_specific_should_inline=None):
         if isinstance(op, Operation) and op.name == graph.name:
             return False # no recursive inlining
     number_ops = len([op for block in blocks for op in block.operations])
+    if call_profile is not None:
+        # see callprofile.py
+        res = call_profile.should_inline(graph.name, len(blocks), number_ops)
+        if res is not None:
+            return res
     return len(blocks) <= 4 and number_ops < 25
 
 
 def topo_order(graph):
+    return graph._cached_analysis("topo_order", _topo_order)[:]
+
+def _topo_order(graph):
     order = list(graph.iterblocks()) # dfs
 
     # do a (slightly bad) topological sort
@@ -4039,7 +4741,9 @@ def topo_order_best_attempt(graph):
     # supports loops too
     if not graph.has_loop:
         return topo_order(graph)
+    return graph._cached_analysis("topo_order_best_attempt", _topo_order_best_attempt)[:]
 
+def _topo_order_best_attempt(graph):
     order = list(graph.iterblocks()) # dfs
 
     incoming = defaultdict(set)
@@ -4126,6 +4830,7 @@ def remove_double_exception_check(graph, codegen):
         if not is_exceptional_return(exceptional_return):
             continue
         block.next.truetarget = exceptional_return
+        graph.cfg_changed()
         nextblock.next.booleanvalue = BooleanConstant.FALSE
         remove_if_true_false(graph, codegen)
         remove_empty_blocks(graph, codegen)
@@ -4180,22 +4885,22 @@ def find_anticipated_casts(graph):
     return anticipated_casts
 
 
+def _leaves_globals_alone(op, codegen):
+    if not op.can_have_side_effects:
+        return True
+    if isinstance(op, Comment):
+        return True
+    if op.name == "@not":
+        return True
+    if op.name == "@eq":
+        return True
+    name = op.name.lstrip("@$")
+    name = codegen.builtin_names.get(name, name)
+    return type(op) is Operation and name in supportcode.purefunctions
+
 @repeat
 def cse_global_reads(graph, codegen):
     # very simple forward load-after-load pass
-    def leaves_globals_alone(op):
-        if not op.can_have_side_effects:
-            return True
-        if isinstance(op, Comment):
-            return True
-        if op.name == "@not":
-            return True
-        if op.name == "@eq":
-            return True
-        name = op.name.lstrip("@$")
-        name = codegen.builtin_names.get(name, name)
-        return type(op) is Operation and name in supportcode.purefunctions
-
     replacements = {}
     available = {} # block -> block -> prev_op
 
@@ -4222,7 +4927,7 @@ def cse_global_reads(graph, codegen):
                 key = (op.name, op.resolved_type)
                 available_in_block[key] = op.args[0]
                 continue
-            elif not leaves_globals_alone(op):
+            elif not _leaves_globals_alone(op, codegen):
                 available_in_block.clear()
                 continue
             else:
@@ -4322,34 +5027,62 @@ def partial_allocation_removal(graph, codegen):
 # ____________________________________________________________
 # dominator-tree based algorithms
 
-def compute_dominators(G):
-    return _compute_dominators(G)[0]
-
-def _compute_dominators(G):
-    preds = G.make_entrymap()
-    start = G.startblock
-    # initialize
-    dominators = {}
-    for node in preds:
-        dominators[node] = set(preds)
-    dominators[start] = {start}
-
-    # fixpoint
-    changed = True
-    while changed:
-        changed = False
-        for node in preds:
-            if node == start:
+@timed
+def gvn(graph, codegen):
+    """ Global value numbering along the dominator tree: a pure operation
+    is replaced by an equivalent one in a dominating block. Unlike the CSE in
+    the BaseOptimizer this also works across loop headers. """
+    idom, entrymap = graph.idoms_and_entrymap()
+    children = defaultdict(list)
+    for block, dominator in idom.iteritems():
+        if block is not dominator:
+            children[dominator].append(block)
+    # tuplestructs can be written to in place, don't touch reads of them then
+    written_structs = set()
+    for op, _ in graph.iterblockops():
+        if isinstance(op, FieldWrite):
+            written_structs.add(op.args[0].resolved_type)
+
+    replacements = {}
+    available = {}
+    todo = [(graph.startblock, None)]
+    while todo:
+        block, added_keys = todo.pop()
+        if added_keys is not None:
+            # leaving the dominator subtree of block
+            for key in added_keys:
+                del available[key]
+            continue
+        added_keys = []
+        for index, op in enumerate(block.operations):
+            if isinstance(op, Phi) or not _cse_can_replace(op, codegen):
                 continue
-            dom = set(preds).intersection(*[dominators[x] for x in preds[node]])
-            dom.add(node)
-            if dom != dominators[node]:
-                changed = True
-                dominators[node] = dom
-    return dominators, preds
+            if isinstance(op, FieldAccess) and op.args[0].resolved_type in written_structs:
+                continue
+            key = (type(op), op.name, tuple(replacements.get(arg, arg).comparison_key()
+                                            for arg in op.args), op.resolved_type)
+            if key in available:
+                replacements[op] = available[key]
+                block.operations[index] = None
+            else:
+                available[key] = op
+                added_keys.append(key)
+        if len(replacements) and None in block.operations:
+            block.operations = [op for op in block.operations if op is not None]
+        todo.append((block, added_keys))
+        todo.extend((child, None) for child in children[block])
+    if not replacements:
+        return False
+    graph.replace_ops(replacements)
+    return True
+
+
+def compute_dominators(G):
+    # the result is cached on the graph, don't mutate it
+    return G._dominators()
 
 def dominatees(G):
-    dom, pred = _compute_dominators(G)
+    dom = G._dominators()
     res = defaultdict(set)
     for block, doms in dom.iteritems():
         for dominator_block in doms:
@@ -4364,6 +5097,93 @@ def find_backedges(G):
         if target in dom[source]:
             yield source, target
 
+def _natural_loop(header, sources, entrymap):
+    body = {header}
+    todo = list(sources)
+    while todo:
+        block = todo.pop()
+        if block in body:
+            continue
+        body.add(block)
+        todo.extend(entrymap[block])
+    return body
+
+@timed
+def licm(graph, codegen):
+    """ Loop-invariant code motion: move pure operations from loop headers
+    whose arguments are all defined outside of the loop to a preheader. Reads
+    of globals are moved too if nothing in the loop can write globals. Only
+    loop headers are considered, because they are executed whenever the loop
+    is entered, so nothing is computed that wasn't computed before. """
+    if not graph.has_loop:
+        return False
+    entrymap = graph.make_entrymap()
+    backedge_sources = defaultdict(list)
+    for source, header in find_backedges(graph):
+        backedge_sources[header].append(source)
+    written_structs = set()
+    for op, _ in graph.iterblockops():
+        if isinstance(op, FieldWrite):
+            written_structs.add(op.args[0].resolved_type)
+    # inner loops first, in a deterministic order. an operation hoisted out of
+    # an inner loop lands in the body of the enclosing loop and can then be
+    # hoisted further
+    order = {block: index for index, block in enumerate(graph.iterblocks())}
+    headers = sorted(backedge_sources, key=lambda header: (
+        len(_natural_loop(header, backedge_sources[header], entrymap)),
+        order[header]))
+    changed = False
+    for header in headers:
+        body = _natural_loop(header, backedge_sources[header], entrymap)
+        outside_preds = [block for block in entrymap[header] if block not in body]
+        if len(outside_preds) != 1:
+            continue
+        defined_in_loop = set()
+        loop_writes_globals = False
+        for block in body:
+            defined_in_loop.update(block.operations)
+            for op in block.operations:
+                if isinstance(op, GlobalWrite) or not _leaves_globals_alone(op, codegen):
+                    loop_writes_globals = True
+        hoisted = []
+        for op in header.operations:
+            if isinstance(op, Phi):
+                continue
+            if isinstance(op, GlobalRead):
+                if loop_writes_globals:
+                    continue
+            elif not _cse_can_replace(op, codegen):
+                continue
+            elif isinstance(op, FieldAccess) and op.args[0].resolved_type in written_structs:
+                continue
+            if any(arg in defined_in_loop for arg in op.args):
+                continue
+            hoisted.append(op)
+            defined_in_loop.remove(op)
+        if not hoisted:
+            continue
+        pred, = outside_preds
+        if isinstance(pred.next, Goto):
+            preheader = pred
+        else:
+            # need a new block between the conditional jump and the header
+            preheader = Block()
+            preheader.next = Goto(header)
+            pred.next.replace_next(header, preheader)
+            graph.cfg_changed()
+            for op in header.operations:
+                if isinstance(op, Phi):
+                    op.prevblocks = [preheader if block is pred else block
+                                     for block in op.prevblocks]
+            entrymap[header] = [preheader if block is pred else block
+                                for block in entrymap[header]]
+            entrymap[preheader] = [pred]
+        hoisted_set = set(hoisted)
+        header.operations = [op for op in header.operations if op not in hoisted_set]
+        preheader.operations.extend(hoisted)
+        changed = True
+    return changed
+
 def propagate_equality(graph, codegen):
     changed = False
     # maps blocks -> values -> [(intconst, prevblock)]
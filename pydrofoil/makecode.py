@@ -1,15 +1,21 @@
 import os
 import sys
 import time
+import cPickle
+import hashlib
 from contextlib import contextmanager
 from rpython.tool.pairtype import pair
 
-from pydrofoil import parse, types, binaryop, operations, supportcode, specialize
-from pydrofoil.emitfunction import emit_function_code
+from pydrofoil import parse, types, binaryop, operations, supportcode, specialize, callprofile
+from pydrofoil.emitfunction import emit_function_code, unboxed_int_parameters
 
 
 assert sys.maxint == 2 ** 63 - 1, "only 64 bit platforms are supported!"
 
+# functions that are hot in the call profile are only split if they have more
+# blocks than that
+HOT_SPLIT_BLOCKS = 400
+
 class NameInfo(object):
     def __init__(self, pyname, typ, ast, write_pyname=None):
         self.pyname = pyname
@@ -22,8 +28,8 @@ class NameInfo(object):
 
 
 class Codegen(specialize.FixpointSpecializer):
-    def __init__(self, promoted_registers=frozenset(), should_inline=None, entrypoints=None):
-        specialize.FixpointSpecializer.__init__(self, entrypoints=entrypoints)
+    def __init__(self, promoted_registers=frozenset(), should_inline=None, entrypoints=None, parallelism=None, graph_cache_dir=None, call_profile=None, instrument_calls=False):
+        specialize.FixpointSpecializer.__init__(self, entrypoints=entrypoints, parallelism=parallelism, graph_cache_dir=graph_cache_dir)
         self.declarations = []
         self.runtimeinit = []
         self.code = []
@@ -51,9 +57,15 @@ class Codegen(specialize.FixpointSpecializer):
         self.add_global("@vector_subrange_o_i_i_unwrapped_res", "supportcode.vector_subrange_o_i_i_unwrapped_res")
         self.add_global("@vector_slice_o_i_i_unwrapped_res", "supportcode.vector_slice_o_i_i_unwrapped_res")
         self.add_global("@helper_vector_update_inplace_o_i_o", "supportcode.helper_vector_update_inplace_o_i_o")
+        self.add_global("@helper_register_update_subrange_o_i_i_o", "supportcode.helper_register_update_subrange_o_i_i_o")
+        self.add_global("@helper_register_subrange_o_i_i", "supportcode.helper_register_subrange_o_i_i")
+        self.add_global("@helper_register_subrange_o_i_i_unwrapped_res", "supportcode.helper_register_subrange_o_i_i_unwrapped_res")
+        self.add_global("@helper_register_slice_o_i_i", "supportcode.helper_register_slice_o_i_i")
+        self.add_global("@helper_register_slice_o_i_i_unwrapped_res", "supportcode.helper_register_slice_o_i_i_unwrapped_res")
         self.add_global("@eq_bits", "supportcode.eq_bits")
         self.add_global("@eq_bits_bv_bv", "supportcode.eq_bits_bv_bv")
         self.add_global("@neq_bits_bv_bv", "supportcode.neq_bits_bv_bv")
+        self.add_global("@ult_bits_bv_bv", "supportcode.ult_bits_bv_bv")
         self.add_global("@eq_int_o_i", "supportcode.eq_int_o_i")
         self.add_global("@eq_int_i_i", "supportcode.eq_int_i_i")
         self.add_global("@add_i_i_wrapped_res", "supportcode.add_i_i_wrapped_res")
@@ -104,12 +116,28 @@ class Codegen(specialize.FixpointSpecializer):
         self.add_global("throw_location", "machine.throw_location", types.String(), write_pyname="machine.throw_location")
         self.promoted_registers = promoted_registers
         self.all_registers = {}
+        # register name -> pyname, of the registers stored in a
+        # bitvector.BitVectorRegister
+        self.storage_registers = {}
+        # the graphs that are emitted as functions taking their Int
+        # arguments unboxed, see emitfunction.unboxed_int_parameters
+        self.unboxed_int_graphs = set()
         self.inlinable_functions = {}
         # a function that returns True, False or None
         self.should_inline = should_inline if should_inline is not None else lambda name: None
         self.let_values = {}
         # (graphs, funcs, args, kwargs) to emit at the end
         self._all_graphs = []
+        # profile of a guest run that drives inlining and specialization
+        self.call_profile = call_profile
+        # if True, the generated code counts calls, see callprofile.py
+        self.instrument_calls = instrument_calls
+        if instrument_calls:
+            # calls of inlined functions would not be counted, and the
+            # functions would look cold in the profile
+            self.should_inline = lambda name: False
+        self._call_profile_keys = []
+        self._call_profile_index = {}
 
     def add_global(self, name, pyname, typ=None, ast=None, write_pyname=None):
         assert isinstance(typ, types.Type) or typ is None
@@ -206,22 +234,39 @@ class Codegen(specialize.FixpointSpecializer):
             with self.emit_code_type("declarations"):
                 yield name
 
+    def emit_call_counter(self, *names):
+        # one name: count calls of a function, two names: count the calls
+        # from the first function to the second one
+        kind = "f" if len(names) == 1 else "c"
+        key = " ".join([kind] + [callprofile.base_name(name) for name in names])
+        index = self._call_profile_index.get(key)
+        if index is None:
+            index = self._call_profile_index[key] = len(self._call_profile_keys)
+            self._call_profile_keys.append(key)
+        self.emit("call_profile_counts[%s] += 1" % (index, ))
+
     def getcode(self):
         self.finish_graphs()
         res = ["\n".join(self.declarations)]
         res.append("def let_init(machine):\n    " + "\n    ".join(self.runtimeinit or ["pass"]))
         res.append("let_init(Machine)")
+        storage_init = ["machine.%s = Machine.%s.copy()" % (pyname, pyname)
+                        for _, pyname in sorted(self.storage_registers.items())]
+        res.append("def init_register_storage(machine):\n    " + "\n    ".join(storage_init or ["pass"]))
         res.append("\n".join(self.code))
         return "\n\n".join(res)
 
     def emit_extra_graph(self, graph, functyp):
         pyname = "func_" + graph.name
         self.add_global(graph.name, pyname, functyp)
-        args = [arg.name for arg in graph.args]
+        args, unbox_lines = unboxed_int_parameters(graph.args)
         first = "def %s(machine, %s):" % (pyname, ", ".join(args))
         def emit_extra(graph, codegen):
             with self.emit_indent(first):
+                for line in unbox_lines:
+                    self.emit(line)
                 emit_function_code(graph, None, codegen)
+        self.unboxed_int_graphs.add(graph)
         self.add_graph(graph, emit_extra)
 
     def add_graph(self, graph, emit_function, *args, **kwargs):
@@ -239,6 +284,9 @@ class Codegen(specialize.FixpointSpecializer):
         else:
             program_entrypoints = self.program_entrypoints + ["zinitializze_registers"]
             program_entrypoints = [self.all_graph_by_name[name] for name in program_entrypoints]
+        removed = self.deduplicate_specialized_graphs(
+            program_entrypoints + [g for g, _, _, _ in self._all_graphs])
+        self.print_persistent_msg("REMOVED DUPLICATE SPECIALIZATIONS:", removed)
         extra_graphs = self.extract_needed_extra_graphs(program_entrypoints)
         graphs_to_emit = set(program_entrypoints)
         for graph, typ in extra_graphs:
@@ -248,6 +296,11 @@ class Codegen(specialize.FixpointSpecializer):
         for graph, func, args, kwargs in self._all_graphs:
             if graph in graphs_to_emit:
                 func(graph, self, *args, **kwargs)
+        if self.instrument_calls:
+            with self.emit_code_type("declarations"):
+                self.emit("call_profile_counts = [0] * %s" % (len(self._call_profile_keys), ))
+                self.emit("Machine._call_profile_keys = %r" % (self._call_profile_keys, ))
+                self.emit("Machine._call_profile_counts = call_profile_counts")
         t2 = time.time()
         self.print_persistent_msg("DONE, took seconds", round(t2 - t1, 2))
         print_stats()
@@ -280,16 +333,41 @@ class Codegen(specialize.FixpointSpecializer):
                 self.emit("return True")
         structtyp.uninitialized_value = "%s(%s)" % (pyname, ", ".join(uninit_arg))
 
-def parse_and_make_code(s, support_code, promoted_registers=set(), should_inline=None, entrypoints=None):
+def parse_and_make_code(s, support_code, promoted_registers=set(), should_inline=None, entrypoints=None, parallelism=None, cache_dir=None, call_profile=None, instrument_calls=False):
     from pydrofoil.infer import infer
-    t1 = time.time()
-    ast = parse.parser.parse(parse.lexer.lex(s))
-    t2 = time.time()
-    print "parsing took", round(t2 - t1, 2)
-    context = infer(ast)
-    t3 = time.time()
-    print "infer took", round(t3 - t2, 2)
-    c = Codegen(promoted_registers, should_inline=should_inline, entrypoints=entrypoints)
+    ast = None
+    if cache_dir is not None:
+        t1 = time.time()
+        ast = load_ast_from_cache(s, cache_dir)
+        if ast is not None:
+            print "loading parsed ast from cache took", round(time.time() - t1, 2)
+    if ast is None:
+        t1 = time.time()
+        ast = parse.parser.parse(parse.lexer.lex(s))
+        t2 = time.time()
+        print "parsing took", round(t2 - t1, 2)
+        context = infer(ast)
+        t3 = time.time()
+        print "infer took", round(t3 - t2, 2)
+        if cache_dir is not None:
+            # must happen before make_code, which mutates the ast
+            store_ast_in_cache(s, cache_dir, ast)
+    if entrypoints is not None:
+        # don't make ir for functions that can't be reached from the entrypoints
+        removed = ast.remove_unreachable_functions(entrypoints + ["zinitializze_registers"])
+        print "removed", removed, "unreachable functions"
+    graph_cache_dir = None
+    if cache_dir is not None:
+        graph_cache_dir = os.path.join(cache_dir, "graphs")
+    c = make_codegen(support_code, promoted_registers, should_inline=should_inline, entrypoints=entrypoints, parallelism=parallelism, graph_cache_dir=graph_cache_dir,
+                     call_profile=call_profile, instrument_calls=instrument_calls)
+    ast.make_code(c)
+    return c.getcode()
+
+def make_codegen(support_code, promoted_registers=set(), **kwargs):
+    """ make a Codegen that already contains the module header of the
+    generated code """
+    c = Codegen(promoted_registers, **kwargs)
     with c.emit_code_type("declarations"):
         c.emit("from rpython.rlib import jit")
         c.emit("from rpython.rlib.rbigint import rbigint")
@@ -304,11 +382,42 @@ def parse_and_make_code(s, support_code, promoted_registers=set(), should_inline
         c.emit("    _immutable_fields_ = ['g']")
         c.emit("    l = Lets()")
         c.emit("    def __init__(self):")
-        c.emit("        self.l  = Machine.l; func_zinitializze_registers(self, ())")
+        c.emit("        self.l  = Machine.l; init_register_storage(self); func_zinitializze_registers(self, ())")
         c.emit("        self.g = supportcode.Globals()")
         c.emit("UninitInt = bitvector.Integer.fromint(-0xfefee)")
-    ast.make_code(c)
-    return c.getcode()
+    return c
+
+
+def _ast_cache_filename(s, cache_dir):
+    # the key contains the source of the parser and the type inference, so
+    # that changing them invalidates the cache
+    from pydrofoil import infer
+    h = hashlib.sha1()
+    for mod in (parse, infer, types):
+        filename = mod.__file__
+        if filename.endswith((".pyc", ".pyo")):
+            filename = filename[:-1]
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    h.update(s)
+    return os.path.join(cache_dir, "ast-%s.pickle" % (h.hexdigest(), ))
+
+def load_ast_from_cache(s, cache_dir):
+    filename = _ast_cache_filename(s, cache_dir)
+    try:
+        with open(filename, "rb") as f:
+            return cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+def store_ast_in_cache(s, cache_dir, ast):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    filename = _ast_cache_filename(s, cache_dir)
+    tmpfilename = "%s.%s.tmp" % (filename, os.getpid())
+    with open(tmpfilename, "wb") as f:
+        cPickle.dump(ast, f, -1)
+    os.rename(tmpfilename, filename)
 
 
 # ____________________________________________________________
@@ -526,8 +635,17 @@ class __extend__(parse.Register):
         self.pyname = "_reg_%s" % (self.name, )
         typ = self.typ.resolve_type(codegen)
         read_pyname = write_pyname = "machine.%s" % self.pyname
+        uninitialized_value = typ.uninitialized_value
         if self.name in codegen.promoted_registers:
             read_pyname = "jit.promote(%s)" % write_pyname
+        elif isinstance(typ, types.BigFixedBitVector) and typ.width > 128:
+            # wide registers (eg vector registers) get mutable storage, to
+            # be able to update their elements in place, see
+            # ir.use_register_storage
+            read_pyname = "%s.read()" % write_pyname
+            write_pyname = "%s.write(%%s)" % write_pyname
+            uninitialized_value = "bitvector.BitVectorRegister(%s)" % (typ.width, )
+            codegen.storage_registers[self.name] = self.pyname
         else:
             read_pyname = typ.packed_field_read(read_pyname)
             write_pyname = typ.packed_field_write(write_pyname, '%s') # bit too much string processing magic
@@ -535,7 +653,7 @@ class __extend__(parse.Register):
         codegen.all_registers[self.name] = self
         codegen.add_global(self.name, read_pyname, typ, self, write_pyname)
         with codegen.emit_code_type("declarations"):
-            codegen.emit("Machine.%s = %s" % (self.pyname, typ.uninitialized_value))
+            codegen.emit("Machine.%s = %s" % (self.pyname, uninitialized_value))
 
         if self.body is None:
             return
@@ -570,31 +688,40 @@ class __extend__(parse.Function):
             return
         codegen.print_debug_msg("making SSA IR")
         graph = construct_ir(self, codegen)
-        inlinable = should_inline(graph, codegen.should_inline)
+        inlinable = should_inline(graph, codegen.should_inline, codegen.call_profile)
+        split_blocks = 150
+        if codegen.call_profile is not None and codegen.call_profile.is_hot(self.name):
+            # splitting adds calls, avoid that on the hot paths
+            split_blocks = HOT_SPLIT_BLOCKS
         if inlinable:
             codegen.inlinable_functions[self.name] = graph
-        elif not graph.has_loop and graph.has_more_than_n_blocks(150):
+        elif not graph.has_loop and graph.has_more_than_n_blocks(split_blocks):
             codegen.print_debug_msg("splitting", self.name)
             functyp = codegen.globalnames[self.name].typ
             for graph2, graph2typ in split_completely(graph, self, functyp, codegen):
                 codegen.add_global(graph2.name, graph2.name, graph2typ)
+                codegen.unboxed_int_graphs.add(graph2)
                 codegen.add_graph(graph2, self.emit_regular_function, graph2.name)
         else:
             if usefully_specializable(graph):
                 codegen.specialization_functions[self.name] = Specializer(graph, codegen)
 
+        codegen.unboxed_int_graphs.add(graph)
         codegen.add_graph(graph, self.emit_regular_function, pyname)
         del self.body # save memory, don't need to keep the parse tree around
 
     def emit_regular_function(self, graph, codegen, pyname):
-        with self._scope(codegen, pyname, actual_args=graph.args):
+        with self._scope(codegen, pyname, actual_args=graph.args, unboxed_ints=True):
             emit_function_code(graph, self, codegen)
         codegen.emit()
 
     @contextmanager
-    def _scope(self, codegen, pyname, method=False, actual_args=None):
+    def _scope(self, codegen, pyname, method=False, actual_args=None, unboxed_ints=False):
         # extra_args is a list of tuples (name, typ)
-        if actual_args is not None:
+        unbox_lines = []
+        if unboxed_ints:
+            args, unbox_lines = unboxed_int_parameters(actual_args)
+        elif actual_args is not None:
             args = [arg.name for arg in actual_args]
         else:
             args = self.args
@@ -613,6 +740,8 @@ class __extend__(parse.Function):
             if actual_args:
                 for arg in actual_args:
                     codegen.add_local(arg.name, arg.name, arg.resolved_type, self)
+            for line in unbox_lines:
+                codegen.emit(line)
             yield
 
     def _prepare_blocks(self):
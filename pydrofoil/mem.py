@@ -1,6 +1,7 @@
 from rpython.rlib.nonconst import NonConstant
 from rpython.rlib.objectmodel import we_are_translated, always_inline
 from rpython.rlib.rarithmetic import r_uint, intmask
+from rpython.rlib.rstring import StringBuilder
 from rpython.rlib import jit, debug as rdebug
 from rpython.rlib import rmmap
 from rpython.rtyper.lltypesystem import rffi, lltype
@@ -54,27 +55,108 @@ class MemBase(object):
             value = value >> 8
         assert not value
 
+    def write_bytes(self, start_addr, buf):
+        """ Write the string buf to memory, starting at start_addr. All the
+        aligned words are copied a whole word at a time. """
+        length = len(buf)
+        i = 0
+        while i < length and not self.is_aligned(start_addr + r_uint(i)):
+            self._aligned_write(start_addr + r_uint(i), 1, r_uint(ord(buf[i])))
+            i += 1
+        num_words = (length - i) >> 3
+        self._write_words(start_addr + r_uint(i), buf, i, num_words)
+        i += num_words * 8
+        while i < length:
+            self._aligned_write(start_addr + r_uint(i), 1, r_uint(ord(buf[i])))
+            i += 1
+
+    def _write_words(self, start_addr, buf, index, num_words):
+        # start_addr is aligned
+        for j in range(num_words):
+            self._aligned_write(start_addr + j * 8, 8, _bytes_to_word(buf, index + j * 8))
+
+    def zero_range(self, start_addr, num_bytes):
+        """ Set num_bytes bytes starting at start_addr to zero. """
+        self.write_bytes(start_addr, '\x00' * num_bytes)
+
+    def read_bytes(self, start_addr, num_bytes):
+        """ Read num_bytes bytes starting at start_addr and return them as a
+        string. All the aligned words are read a whole word at a time. """
+        builder = StringBuilder(num_bytes)
+        i = 0
+        while i < num_bytes and not self.is_aligned(start_addr + r_uint(i)):
+            builder.append(chr(intmask(self._aligned_read(start_addr + r_uint(i), 1, False))))
+            i += 1
+        num_words = (num_bytes - i) >> 3
+        self._read_words(start_addr + r_uint(i), num_words, builder)
+        i += num_words * 8
+        while i < num_bytes:
+            builder.append(chr(intmask(self._aligned_read(start_addr + r_uint(i), 1, False))))
+            i += 1
+        return builder.build()
+
+    def _read_words(self, start_addr, num_words, builder):
+        # start_addr is aligned
+        for j in range(num_words):
+            _append_word(builder, self._aligned_read(start_addr + j * 8, 8, False))
+
+def _bytes_to_word(buf, index):
+    # little endian
+    value = r_uint(0)
+    for i in range(7, -1, -1):
+        value = (value << 8) | r_uint(ord(buf[index + i]))
+    return value
+
+def _append_word(builder, value):
+    # little endian
+    for i in range(8):
+        builder.append(chr(intmask(value & 0xff)))
+        value >>= 8
+
+def _slice(buf, start, stop):
+    if start == 0 and stop == len(buf):
+        return buf
+    assert 0 <= start <= stop
+    return buf[start:stop]
+
 # every word starts out as NORMAL. can transition to IMMUTABLE when used as
 # executable memory, which does not need a version change. transitioning from
 # NORMAL to MUTABLE does not need a version change either. only a transition
-# IMMUTABLE to MUTABLE needs one.
-
-MEM_STATUS_IMMUTABLE = 'i'
-MEM_STATUS_NORMAL = 'n'
-MEM_STATUS_MUTABLE = 'm'
+# IMMUTABLE to MUTABLE needs one. the versions are per page, so that
+# overwriting code on one page does not invalidate the traces that fetched
+# instructions from other pages.
+#
+# the status of every word is stored in two bits, packed into an array of
+# machine words, to keep the overhead small compared to the memory itself.
+
+MEM_STATUS_NORMAL = 0
+MEM_STATUS_IMMUTABLE = 1
+MEM_STATUS_MUTABLE = 2
+
+STATUS_BITS = 2
+STATUS_MASK = (1 << STATUS_BITS) - 1
+STATUS_PER_WORD_BITS = 5 # 32 statuses per 64-bit word
+STATUS_PER_WORD_MASK = (1 << STATUS_PER_WORD_BITS) - 1
 
 class Version(object):
     pass
 
+class Page(object):
+    _immutable_fields_ = ['version?']
+
+    def __init__(self):
+        self.version = Version()
+
 
 class FlatMemory(MemBase):
     SIZE = 64 * 1024 * 1024 // 8 # 64 MB
 
+    # in words, ie 4 KB pages
     PAGE_BITS = 9
     PAGE_SIZE = 1 << 9
     PAGE_MASK = PAGE_SIZE - 1
 
-    _immutable_fields_ = ['mem?', 'version?', 'status']
+    _immutable_fields_ = ['mem?', 'pages[*]', 'status']
 
     def __init__(self, mmap=False, size=SIZE):
         self.size = size
@@ -93,8 +175,14 @@ class FlatMemory(MemBase):
         else:
             mem = [r_uint(0)] * (size // 8)
         self.mem = mem
-        self.status = [MEM_STATUS_NORMAL] * size
-        self.version = Version()
+        num_words = size // 8
+        num_status_words = (num_words + STATUS_PER_WORD_MASK) >> STATUS_PER_WORD_BITS
+        self.status = [r_uint(0)] * num_status_words
+        num_pages = (num_words + self.PAGE_MASK) >> self.PAGE_BITS
+        pages = [None] * num_pages
+        for i in range(num_pages):
+            pages[i] = Page()
+        self.pages = pages
 
         self.mmap = mmap
 
@@ -119,6 +207,23 @@ class FlatMemory(MemBase):
             mask = (r_uint(1) << (num_bytes * 8)) - 1
         return mem_offset, inword_addr, mask
 
+    @always_inline
+    def _get_page(self, mem_offset):
+        return self.pages[mem_offset >> self.PAGE_BITS]
+
+    @always_inline
+    def _read_status(self, mem_offset):
+        word = self.status[mem_offset >> STATUS_PER_WORD_BITS]
+        shift = intmask(mem_offset & STATUS_PER_WORD_MASK) * STATUS_BITS
+        return intmask((word >> shift) & STATUS_MASK)
+
+    @always_inline
+    def _write_status(self, mem_offset, status):
+        index = mem_offset >> STATUS_PER_WORD_BITS
+        shift = intmask(mem_offset & STATUS_PER_WORD_MASK) * STATUS_BITS
+        word = self.status[index] & ~(r_uint(STATUS_MASK) << shift)
+        self.status[index] = word | (r_uint(status) << shift)
+
     def _aligned_read(self, start_addr, num_bytes, executable_flag):
         if executable_flag:
             jit.promote(start_addr)
@@ -127,8 +232,8 @@ class FlatMemory(MemBase):
             self.mark_word_immutable(start_addr)
 
         if (executable_flag and
-                self._get_status_word(mem_offset, self.version) == MEM_STATUS_IMMUTABLE):
-            data = self._immutable_read(mem_offset, self.version)
+                self._get_status_word(mem_offset, self._get_page(mem_offset).version) == MEM_STATUS_IMMUTABLE):
+            data = self._immutable_read(mem_offset, self._get_page(mem_offset).version)
         else:
             data = self.mem[mem_offset]
             if executable_flag:
@@ -140,13 +245,13 @@ class FlatMemory(MemBase):
 
     @jit.elidable_promote('all')
     def _immutable_read(self, mem_offset, version):
-        assert version is self.version
+        assert version is self._get_page(mem_offset).version
         return self.mem[mem_offset]
 
     @jit.elidable_promote('all')
     def _get_status_word(self, mem_offset, version):
-        assert version is self.version
-        return self.status[mem_offset]
+        assert version is self._get_page(mem_offset).version
+        return self._read_status(mem_offset)
 
     def _aligned_write(self, start_addr, num_bytes, value):
         mem_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes)
@@ -161,15 +266,15 @@ class FlatMemory(MemBase):
         self._write_word(mem_offset, (olddata & ~mask) | value)
 
     def _write_word(self, mem_offset, value):
-        if self.status[mem_offset] == MEM_STATUS_IMMUTABLE:
+        if self._read_status(mem_offset) == MEM_STATUS_IMMUTABLE:
             oldval = self.mem[mem_offset]
             if oldval != value:
                 self._invalidate(mem_offset)
         self.mem[mem_offset] = value
 
     def _invalidate(self, mem_offset):
-        self.version = Version()
-        self.status[mem_offset] = MEM_STATUS_MUTABLE
+        self._get_page(mem_offset).version = Version()
+        self._write_status(mem_offset, MEM_STATUS_MUTABLE)
         self._debug_print_invalidating(mem_offset)
 
     @jit.dont_look_inside
@@ -181,11 +286,112 @@ class FlatMemory(MemBase):
     @jit.not_in_trace
     def mark_word_immutable(self, addr):
         mem_offset, inword_addr, mask = self._split_addr(addr, 1)
-        status = self._get_status_word(mem_offset, self.version)
+        status = self._get_status_word(mem_offset, self._get_page(mem_offset).version)
         if status != MEM_STATUS_NORMAL:
             return
         #print "mark_word_immutable", mem_offset
-        self.status[mem_offset] = MEM_STATUS_IMMUTABLE
+        self._write_status(mem_offset, MEM_STATUS_IMMUTABLE)
+
+    def _write_words(self, start_addr, buf, index, num_words):
+        mem_offset = start_addr >> 3
+        for j in range(num_words):
+            self._write_word(mem_offset + j, _bytes_to_word(buf, index + j * 8))
+
+    def _read_words(self, start_addr, num_words, builder):
+        mem_offset = start_addr >> 3
+        for j in range(num_words):
+            _append_word(builder, self.mem[mem_offset + j])
+
+
+class SparseMemory(MemBase):
+    """ A memory of a fixed size that is split into chunks, which are only
+    allocated when they are first written to or executed from. Every chunk is
+    a small FlatMemory, so instruction fetches keep the immutability fast
+    path. Reading from a chunk that was never allocated returns zero. """
+
+    ADDRESS_BITS_CHUNK = 16 # 64 KB
+    CHUNK_SIZE = 2 ** ADDRESS_BITS_CHUNK
+    CHUNK_MASK = CHUNK_SIZE - 1
+
+    _immutable_fields_ = ['chunks']
+
+    def __init__(self, size=FlatMemory.SIZE):
+        assert size & self.CHUNK_MASK == 0
+        self.size = size
+        self.chunks = [None] * (size >> self.ADDRESS_BITS_CHUNK)
+
+    @jit.elidable
+    def _get_chunk(self, chunk_index):
+        chunk = self.chunks[chunk_index]
+        if chunk is None:
+            chunk = self._allocate_chunk(chunk_index)
+        return chunk
+
+    @jit.dont_look_inside
+    def _allocate_chunk(self, chunk_index):
+        chunk = self.chunks[chunk_index] = FlatMemory(False, self.CHUNK_SIZE)
+        return chunk
+
+    def _aligned_read(self, start_addr, num_bytes, executable_flag):
+        chunk_index = start_addr >> self.ADDRESS_BITS_CHUNK
+        if executable_flag:
+            jit.promote(start_addr)
+            # constant-folded, because the address is a constant
+            chunk = self._get_chunk(chunk_index)
+        else:
+            chunk = self.chunks[chunk_index]
+            if chunk is None:
+                return r_uint(0)
+        return chunk._aligned_read(start_addr & self.CHUNK_MASK, num_bytes, executable_flag)
+
+    def _aligned_write(self, start_addr, num_bytes, value):
+        chunk_index = start_addr >> self.ADDRESS_BITS_CHUNK
+        chunk = self.chunks[chunk_index]
+        if chunk is None:
+            chunk = self._allocate_chunk(chunk_index)
+        chunk._aligned_write(start_addr & self.CHUNK_MASK, num_bytes, value)
+
+    def write_bytes(self, start_addr, buf):
+        length = len(buf)
+        i = 0
+        while i < length:
+            addr = start_addr + r_uint(i)
+            chunk_index = addr >> self.ADDRESS_BITS_CHUNK
+            offset = addr & self.CHUNK_MASK
+            stop = min(length, i + self.CHUNK_SIZE - intmask(offset))
+            chunk = self.chunks[chunk_index]
+            if chunk is None:
+                chunk = self._allocate_chunk(chunk_index)
+            chunk.write_bytes(offset, _slice(buf, i, stop))
+            i = stop
+
+    def zero_range(self, start_addr, num_bytes):
+        # chunks that were never allocated read as zero already, so only
+        # clear the ones that exist
+        i = 0
+        while i < num_bytes:
+            addr = start_addr + r_uint(i)
+            offset = addr & self.CHUNK_MASK
+            stop = min(num_bytes, i + self.CHUNK_SIZE - intmask(offset))
+            chunk = self.chunks[addr >> self.ADDRESS_BITS_CHUNK]
+            if chunk is not None:
+                chunk.zero_range(offset, stop - i)
+            i = stop
+
+    def read_bytes(self, start_addr, num_bytes):
+        builder = StringBuilder(num_bytes)
+        i = 0
+        while i < num_bytes:
+            addr = start_addr + r_uint(i)
+            offset = addr & self.CHUNK_MASK
+            stop = min(num_bytes, i + self.CHUNK_SIZE - intmask(offset))
+            chunk = self.chunks[addr >> self.ADDRESS_BITS_CHUNK]
+            if chunk is None:
+                builder.append_multiple_char('\x00', stop - i)
+            else:
+                builder.append(chunk.read_bytes(offset, stop - i))
+            i = stop
+        return builder.build()
 
 
 class BlockMemory(MemBase):
@@ -276,65 +482,193 @@ class BlockMemory(MemBase):
         value <<= inword_addr * 8
         block[block_offset] = (olddata & ~mask) | value
 
+    def _write_words(self, start_addr, buf, index, num_words):
+        if not num_words:
+            return
+        block = self._get_block(start_addr >> self.ADDRESS_BITS_BLOCK)
+        for j in range(num_words):
+            addr = start_addr + j * 8
+            if j and addr & self.BLOCK_MASK == 0:
+                block = self._get_block(addr >> self.ADDRESS_BITS_BLOCK)
+            block[(addr & self.BLOCK_MASK) >> 3] = _bytes_to_word(buf, index + j * 8)
+
+    def _read_words(self, start_addr, num_words, builder):
+        if not num_words:
+            return
+        block = self._get_block(start_addr >> self.ADDRESS_BITS_BLOCK)
+        for j in range(num_words):
+            addr = start_addr + j * 8
+            if j and addr & self.BLOCK_MASK == 0:
+                block = self._get_block(addr >> self.ADDRESS_BITS_BLOCK)
+            _append_word(builder, block[(addr & self.BLOCK_MASK) >> 3])
 
-class SplitMemory(MemBase):
-    # XXX should be generalized to N segments and auto-generated
 
-    _immutable_fields_ = ['mem1', 'address_base1', 'address_end1', 'mem2', 'address_base2', 'address_end2']
+class MemoryRegion(object):
+    """ An address range [start, start + size) of a platform's memory map. If
+    mem is not None, the range is backed by that memory, which is addressed
+    relative to start. """
 
-    def __init__(self, mem1, address_base1, size1, mem2, address_base2, size2):
-        assert self.is_aligned(address_base1)
-        assert self.is_aligned(size1)
+    _immutable_fields_ = ['name', 'start', 'size', 'mem']
+
+    def __init__(self, name, start, size, mem=None):
+        assert size >= 8
         # fits in 63 bit
-        assert not (address_base1 + size1) & (r_uint(1) << 63)
-        self.mem1 = mem1
-        self.address_base1 = intmask(address_base1)
-        self.address_end1 = intmask(address_base1 + size1)
+        assert not (r_uint(start) + r_uint(size)) & (r_uint(1) << 63)
+        self.name = name
+        self.start = r_uint(start)
+        self.size = r_uint(size)
+        self.mem = mem
+
+    @always_inline
+    def contains(self, addr, width):
+        # a single unsigned comparison, addresses below start wrap around to
+        # very big numbers
+        return addr - self.start <= self.size - r_uint(width)
+
+    def __repr__(self):
+        return "<MemoryRegion %s 0x%x-0x%x>" % (
+            self.name, self.start, self.start + self.size)
+
+
+class MemoryMap(object):
+    """ A list of non-overlapping MemoryRegions, sorted by address. While
+    tracing, every lookup remembers the region that the instruction at pc
+    accessed. The JIT constant-folds that region per pc, so an access to the
+    same region as during tracing costs a single range check, independently
+    of the number of regions. """
+
+    _immutable_fields_ = ['regions[*]']
+
+    def __init__(self, regions):
+        assert regions
+        for index in range(1, len(regions)):
+            prev = regions[index - 1]
+            assert prev.start + prev.size <= regions[index].start
+        self.regions = regions[:]
+        self._likely_index = 0
+
+    @jit.not_in_trace
+    def _observe(self, pc, addr, width):
+        index = self.find_index(addr, width)
+        if index >= 0:
+            self._likely_index = index
+
+    @jit.elidable
+    def _get_likely_index(self, pc):
+        # not really elidable, but the result is only used to produce guards.
+        # the JIT records the result per pc, so every instruction of a trace
+        # gets the region that it accessed while tracing
+        return self._likely_index
 
-        assert self.is_aligned(address_base2)
-        assert self.is_aligned(size2)
-        assert not (address_base2 + size2) & (r_uint(1) << 63)
-        self.mem2 = mem2
-        self.address_base2 = intmask(address_base2)
-        self.address_end2 = intmask(address_base2 + size2)
+    @jit.dont_look_inside
+    def find_index(self, addr, width):
+        for index, region in enumerate(self.regions):
+            if region.contains(addr, width):
+                return index
+        return -1
 
-    def _not_huge(self, start_addr):
-        # highest bit as a unsigned int not set
-        return not (start_addr & (r_uint(1)<<63))
+    @always_inline
+    def lookup_likely(self, addr, width, pc):
+        """ Return the index of the region that the instruction at pc accessed
+        while tracing, if it contains the width bytes starting at addr as
+        well, otherwise -1. """
+        self._observe(pc, addr, width)
+        index = self._get_likely_index(pc)
+        if self.regions[index].contains(addr, width):
+            return index
+        return -1
 
-    def check_mem1(self, start_addr):
-        return self._not_huge(start_addr) and (self.address_base1 <= intmask(start_addr) < self.address_end1)
+    @always_inline
+    def lookup(self, addr, width, pc):
+        """ Return the index of the region that contains the width bytes
+        starting at addr, or -1. pc is the address of the instruction that
+        makes the access. """
+        if jit.we_are_jitted():
+            index = self.lookup_likely(addr, width, pc)
+            if index >= 0:
+                return index
+        return self.find_index(addr, width)
 
-    def check_mem1_fast(self, start_addr):
-        return self._not_huge(start_addr) and (intmask(start_addr) < self.address_end1)
 
-    def check_mem2(self, start_addr):
-        return self._not_huge(start_addr) and (self.address_base2 <= intmask(start_addr) < self.address_end2)
+class SplitMemory(MemBase):
+    """ Dispatches accesses to several memories, each mapped to its own range
+    of addresses. The guest accesses should go through read_from and
+    write_from, which get the pc of the accessing instruction to find the
+    region quickly in the JIT, see MemoryMap. """
+
+    _immutable_fields_ = ['memory_map']
+
+    def __init__(self, regions):
+        for region in regions:
+            assert region.mem is not None
+            assert self.is_aligned(region.start)
+            assert self.is_aligned(region.size)
+        self.memory_map = MemoryMap(regions)
+
+    @always_inline
+    def _get_region(self, index):
+        if index < 0:
+            raise ValueError
+        return self.memory_map.regions[index]
+
+    @always_inline
+    def _find_region(self, start_addr, num_bytes):
+        # without a pc there is nothing to key the JIT's guess by
+        return self._get_region(self.memory_map.find_index(start_addr, num_bytes))
+
+    @always_inline
+    def read_from(self, pc, start_addr, num_bytes, executable_flag=False):
+        region = self._get_region(self.memory_map.lookup(start_addr, num_bytes, pc))
+        return region.mem.read(start_addr - region.start, num_bytes, executable_flag)
+
+    @always_inline
+    def write_from(self, pc, start_addr, num_bytes, value):
+        region = self._get_region(self.memory_map.lookup(start_addr, num_bytes, pc))
+        region.mem.write(start_addr - region.start, num_bytes, value)
 
     def _aligned_read(self, start_addr, num_bytes, executable_flag):
         if executable_flag:
             jit.promote(start_addr)
-        if self.address_base1:
-            if self.check_mem1(start_addr):
-                return self.mem1._aligned_read(start_addr - self.address_base1, num_bytes, executable_flag)
-        else:
-            if self.check_mem1_fast(start_addr):
-                return self.mem1._aligned_read(start_addr, num_bytes, executable_flag)
-        if self.check_mem2(start_addr):
-            return self.mem2._aligned_read(start_addr - self.address_base2, num_bytes, executable_flag)
-        raise ValueError
+        region = self._find_region(start_addr, num_bytes)
+        return region.mem._aligned_read(start_addr - region.start, num_bytes, executable_flag)
 
     def _aligned_write(self, start_addr, num_bytes, value):
-        if self.address_base1:
-            if self.check_mem1(start_addr):
-                return self.mem1._aligned_write(start_addr - self.address_base1, num_bytes, value)
-        else:
-            if self.check_mem1_fast(start_addr):
-                return self.mem1._aligned_write(start_addr, num_bytes, value)
-        if self.check_mem2(start_addr):
-            return self.mem2._aligned_write(start_addr - self.address_base2, num_bytes, value)
-        raise ValueError
+        region = self._find_region(start_addr, num_bytes)
+        return region.mem._aligned_write(start_addr - region.start, num_bytes, value)
+
+    def write_bytes(self, start_addr, buf):
+        length = len(buf)
+        i = 0
+        while i < length:
+            addr = start_addr + r_uint(i)
+            region = self._find_region(addr, 1)
+            offset = addr - region.start
+            stop = min(length, i + intmask(region.size - offset))
+            region.mem.write_bytes(offset, _slice(buf, i, stop))
+            i = stop
+
+    def zero_range(self, start_addr, num_bytes):
+        i = 0
+        while i < num_bytes:
+            addr = start_addr + r_uint(i)
+            region = self._find_region(addr, 1)
+            offset = addr - region.start
+            stop = min(num_bytes, i + intmask(region.size - offset))
+            region.mem.zero_range(offset, stop - i)
+            i = stop
+
+    def read_bytes(self, start_addr, num_bytes):
+        builder = StringBuilder(num_bytes)
+        i = 0
+        while i < num_bytes:
+            addr = start_addr + r_uint(i)
+            region = self._find_region(addr, 1)
+            offset = addr - region.start
+            stop = min(num_bytes, i + intmask(region.size - offset))
+            builder.append(region.mem.read_bytes(offset, stop - i))
+            i = stop
+        return builder.build()
 
     def close(self):
-        self.mem1.close()
-        self.mem2.close()
+        for region in self.memory_map.regions:
+            region.mem.close()
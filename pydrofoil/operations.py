@@ -63,15 +63,25 @@ class __extend__(types.BigFixedBitVector):
 
     def packed_field_read(self, sarg):
         assert "." in sarg
+        if self.width <= 128:
+            # two words, no list needed
+            names = "(%s, %s_low, %s_high)" % (self.width, sarg, sarg)
+            return "bitvector.TwoWordBitVector" + names
         names = "(%s, %s_val, %s_data)" % (self.width, sarg, sarg)
         return "bitvector.BitVector.unpack" + names
 
     def packed_field_write(self, lhs, rhs):
+        if self.width <= 128:
+            names = "(%s_low, %s_high)" % (lhs, lhs)
+            return "%s = %s.two_words()" % (names, rhs)
         names = "(%s_val, %s_data)" % (lhs, lhs)
         return "%s = %s.pack()[1:]" % (names, rhs)
 
     def packed_field_copy(self, lhs, rhs):
-        names = "(%s_val, %s_data)"
+        if self.width <= 128:
+            names = "(%s_low, %s_high)"
+        else:
+            names = "(%s_val, %s_data)"
         return "%s = %s" % (names % (lhs, lhs), names % (rhs, rhs))
 
 
@@ -147,6 +147,44 @@ class File(BaseAst):
     def __init__(self, declarations, sourcepos=None):
         self.declarations = declarations
 
+    def remove_unreachable_functions(self, entrypoints):
+        """ Remove the function declarations that can't be called, directly
+        or indirectly, from any of the entrypoints or from the bodies of
+        registers and lets. Returns the number of removed functions. """
+        functions = {}
+        todo = list(entrypoints)
+        for decl in self.declarations:
+            if isinstance(decl, Function):
+                functions[decl.name] = decl
+            elif isinstance(decl, (Register, Let)) and decl.body is not None:
+                todo.extend(_collect_names(decl.body))
+        reachable = set()
+        while todo:
+            name = todo.pop()
+            if name in reachable or name not in functions:
+                continue
+            reachable.add(name)
+            todo.extend(_collect_names(functions[name].body))
+        numdecls = len(self.declarations)
+        self.declarations = [decl for decl in self.declarations
+                             if not isinstance(decl, Function) or decl.name in reachable]
+        return numdecls - len(self.declarations)
+
+def _collect_names(ast):
+    # over-approximates the called functions by collecting all the strings in
+    # the ast, which includes the names of all the called functions
+    res = set()
+    todo = [ast]
+    while todo:
+        value = todo.pop()
+        if isinstance(value, str):
+            res.add(value)
+        elif isinstance(value, (list, tuple)):
+            todo.extend(value)
+        elif isinstance(value, BaseAst):
+            todo.extend(value.__dict__.itervalues())
+    return res
+
 class Declaration(BaseAst):
     pass
 
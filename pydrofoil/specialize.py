@@ -1,4 +1,7 @@
+import os
 import sys
+import cPickle
+import hashlib
 from collections import defaultdict
 from pydrofoil import types, ir, parse, supportcode, bitvector
 
@@ -149,7 +152,7 @@ class Specializer(object):
         if nameextension is not None:
             graph.name += "__" + nameextension
             ir.remove_dead(graph, self.codegen)
-        if ir.should_inline(graph, self.codegen.should_inline):
+        if ir.should_inline(graph, self.codegen.should_inline, self.codegen.call_profile):
             self.codegen.inlinable_functions[graph.name] = graph
         self.codegen.schedule_graph_specialization(graph)
         self.codegen.specialization_functions[graph.name] = self
@@ -318,6 +321,10 @@ SPECIALIZABLE_BUILTINS = frozenset("""
 
 @ir.repeat
 def split_for_arg_constness(graph, codegen):
+    call_profile = getattr(codegen, "call_profile", None)
+    if call_profile is not None and call_profile.is_cold(graph.name):
+        # never executed in the profiled run, don't duplicate its calls
+        return False
     for block in graph.iterblocks():
         for index, op in enumerate(block.operations):
             if not isinstance(op, ir.Operation):
@@ -369,15 +376,81 @@ def split_for_arg_constness(graph, codegen):
                 phi = ir.Phi(prevblocks, callvalues[copied_op], copied_op.resolved_type)
                 switchblock.operations.insert(0, phi)
                 replacements[copied_op] = phi
+            graph.cfg_changed()
             graph.replace_ops(replacements)
             return True
     return False
 
 
+# don't bother forking workers for fewer graphs than that
+MIN_PARALLEL_BATCH = 4
+MAX_BATCH_PER_PROCESS = 8
+
+# how often the range summary of a graph can get more precise, to make sure
+# that the rescheduling of its callers terminates
+MAX_RETURN_RANGE_UPDATES = 4
+
+class _WorkerState(object):
+    # set before forking the worker processes, which inherit it
+    codegen = None
+    batch = None
+
+_worker_state = _WorkerState()
+
+def _optimize_in_worker(index):
+    return _worker_state.codegen._optimize_isolated(_worker_state.batch[index])
+
+def _called_graph_names(graph, all_graph_by_name):
+    res = set()
+    for op, _ in graph.iterblockops():
+        if isinstance(op, ir.Operation) and op.name in all_graph_by_name:
+            res.add(op.name)
+    return res
+
+
+def _structural_key(graph):
+    """ A key that is equal for two graphs if they compute the same thing in
+    the same way. It ignores the graph name, the argument names and the
+    source positions and variable names of the operations. """
+    _, argdata, blockdata, has_loop = ir.serialize_graph(graph)
+    blocks = []
+    for opsdata, nextdata in blockdata:
+        ops = []
+        for opdata in opsdata:
+            if opdata[0] is ir.Phi:
+                ops.append(opdata)
+            else:
+                ops.append(opdata[:4]) # strip sourcepos and varname_hint
+        if nextdata[0] is not ir.JustStop:
+            nextdata = nextdata[:-1] # strip sourcepos
+        blocks.append((ops, nextdata))
+    return repr(([typ for _, typ in argdata], blocks, has_loop))
+
+def _function_source_fingerprint(func):
+    """ Hash the source file that defines the function func, so that changing
+    any data in that module that func depends on changes the result. """
+    if func is None:
+        return "None"
+    code = getattr(func, "__code__", None)
+    if code is None:
+        code = getattr(getattr(func, "__func__", None), "__code__", None)
+    if code is None:
+        return repr(func)
+    h = hashlib.sha1(code.co_name)
+    try:
+        with open(code.co_filename, "rb") as f:
+            h.update(f.read())
+    except IOError:
+        h.update(code.co_code)
+        h.update(repr(code.co_consts))
+    return h.hexdigest()
+
+
 class FixpointSpecializer(object):
     should_inline = None
+    call_profile = None # a callprofile.CallProfile or None
 
-    def __init__(self, entrypoints=None):
+    def __init__(self, entrypoints=None, parallelism=None, graph_cache_dir=None):
         import collections
         import py
         self.specialization_todo = collections.deque()
@@ -386,7 +459,19 @@ class FixpointSpecializer(object):
         self.specialization_functions = {}
         self.all_graph_by_name = {}
         self.inline_dependencies = defaultdict(set) # graph -> {graphs}
+        # summaries of the ranges of the results of graphs, see absinterp
+        self.return_ranges = {} # name -> Range
+        self.return_range_dependencies = defaultdict(set) # name -> {graphs}
+        self._return_range_updates = defaultdict(int)
         self.program_entrypoints = entrypoints
+        # number of worker processes used by specialize_all, None or 1 means
+        # optimize everything in this process
+        self.parallelism = parallelism
+        # directory of the persistent cache of optimized graphs, or None
+        self.graph_cache_dir = graph_cache_dir
+        self._graph_cache_info = {} # graph -> (content hash, called names)
+        self._source_fingerprint = None
+        self._config_fingerprint = None
         # attributes for printing
         self._highlevel_task_msg = ''
         self._terminal_columns = py.io.get_terminal_width()
@@ -401,35 +486,378 @@ class FixpointSpecializer(object):
         assert oldname != graph.name
         del self.all_graph_by_name[oldname]
         self.all_graph_by_name[graph.name] = graph
+        self._graph_cache_info.pop(graph, None)
         self.specialization_functions[graph.name] = self.specialization_functions[oldname]
 
     def specialize_all(self):
-        import sys
         todo = self.specialization_todo
         while todo:
+            if self.parallelism is not None and self.parallelism > 1 and hasattr(os, "fork"):
+                batch = self._independent_todo_prefix()
+                if len(batch) >= MIN_PARALLEL_BATCH:
+                    self._optimize_batch_in_parallel(batch)
+                    continue
             graph = todo.popleft()
             self.print_highlevel_task("(todo: %s) OPTIMIZING %s" % (len(todo), graph.name))
             self.specialization_todo_set.remove(graph)
-            changed = ir.optimize(graph, self)
-            schedule_deps = None
-            if changed and graph.name in self.specialization_functions:
-                spec = self.specialization_functions[graph.name]
-                if spec.graph is graph:
+            changed = self._optimize_graph(graph)
+            self._finish_optimized_graph(graph, changed)
+
+    def _optimize_graph(self, graph):
+        key = self._graph_cache_key(graph)
+        if key is not None:
+            result = self._graph_cache_load(key)
+            if result is not None:
+                return self._apply_optimization_result(graph, result)
+        state = self._shared_state_size()
+        changed = ir.optimize(graph, self)
+        if key is not None and self._shared_state_size() == state:
+            self._graph_cache_store(key, self._optimization_result(graph, changed))
+        return changed
+
+    def _finish_optimized_graph(self, graph, changed):
+        self._graph_cache_info.pop(graph, None)
+        self._update_return_range(graph)
+        schedule_deps = None
+        if changed and graph.name in self.specialization_functions:
+            spec = self.specialization_functions[graph.name]
+            if spec.graph is graph:
+                return
+            if ir.should_inline(graph, self.should_inline, self.call_profile):
+                self.inlinable_functions[graph.name] = graph
+                schedule_deps = spec.dependencies
+            elif spec.check_return_type_change(graph):
+                schedule_deps = spec.dependencies
+        elif changed and graph.name not in self.inlinable_functions:
+            if ir.should_inline(graph, self.should_inline, self.call_profile):
+                self.inlinable_functions[graph.name] = graph
+                schedule_deps = self.inline_dependencies[graph.name]
+        if schedule_deps:
+            self._schedule_again(schedule_deps)
+
+    def _schedule_again(self, graphs):
+        for othergraph in graphs:
+            if othergraph not in self.specialization_todo_set:
+                self.specialization_todo.append(othergraph)
+                self.specialization_todo_set.add(othergraph)
+
+    def _update_return_range(self, graph):
+        """ Recompute the range summary of the results of graph. If it got
+        more precise, the graphs that used the old summary are optimized
+        again. """
+        from pydrofoil.absinterp import compute_return_range
+        if self._return_range_updates[graph.name] >= MAX_RETURN_RANGE_UPDATES:
+            return
+        res = compute_return_range(graph, self)
+        if res is None:
+            return
+        old = self.return_ranges.get(graph.name, None)
+        if old is not None:
+            # every version of the graph computes the same function, so both
+            # ranges are correct and the intersection is too
+            res = res.intersect(old)
+            if res == old:
+                return
+        self.return_ranges[graph.name] = res
+        self._return_range_updates[graph.name] += 1
+        self._schedule_again(self.return_range_dependencies[graph.name])
+
+    # parallel optimization: a prefix of the todo queue where no graph depends
+    # on any of the others (see _optimization_dependencies) can be optimized in forked worker processes, each
+    # seeing exactly the state it would have seen when optimizing the queue
+    # sequentially. the workers send back the optimized graphs and the
+    # dependencies they recorded; a worker that had to change shared state
+    # (eg by creating a new specialization) sends back nothing and the graph
+    # is optimized again in the parent, in queue order. that way the result is
+    # the same as the one of the sequential loop.
+
+    def _independent_todo_prefix(self):
+        batch = []
+        batch_names = set()
+        batch_callees = set()
+        maxsize = self.parallelism * MAX_BATCH_PER_PROCESS
+        for graph in self.specialization_todo:
+            if len(batch) >= maxsize:
+                break
+            callees = self._optimization_dependencies(graph)
+            if graph.name in batch_callees or not callees.isdisjoint(batch_names):
+                break
+            batch.append(graph)
+            batch_names.add(graph.name)
+            batch_callees.update(callees)
+        return batch
+
+    def _optimization_dependencies(self, graph):
+        """ The names of the graphs whose current state can influence the
+        optimization of graph: the graphs it calls, all the existing
+        specializations of the specialization functions it calls and,
+        transitively, the dependencies of the inlinable functions among
+        those, which can be inlined into graph. """
+        res = set()
+        todo = [graph]
+        while todo:
+            callgraph = todo.pop()
+            for name in _called_graph_names(callgraph, self.all_graph_by_name):
+                names = [name]
+                spec = self.specialization_functions.get(name, None)
+                if spec is not None:
+                    names.append(spec.graph.name)
+                    for value in spec.cache.itervalues():
+                        if value is not None:
+                            names.append(value[0].name)
+                for name in names:
+                    if name in res:
+                        continue
+                    res.add(name)
+                    inlinable = self.inlinable_functions.get(name, None)
+                    if inlinable is not None and inlinable is not graph:
+                        todo.append(inlinable)
+        return res
+
+    def _optimize_batch_in_parallel(self, batch):
+        import multiprocessing
+        todo = self.specialization_todo
+        for graph in batch:
+            assert todo.popleft() is graph
+        self.print_highlevel_task("(todo: %s) OPTIMIZING %s GRAPHS IN PARALLEL" % (len(todo), len(batch)))
+        _worker_state.codegen = self
+        _worker_state.batch = batch
+        # every worker handles a single graph, so that all of them are forked
+        # from the unchanged state of this process
+        pool = multiprocessing.Pool(min(self.parallelism, len(batch)), maxtasksperchild=1)
+        try:
+            results = pool.map(_optimize_in_worker, range(len(batch)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _worker_state.codegen = None
+            _worker_state.batch = None
+        for graph, result in zip(batch, results):
+            self.specialization_todo_set.remove(graph)
+            if result is None:
+                self.print_highlevel_task("(todo: %s) OPTIMIZING %s" % (len(todo), graph.name))
+                changed = self._optimize_graph(graph)
+            else:
+                changed = self._apply_worker_result(graph, result)
+            self._finish_optimized_graph(graph, changed)
+
+    def _optimize_isolated(self, graph):
+        """ Optimize graph in a worker process. Returns None if the
+        optimization had effects on the codegen that can't be sent back to the
+        parent process. """
+        state = self._shared_state_size()
+        timings = ir.TIMINGS.copy()
+        counts = ir.COUNTS.copy()
+        try:
+            changed = self._optimize_graph(graph)
+        except Exception:
+            return None # the parent will redo it and report the error
+        if self._shared_state_size() != state:
+            return None
+        timings = {name: t - timings.get(name, 0.0) for name, t in ir.TIMINGS.iteritems()}
+        counts = {name: c - counts.get(name, 0) for name, c in ir.COUNTS.iteritems()}
+        return cPickle.dumps((self._optimization_result(graph, changed),
+                              timings, counts), -1)
+
+    def _apply_worker_result(self, graph, result):
+        result, timings, counts = cPickle.loads(result)
+        for name, t in timings.iteritems():
+            ir.TIMINGS[name] += t
+        for name, c in counts.iteritems():
+            ir.COUNTS[name] += c
+        return self._apply_optimization_result(graph, result)
+
+    def _shared_state_size(self):
+        # optimizing a graph must not have changed any of these for its result
+        # to be usable outside of the current process
+        return (len(self.all_graph_by_name), len(self.specialization_todo),
+                len(getattr(self, "declarations", ())))
+
+    def _optimization_result(self, graph, changed):
+        inline_deps = [name for name, graphs in self.inline_dependencies.iteritems()
+                       if graph in graphs]
+        spec_deps = [name for name, spec in self.specialization_functions.iteritems()
+                     if graph in spec.dependencies]
+        range_deps = [name for name, graphs in self.return_range_dependencies.iteritems()
+                      if graph in graphs]
+        return ir.serialize_graph(graph), changed, inline_deps, spec_deps, range_deps
+
+    def _apply_optimization_result(self, graph, result):
+        data, changed, inline_deps, spec_deps, range_deps = result
+        newgraph = ir.deserialize_graph(data)
+        assert newgraph.name == graph.name
+        graph.args = newgraph.args
+        graph.startblock = newgraph.startblock
+        graph.has_loop = newgraph.has_loop
+        for name in inline_deps:
+            self.inline_dependencies[name].add(graph)
+        for name in spec_deps:
+            self.specialization_functions[name].dependencies.add(graph)
+        for name in range_deps:
+            self.return_range_dependencies[name].add(graph)
+        return changed
+
+    # persistent graph cache: the result of optimizing a graph is stored on
+    # disk, keyed by a hash of the unoptimized graph together with the
+    # current state of all the graphs it can (transitively) call, inline or
+    # specialize against, and of the source code of pydrofoil. only results
+    # of optimizations that didn't change the shared state of the codegen
+    # (see _shared_state_size) are stored, so replaying them is equivalent to
+    # optimizing again.
+
+    def _graph_cache_key(self, graph):
+        if self.graph_cache_dir is None:
+            return None
+        parts = [self._get_source_fingerprint(), self._get_config_fingerprint(),
+                 self._graph_content_hash(graph)]
+        seen = {graph.name}
+        todo = list(self._graph_called_names(graph))
+        while todo:
+            name = todo.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            calledgraph = self.all_graph_by_name.get(name)
+            if calledgraph is not None:
+                parts.append("graph %s %s" % (name, self._graph_content_hash(calledgraph)))
+                todo.extend(self._graph_called_names(calledgraph))
+            inlinegraph = self.inlinable_functions.get(name)
+            if inlinegraph is not None:
+                parts.append("inline %s %s" % (name, self._graph_content_hash(inlinegraph)))
+                todo.extend(self._graph_called_names(inlinegraph))
+            if name in self.return_ranges:
+                parts.append("range %s %r" % (name, self.return_ranges[name]))
+            spec = self.specialization_functions.get(name)
+            if spec is not None:
+                todo.append(spec.graph.name)
+                variants = []
+                for key, value in spec.cache.iteritems():
+                    if value is None:
+                        variants.append((repr(key), None))
+                    else:
+                        stubgraph, restype = value
+                        variants.append((repr(key), stubgraph.name, repr(restype)))
+                        todo.append(stubgraph.name)
+                parts.append("spec %s %s %s" % (name, spec.graph.name, sorted(variants)))
+        parts.sort()
+        return hashlib.sha1("\n".join(parts)).hexdigest()
+
+    def _get_source_fingerprint(self):
+        if self._source_fingerprint is None:
+            h = hashlib.sha1()
+            dirname = os.path.dirname(os.path.abspath(__file__))
+            for filename in sorted(os.listdir(dirname)):
+                if filename.endswith(".py"):
+                    with open(os.path.join(dirname, filename), "rb") as f:
+                        h.update(filename)
+                        h.update(f.read())
+            h.update(repr(sorted(getattr(self, "builtin_names", {}).items())))
+            self._source_fingerprint = "source " + h.hexdigest()
+        return self._source_fingerprint
+
+    def _get_config_fingerprint(self):
+        """ A hash of the model-specific configuration that influences the
+        optimization results: the should_inline hook (decides which new
+        specializations are inlinable), identified by the source of the module
+        that defines it, the promoted registers, whether calls are
+        instrumented (which disables inlining) and the contents of the call
+        profile (which drives inlining and specialization). """
+        if self._config_fingerprint is None:
+            h = hashlib.sha1()
+            h.update(_function_source_fingerprint(self.should_inline))
+            h.update(repr(sorted(getattr(self, "promoted_registers", ()))))
+            h.update(repr(bool(getattr(self, "instrument_calls", False))))
+            if self.call_profile is not None:
+                h.update(self.call_profile.fingerprint())
+            self._config_fingerprint = "config " + h.hexdigest()
+        return self._config_fingerprint
+
+    def _get_graph_cache_info(self, graph):
+        info = self._graph_cache_info.get(graph)
+        if info is None:
+            contenthash = hashlib.sha1(repr(ir.serialize_graph(graph))).hexdigest()
+            names = set()
+            for op, _ in graph.iterblockops():
+                if isinstance(op, ir.Operation) and (
+                        op.name in self.all_graph_by_name or
+                        op.name in self.inlinable_functions or
+                        op.name in self.specialization_functions):
+                    names.add(op.name)
+            info = contenthash, names
+            self._graph_cache_info[graph] = info
+        return info
+
+    def _graph_content_hash(self, graph):
+        return self._get_graph_cache_info(graph)[0]
+
+    def _graph_called_names(self, graph):
+        return self._get_graph_cache_info(graph)[1]
+
+    def _graph_cache_load(self, key):
+        filename = os.path.join(self.graph_cache_dir, key + ".pickle")
+        try:
+            with open(filename, "rb") as f:
+                return cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def _graph_cache_store(self, key, result):
+        if not os.path.isdir(self.graph_cache_dir):
+            try:
+                os.makedirs(self.graph_cache_dir)
+            except OSError:
+                pass # created concurrently
+        filename = os.path.join(self.graph_cache_dir, key + ".pickle")
+        # write to a temporary file first, several processes can write the
+        # same entry at the same time
+        tmpfilename = "%s.%s.tmp" % (filename, os.getpid())
+        with open(tmpfilename, "wb") as f:
+            cPickle.dump(result, f, -1)
+        os.rename(tmpfilename, filename)
+
+    def deduplicate_specialized_graphs(self, keep_graphs):
+        """ Specializations of a function can end up with the same body after
+        optimization, e.g. because a constant argument was folded away.
+        Redirect all calls to one canonical copy and forget about the others.
+        Repeat until nothing changes, because redirecting the calls can make
+        the callers identical too. Graphs in keep_graphs are never removed.
+        Returns the number of removed graphs. """
+        keep_graphs = set(keep_graphs)
+        removed = 0
+        while 1:
+            groups = defaultdict(list)
+            for name, graph in self.all_graph_by_name.iteritems():
+                if graph in keep_graphs:
+                    continue
+                spec = self.specialization_functions.get(name)
+                if spec is None or name not in spec.name_to_restyp:
+                    continue
+                key = (spec.name_to_restyp[name], _structural_key(graph))
+                groups[key].append(graph)
+            replacements = {}
+            for graphs in groups.itervalues():
+                if len(graphs) == 1:
                     continue
-                if ir.should_inline(graph, self.should_inline):
-                    self.inlinable_functions[graph.name] = graph
-                    schedule_deps = spec.dependencies
-                elif spec.check_return_type_change(graph):
-                    schedule_deps = spec.dependencies
-            elif changed and graph.name not in self.inlinable_functions:
-                if ir.should_inline(graph, self.should_inline):
-                    self.inlinable_functions[graph.name] = graph
-                    schedule_deps = self.inline_dependencies[graph.name]
-            if schedule_deps:
-                for othergraph in schedule_deps:
-                    if othergraph not in self.specialization_todo_set:
-                        todo.append(othergraph)
-                        self.specialization_todo_set.add(othergraph)
+                graphs.sort(key=lambda graph: (len(graph.name), graph.name))
+                canonical = graphs[0]
+                for graph in graphs[1:]:
+                    replacements[graph.name] = canonical.name
+            if not replacements:
+                return removed
+            for name in replacements:
+                self.print_debug_msg("DEDUPLICATED", name, "->", replacements[name])
+                graph = self.all_graph_by_name.pop(name)
+                self.inlinable_functions.pop(name, None)
+                self._graph_cache_info.pop(graph, None)
+                removed += 1
+            for graph in self.all_graph_by_name.itervalues():
+                changed = False
+                for op, _ in graph.iterblockops():
+                    if isinstance(op, ir.Operation) and op.name in replacements:
+                        op.name = replacements[op.name]
+                        changed = True
+                if changed:
+                    self._graph_cache_info.pop(graph, None)
 
     def extract_needed_extra_graphs(self, starting_graphs):
         result = set()
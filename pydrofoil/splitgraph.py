@@ -119,6 +119,7 @@ def split_graph(graph, codegen, functyp, next_name, min_size, start_block=None):
     newblock.next = ir.Return(op)
     for block in calling_blocks:
         block.next.replace_next(transferblock, newblock)
+    graph.cfg_changed()
 
     replacements = {}
     newargs = []
@@ -244,6 +244,10 @@ def eq_bits(machine, gvba, gvbb):
 def eq_bits_bv_bv(machine, bva, bvb):
     return bva == bvb
 
+@purefunction
+def ult_bits_bv_bv(machine, bva, bvb):
+    return bva < bvb
+
 @purefunction
 def neq_bits(machine, gvba, gvbb):
     return not gvba.eq(gvbb)
@@ -900,6 +904,36 @@ def helper_vector_update_inplace_o_i_o(machine, vec, index, element):
         raise TypeError
     vec[index] = element
 
+# subranges of registers stored in a bitvector.BitVectorRegister, see
+# ir.use_register_storage. regname is the (constant) attribute name of the
+# register on the machine
+
+@objectmodel.always_inline
+@objectmodel.specialize.arg(1)
+def helper_register_update_subrange_o_i_i_o(machine, regname, n, m, s):
+    getattr(machine, regname).update_subrange(n, m, s)
+    return ()
+
+@objectmodel.always_inline
+@objectmodel.specialize.arg(1)
+def helper_register_subrange_o_i_i(machine, regname, n, m):
+    return getattr(machine, regname).subrange(n, m)
+
+@objectmodel.always_inline
+@objectmodel.specialize.arg(1)
+def helper_register_subrange_o_i_i_unwrapped_res(machine, regname, n, m):
+    return getattr(machine, regname).subrange_unwrapped_res(n, m)
+
+@objectmodel.always_inline
+@objectmodel.specialize.arg(1)
+def helper_register_slice_o_i_i(machine, regname, start, length):
+    return getattr(machine, regname).subrange(start + length - 1, start)
+
+@objectmodel.always_inline
+@objectmodel.specialize.arg(1)
+def helper_register_slice_o_i_i_unwrapped_res(machine, regname, start, length):
+    return getattr(machine, regname).subrange_unwrapped_res(start + length - 1, start)
+
 @objectmodel.specialize.argtype(2)
 def undefined_vector(machine, size, element):
     return [element] * size.toint()
@@ -1313,12 +1347,13 @@ def _platform_write_mem_slowpath(machine, mem, write_kind, addr, n, data):
     #    import pdb; pdb.set_trace()
     start = 0
     stop = 7
+    buf = ['\x00'] * n
     for i in range(n):
-        byte = data.subrange_unwrapped_res(stop, start)
-        mem.write(addr + i, 1, byte)
+        buf[i] = chr(intmask(data.subrange_unwrapped_res(stop, start)))
         stop += 8
         start += 8
     assert start == data.size()
+    mem.write_bytes(addr, "".join(buf))
 
 # isla stuff
 
@@ -1374,9 +1409,29 @@ class RegistersBase(object):
     throw_location = None
     current_exception = None
 
+    # set by code that was generated with instrument_calls=True
+    _call_profile_keys = None
+    _call_profile_counts = None
+
     def __init__(self):
         pass
 
+    def write_call_profile(self, filename):
+        """ Write the call counts to filename, in the format that
+        pydrofoil.callprofile reads. Returns False if the code was generated
+        without call counting. """
+        keys = self._call_profile_keys
+        counts = self._call_profile_counts
+        if keys is None or counts is None:
+            return False
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            for i in range(len(keys)):
+                os.write(fd, "%s %s\n" % (keys[i], counts[i]))
+        finally:
+            os.close(fd)
+        return True
+
 class ObjectBase(object):
     _attrs_ = []
 
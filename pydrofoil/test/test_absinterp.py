@@ -1,5 +1,6 @@
 from pydrofoil.absinterp import analyze, BOOL, UNBOUNDED, TRUE, FALSE, MACHINEINT, Range
-from pydrofoil.absinterp import optimize_with_range_info
+from pydrofoil.absinterp import optimize_with_range_info, compute_return_range
+from pydrofoil.absinterp import KnownBits, optimize_with_known_bits
 from pydrofoil.test.test_ir import compare, FakeCodeGen
 
 from pydrofoil.types import *
@@ -721,3 +722,91 @@ i3 = block0.emit(Operation, '@shl_int_i_i_must_fit', [i2, MachineIntConstant(2)]
 block0.next = Return(i3, None)
 graph = Graph('g', [v], block0)
 """)
+
+def test_compute_return_range():
+    b = Argument("b", Bool())
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block1.next = ConditionalGoto(b, block2, block3)
+    block2.next = Return(MachineIntConstant(1))
+    block3.next = Return(MachineIntConstant(5))
+    g = Graph('g', [b], block1)
+    assert compute_return_range(g, fakecodegen) == Range(1, 5)
+
+def test_compute_return_range_nothing_known():
+    i = Argument("i", MachineInt())
+    block1 = Block()
+    block1.next = Return(i)
+    g = Graph('g', [i], block1)
+    assert compute_return_range(g, fakecodegen) is None
+
+def test_call_uses_return_range():
+    class SummaryCodeGen(FakeCodeGen):
+        return_ranges = {"zf": Range(0, 10)}
+        return_range_dependencies = defaultdict(set)
+    codegen = SummaryCodeGen()
+    block1 = Block()
+    i1 = block1.emit(Operation, "zf", [], Int())
+    i2 = block1.emit(Operation, "int_to_int64", [i1], MachineInt())
+    block1.next = Return(i2)
+    g = Graph('g', [], block1)
+    values = analyze(g, codegen)
+    assert values[block1][i1] == Range(0, 10)
+    assert values[block1][i2] == Range(0, 10)
+    assert codegen.return_range_dependencies["zf"] == {g}
+    # the call itself stays, it could have side effects
+    optimize_with_range_info(g, codegen)
+    assert i1 in block1.operations
+
+def test_range_intersect():
+    assert Range(0, 10).intersect(Range(5, None)) == Range(5, 10)
+    assert Range(None, 10).intersect(Range(None, 3)) == Range(None, 3)
+    assert UNBOUNDED.intersect(Range(1, 2)) == Range(1, 2)
+
+def test_known_bits():
+    a = KnownBits(8, 0b11110000, 0b00000101)
+    assert a.and_(KnownBits.fromconst(8, 0b1111)) == KnownBits(8, 0b11110000, 0b0101)
+    assert a.or_(KnownBits.fromconst(8, 0b10)) == KnownBits(8, 0b11110000, 0b0111)
+    assert a.invert() == KnownBits(8, 0b00000101, 0b11110000)
+    assert a.lshift(4) == KnownBits(8, 0b1111, 0b01010000)
+    assert a.rshift(4) == KnownBits(8, 0b11111111, 0)
+    assert a.subrange(3, 2) == KnownBits(2, 0, 0b01)
+    assert a.concat(KnownBits.fromconst(2, 0b10)) == KnownBits(10, 0b1111000001, 0b0000010110)
+    assert a.zero_extend(10) == KnownBits(10, 0b1111110000, 0b0101)
+    assert KnownBits(4, 0, 0b1000).sign_extend(6) == KnownBits(6, 0, 0b111000)
+    assert a.eq(KnownBits.fromconst(8, 0b1)) == FALSE
+    assert a.eq(KnownBits.fromconst(8, 0b1101)) == BOOL
+    assert KnownBits.fromconst(8, 3).eq(KnownBits.fromconst(8, 3)) == TRUE
+
+def test_known_bits_decode():
+    x = Argument('x', SmallFixedBitVector(32))
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    opcode = block1.emit(Operation, '@vector_subrange_fixed_bv_i_i', [x, MachineIntConstant(6), MachineIntConstant(0)], SmallFixedBitVector(7))
+    cond = block1.emit(Operation, '@eq_bits_bv_bv', [opcode, SmallBitVectorConstant(0b0110011, SmallFixedBitVector(7))], Bool())
+    block1.next = ConditionalGoto(cond, block2, block3)
+    low = block2.emit(Operation, '@vector_subrange_fixed_bv_i_i', [x, MachineIntConstant(1), MachineIntConstant(0)], SmallFixedBitVector(2))
+    cond2 = block2.emit(Operation, '@eq_bits_bv_bv', [low, SmallBitVectorConstant(0b11, SmallFixedBitVector(2))], Bool())
+    block2.next = Return(cond2)
+    block3.next = Return(BooleanConstant.FALSE)
+    g = Graph('g', [x], block1)
+    assert optimize_with_known_bits(g, fakecodegen)
+    assert block2.next.value is BooleanConstant.TRUE
+    assert not block2.operations
+
+def test_known_bits_superfluous_mask():
+    x = Argument('x', SmallFixedBitVector(8))
+    block1 = Block()
+    i1 = block1.emit(Operation, '@zero_extend_bv_i_i', [x, MachineIntConstant(8), MachineIntConstant(32)], SmallFixedBitVector(32))
+    i2 = block1.emit(Operation, '@and_vec_bv_bv', [i1, SmallBitVectorConstant(0xffff, SmallFixedBitVector(32))], SmallFixedBitVector(32))
+    i3 = block1.emit(Operation, '@shiftl_bv_i', [i2, MachineIntConstant(32), MachineIntConstant(8)], SmallFixedBitVector(32))
+    i4 = block1.emit(Operation, '@and_vec_bv_bv', [i3, SmallBitVectorConstant(0xff, SmallFixedBitVector(32))], SmallFixedBitVector(32))
+    block1.next = Return(i4)
+    g = Graph('g', [x], block1)
+    assert optimize_with_known_bits(g, fakecodegen)
+    assert block1.operations == [i1, i3]
+    assert i3.args[0] is i1
+    assert isinstance(block1.next.value, SmallBitVectorConstant)
+    assert block1.next.value.value == 0
@@ -0,0 +1,50 @@
+import json
+
+from pydrofoil import benchmark, ir
+
+
+def make_report(time=1.0, rss=1000, passtime=1.0, ops=100, lines=500):
+    return {"version": benchmark.REPORT_VERSION, "models": {"m": {
+        "phases": {"parse": {"time": time, "peak_rss_kb": rss}},
+        "total_time": time,
+        "passes": {"localopt": {"time": passtime, "iterations": 5, "ops_before": 10, "ops_after": 5}},
+        "graphs": {"number": 3, "blocks": 10, "ops": ops},
+        "output_lines": lines,
+    }}}
+
+def test_compare_reports():
+    baseline = make_report()
+    assert benchmark.compare_reports(baseline, make_report()) == []
+    assert benchmark.compare_reports(baseline, make_report(time=1.2)) == []
+    regressions = benchmark.compare_reports(baseline, make_report(time=2.0))
+    assert regressions == ["m total time: 1.00 -> 2.00 (+100.0%)",
+                           "m parse time: 1.00 -> 2.00 (+100.0%)"]
+    regressions = benchmark.compare_reports(baseline, make_report(rss=2000, ops=200, lines=1000, passtime=3.0))
+    assert len(regressions) == 4
+    # faster is fine
+    assert benchmark.compare_reports(baseline, make_report(time=0.1, passtime=0.1)) == []
+    # too short to compare
+    assert benchmark.compare_reports(make_report(time=0.01), make_report(time=0.1)) == []
+    # models that are not in the baseline are ignored
+    assert benchmark.compare_reports({"models": {}}, make_report()) == []
+
+def test_benchmark_nand(tmpdir):
+    model, = [model for model in benchmark.MODELS if model.name == "nand2tetris"]
+    assert model.available()
+    report = benchmark.run([model], fresh_process=False)
+    result = report["models"]["nand2tetris"]
+    assert set(result["phases"]) == {"parse", "infer", "build_ssa", "specialize", "emit"}
+    assert result["graphs"]["number"] > 0
+    assert result["output_lines"] > 100
+    assert "localopt" in result["passes"]
+    # passes that don't run via repeat are timed too
+    for name in ["sccp", "gvn", "licm", "optimize_with_known_bits", "compile_decision_trees"]:
+        assert result["passes"][name]["iterations"] > 0
+    assert not ir.MEASURE_GRAPH_SIZES
+    # the report is json and can be used as a baseline
+    filename = str(tmpdir.join("report.json"))
+    assert benchmark.main(["benchmark", "nand2tetris", "-o", filename]) == 0
+    with open(filename) as f:
+        baseline = json.load(f)
+    assert set(baseline["models"]["nand2tetris"]["passes"]) == set(result["passes"])
+    assert benchmark.compare_reports(baseline, baseline) == []
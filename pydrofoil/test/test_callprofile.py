@@ -0,0 +1,77 @@
+from pydrofoil.callprofile import CallProfile, base_name
+from pydrofoil import supportcode
+from pydrofoil.types import *
+from pydrofoil.ir import *
+
+PROFILE = """
+# a comment
+f zmain 1
+f zhot 100000
+f zhot_specialized_o_1 50000
+f zonce 7
+f zwarm 3
+f zcold 0
+c zmain zhot 100000
+c zmain zonce 7
+c zmain zwarm 1
+c zhot zwarm 1
+c zonce zwarm 1
+c zwarm zhot 3
+"""
+
+def test_base_name():
+    assert base_name("zfoo") == "zfoo"
+    assert base_name("zfoo_specialized_o_1__i") == "zfoo"
+
+def test_parse():
+    profile = CallProfile.parse(PROFILE)
+    assert profile.count("zhot") == 150000
+    assert profile.count("zhot_specialized_bv64") == 150000
+    assert profile.count("zunknown") == 0
+    assert profile.number_of_callers("zwarm") == 3
+    assert profile.number_of_callers("zonce") == 1
+    assert profile.is_cold("zcold")
+    assert not profile.is_cold("zunknown")
+    assert not profile.is_cold("zwarm")
+    assert profile.is_hot("zhot")
+    assert not profile.is_hot("zwarm")
+
+def test_parse_error():
+    import pytest
+    with pytest.raises(ValueError):
+        CallProfile.parse("f zfoo\n")
+
+def test_should_inline():
+    profile = CallProfile.parse(PROFILE)
+    assert profile.should_inline("zcold", 1, 1) is False
+    assert profile.should_inline("zunknown", 1, 1) is None
+    assert profile.should_inline("zonce", 20, 150) is True
+    assert profile.should_inline("zonce", 30, 500) is None
+    assert profile.should_inline("zwarm", 1, 1) is None
+    assert profile.should_inline("zhot", 5, 40) is True
+    assert profile.should_inline("zhot", 5, 100) is None
+    assert CallProfile().should_inline("zhot", 1, 1) is None
+
+def test_should_inline_graph():
+    profile = CallProfile.parse(PROFILE)
+    a = Argument('a', MachineInt())
+    block = Block()
+    i1 = block.emit(Operation, '@add_i_i_must_fit', [a, MachineIntConstant(1)], MachineInt(), None, None)
+    block.next = Return(i1)
+    assert should_inline(Graph('zcold', [a], block))
+    assert not should_inline(Graph('zcold', [a], block), None, profile)
+    assert should_inline(Graph('zwarm', [a], block), None, profile)
+    # the model specific decision wins
+    assert should_inline(Graph('zcold', [a], block), lambda name: True, profile)
+
+def test_write_call_profile(tmpdir):
+    class Machine(supportcode.RegistersBase):
+        pass
+    filename = str(tmpdir.join("profile"))
+    assert not Machine().write_call_profile(filename)
+    Machine._call_profile_keys = ["f zmain", "f zfoo", "c zmain zfoo"]
+    Machine._call_profile_counts = [1, 12, 12]
+    assert Machine().write_call_profile(filename)
+    profile = CallProfile.read(filename)
+    assert profile.count("zfoo") == 12
+    assert profile.site_counts == {("zmain", "zfoo"): 12}
@@ -0,0 +1,210 @@
+from contextlib import contextmanager
+
+from pydrofoil.emitfunction import CodeEmitter, structure_graph
+from pydrofoil.types import *
+from pydrofoil.ir import *
+
+
+class FakeCodeGen(object):
+    builtin_names = {}
+
+    def __init__(self):
+        self.code = []
+        self.level = 0
+
+    @contextmanager
+    def emit_indent(self, line=None):
+        if line is not None:
+            self.emit(line)
+        self.level += 1
+        yield
+        self.level -= 1
+
+    def emit(self, line=''):
+        self.code.append("    " * self.level + line)
+
+def make_function(graph):
+    codegen = FakeCodeGen()
+    with codegen.emit_indent("def f(machine, %s):" % (
+            ", ".join(arg.name for arg in graph.args))):
+        CodeEmitter(graph, None, codegen).emit()
+    source = "\n".join(codegen.code)
+    d = {}
+    exec source in d
+    return d['f'], source
+
+
+def make_if_else():
+    a = Argument('a', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block0.next = ConditionalGoto(a, block1, block2)
+    block1.next = Goto(block3)
+    block2.next = Goto(block3)
+    i1 = block3.emit_phi([block1, block2], [MachineIntConstant(1), MachineIntConstant(2)], MachineInt())
+    block3.next = Return(i1)
+    return Graph('f', [a], block0)
+
+def test_if_else():
+    graph = make_if_else()
+    f, source = make_function(graph)
+    assert "while 1:" not in source
+    assert "else:" in source
+    assert f(None, True) == 1
+    assert f(None, False) == 2
+
+def test_if_return_stays_flat():
+    a = Argument('a', Bool())
+    b = Argument('b', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block4 = Block()
+    block0.next = ConditionalGoto(a, block1, block2)
+    block1.next = Return(MachineIntConstant(1))
+    block2.next = ConditionalGoto(b, block3, block4)
+    block3.next = Return(MachineIntConstant(2))
+    block4.next = Return(MachineIntConstant(3))
+    graph = Graph('f', [a, b], block0)
+    f, source = make_function(graph)
+    assert "else:" not in source
+    assert f(None, True, False) == 1
+    assert f(None, False, True) == 2
+    assert f(None, False, False) == 3
+
+def test_loop():
+    a = Argument('a', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block0.next = Goto(block1)
+    i1 = block1.emit_phi([block0, block2], [a, BooleanConstant.FALSE], Bool())
+    i2 = block1.emit_phi([block0, block2], [MachineIntConstant(0), MachineIntConstant(1)], MachineInt())
+    block1.next = ConditionalGoto(i1, block2, block3)
+    block2.next = Goto(block1)
+    block3.next = Return(i2)
+    graph = Graph('f', [a], block0, True)
+    f, source = make_function(graph)
+    assert "pc = " not in source
+    assert source.count("while 1:") == 1
+    assert f(None, True) == 1
+    assert f(None, False) == 0
+
+def test_structure_loop():
+    a = Argument('a', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block0.next = Goto(block1)
+    block1.next = ConditionalGoto(a, block1, block2)
+    block2.next = Return(None)
+    graph = Graph('f', [a], block0, True)
+    assert structure_graph(graph) == [
+        ("block", block0),
+        ("loop", [("block", block1), ("if", block1, [("continue", )], [("break", )])]),
+        ("block", block2),
+        ("next", block2),
+    ]
+
+def test_irreducible_falls_back_to_dispatch():
+    a = Argument('a', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    # the cycle block1 <-> block2 can be entered at both blocks
+    block0.next = ConditionalGoto(a, block1, block2)
+    block1.next = ConditionalGoto(a, block2, block3)
+    block2.next = Goto(block1)
+    block3.next = Return(MachineIntConstant(5))
+    graph = Graph('f', [a], block0, True)
+    assert structure_graph(graph) is None
+    f, source = make_function(graph)
+    assert "pc = 0" in source
+    assert f(None, False) == 5
+
+def test_if_with_empty_arms():
+    # remove_critical_edges inserts empty else blocks, and the then blocks
+    # contain only comments
+    a = Argument('a', Bool())
+    b = Argument('b', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block4 = Block()
+    block0.next = ConditionalGoto(a, block1, block2)
+    block1.emit(Comment, 'only a comment', [], Unit(), None, None)
+    block1.next = Goto(block2)
+    block2.next = ConditionalGoto(b, block3, block4)
+    block3.emit(Comment, 'only a comment', [], Unit(), None, None)
+    block3.next = Goto(block4)
+    block4.next = Return(MachineIntConstant(5))
+    graph = Graph('f', [a, b], block0)
+    f, source = make_function(graph)
+    assert "else:" not in source
+    assert f(None, True, False) == 5
+    assert f(None, False, True) == 5
+
+def test_instrument_calls():
+    class InstrumentingCodeGen(FakeCodeGen):
+        instrument_calls = True
+
+        def emit_call_counter(self, *names):
+            self.emit("counts.append(%r)" % (names, ))
+    codegen = InstrumentingCodeGen()
+    graph = make_if_else()
+    with codegen.emit_indent("def f(machine, counts, a):"):
+        CodeEmitter(graph, None, codegen).emit()
+    d = {}
+    exec "\n".join(codegen.code) in d
+    counts = []
+    assert d['f'](None, counts, True) == 1
+    assert counts == [('f', )]
+
+def test_unboxed_int_arguments():
+    from pydrofoil.makecode import NameInfo
+    x = Argument('x', Int())
+    block = Block()
+    block.next = Return(x)
+    callee = Graph('g', [x], block)
+
+    class UnboxingCodeGen(FakeCodeGen):
+        builtin_names = {"zz5i64zDzKz5i": "int64_to_int"}
+        all_graph_by_name = {"g": callee}
+        unboxed_int_graphs = {callee}
+        functyp = Function(Tuple((Int(), )), Int())
+        globalnames = {
+            "g": NameInfo("g", functyp, None),
+            "zz5i64zDzKz5i": NameInfo("supportcode.int64_to_int", functyp, None),
+        }
+
+        def getname(self, name):
+            return self.globalnames[name].pyname
+
+        def getinfo(self, name):
+            return self.globalnames[name]
+
+    a = Argument('a', MachineInt())
+    b = Argument('b', Int())
+    block = Block()
+    i1 = block.emit(Operation, 'zz5i64zDzKz5i', [a], Int())
+    i2 = block.emit(Operation, 'g', [i1], Int())
+    block.emit(Operation, 'g', [b], Int())
+    block.emit(Operation, 'g', [IntConstant(5)], Int())
+    block.next = Return(i2)
+    graph = Graph('f', [a, b], block)
+    codegen = UnboxingCodeGen()
+    with codegen.emit_indent("def f(machine, a, b):"):
+        CodeEmitter(graph, None, codegen).emit()
+    source = "\n".join(codegen.code)
+    # the machine int is passed without making an Int box for it
+    assert "supportcode.int64_to_int" not in source
+    assert "g(machine, a, None)" in source
+    assert "ival_0, idata_0 = b.pack()" in source
+    assert "g(machine, ival_0, idata_0)" in source
+    assert "g(machine, 5, None)" in source
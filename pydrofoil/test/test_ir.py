@@ -33,6 +33,59 @@ def compare(graph, expected):
         print got
     assert got == expected
 
+def compare_structurally(graph1, graph2):
+    """ Check that graph1 and graph2 are the same graph, by walking both of
+    them in parallel. Unlike comparing the output of print_graph_construction,
+    this does not depend on the order in which the blocks are printed. """
+    assert len(graph1.args) == len(graph2.args)
+    valuemap = {}
+    for arg1, arg2 in zip(graph1.args, graph2.args):
+        assert arg1.name == arg2.name
+        assert arg1.resolved_type == arg2.resolved_type
+        valuemap[arg1] = arg2
+    blockmap = {graph1.startblock: graph2.startblock}
+    todo = [graph1.startblock]
+    while todo:
+        block1 = todo.pop()
+        block2 = blockmap[block1]
+        assert len(block1.operations) == len(block2.operations)
+        for op1, op2 in zip(block1.operations, block2.operations):
+            assert type(op1) is type(op2)
+            valuemap[op1] = op2
+        assert type(block1.next) is type(block2.next)
+        targets1 = block1.next.next_blocks()
+        targets2 = block2.next.next_blocks()
+        assert len(targets1) == len(targets2)
+        for target1, target2 in zip(targets1, targets2):
+            if target1 in blockmap:
+                assert blockmap[target1] is target2
+            else:
+                blockmap[target1] = target2
+                todo.append(target1)
+
+    def compare_values(values1, values2):
+        assert len(values1) == len(values2)
+        for value1, value2 in zip(values1, values2):
+            if isinstance(value1, Constant):
+                assert value1.comparison_key() == value2.comparison_key()
+            elif value1 is None:
+                assert value2 is None
+            else:
+                assert valuemap[value1] is value2
+
+    for block1, block2 in blockmap.items():
+        for op1, op2 in zip(block1.operations, block2.operations):
+            assert op1.resolved_type == op2.resolved_type
+            if isinstance(op1, Phi):
+                assert [blockmap[prevblock] for prevblock in op1.prevblocks] == op2.prevblocks
+            else:
+                assert op1.name == op2.name
+                assert op1.sourcepos == op2.sourcepos
+                assert op1.varname_hint == op2.varname_hint
+            compare_values(op1.getargs(), op2.getargs())
+        assert block1.next.sourcepos == block2.next.sourcepos
+        compare_values(block1.next.getargs(), block2.next.getargs())
+
 
 def make_bits_to_bool():
     zb = Argument('zb', SmallFixedBitVector(1))
@@ -3234,6 +3287,49 @@ def test_compute_dominators():
     assert invdoms[block4] == {block5, block4}
     assert invdoms[block1] == {block1, block2, block4, block5}
 
+def test_analysis_cache():
+    i = Argument('i', MachineInt())
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    i1 = block1.emit(Operation, '@eq', [i, MachineIntConstant(32)], Bool(), None, None)
+    block1.next = ConditionalGoto(i1, block2, block3)
+    block2.next = Goto(block3)
+    block3.next = Return(i)
+    g = Graph("g", [i], block1)
+    doms = compute_dominators(g)
+    assert doms[block3] == {block1, block3}
+    assert compute_dominators(g) is doms
+    entrymap = g.make_entrymap()
+    assert set(entrymap[block3]) == {block1, block2}
+    # the entrymap is a copy that can be changed
+    entrymap[block3].append(block3)
+    assert set(g.make_entrymap()[block3]) == {block1, block2}
+    # changing a target and calling cfg_changed invalidates the cache
+    block1.next.falsetarget = block2
+    g.cfg_changed()
+    assert compute_dominators(g)[block3] == {block1, block2, block3}
+    assert set(g.make_entrymap()[block3]) == {block2}
+    assert topo_order(g) == [block1, block2, block3]
+    # forgetting to call it is found by check
+    block1.next = Goto(block3)
+    with pytest.raises(AssertionError):
+        g.check()
+    g.cfg_changed()
+    g.check()
+    assert compute_dominators(g)[block3] == {block1, block3}
+    assert topo_order(g) == [block1, block3]
+    assert g.immediate_dominators() == {block1: block1, block3: block1}
+    # and a new startblock
+    g.startblock = block2
+    assert g.immediate_dominators() == {block2: block2, block3: block2}
+    # changing the operations or making new blocks keeps the cache
+    doms = compute_dominators(g)
+    block3.operations.append(Operation('foo', [], Unit()))
+    block3.operations = []
+    Block().next = Goto(block3)
+    assert compute_dominators(g) is doms
+
 def test_use_equality_information():
     i = Argument('i', MachineInt())
     block1 = Block()
@@ -3991,3 +4087,367 @@ block0 = Block()
 block0.next = Return(a, None)
 graph = Graph('f', [a], block0)
 ''')
+
+
+def test_serialize_graph_roundtrip():
+    import cPickle
+    zxs = Argument('zxs', SmallFixedBitVector(8))
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block4 = Block()
+    i0 = block0.emit(GlobalRead, 'zflag', [], Bool(), None, None)
+    block0.next = ConditionalGoto(i0, block1, block4, '`1 1:1')
+    i1 = block1.emit_phi([block0, block3], [SmallBitVectorConstant(0x00, SmallFixedBitVector(8)), None], SmallFixedBitVector(8))
+    i2 = block1.emit_phi([block0, block3], [MachineIntConstant(0), None], MachineInt())
+    i3 = block1.emit(Operation, '@gt', [i2, MachineIntConstant(7)], Bool(), '`1 279:2-280:19', None)
+    block1.next = ConditionalGoto(i3, block2, block3, '`1 279:2-280:19')
+    block2.next = Return(i1, None)
+    i4 = block3.emit(Operation, '@vector_access_bv_i', [zxs, i2], SmallFixedBitVector(1), '`1 280:12-280:19', 'zz47')
+    i5 = block3.emit(Operation, '$zupdate_fbits', [i1, i2, i4], SmallFixedBitVector(8), '`1 280:4-280:9', 'zz410')
+    i6 = block3.emit(Cast, '$cast', [i5], GenericBitVector(), None, None)
+    i1.prevvalues[1] = i5
+    i7 = block3.emit(Operation, '@iadd', [i2, MachineIntConstant(1)], MachineInt(), '`1 279:2-280:19', 'zz45')
+    i2.prevvalues[1] = i7
+    block3.next = Goto(block1, None)
+    block4.next = Raise(StringConstant('fail'), None)
+    graph = Graph('zreverse_bits_in_byte', [zxs], block0, True)
+
+    data = cPickle.dumps(serialize_graph(graph), -1)
+    newgraph = deserialize_graph(cPickle.loads(data))
+    newgraph.check()
+    assert newgraph.has_loop
+    compare_structurally(graph, newgraph)
+    newcast = [op for op, _ in newgraph.iterblockops() if isinstance(op, Cast)]
+    assert len(newcast) == 1
+    assert newcast[0].resolved_type is GenericBitVector()
+
+def test_localoptimizer_only_some_blocks():
+    zx = Argument('zx', MachineInt())
+    block0 = Block()
+    block1 = Block()
+    i1 = block0.emit(Cast, '$cast', [zx], MachineInt(), None, None)
+    block0.next = Goto(block1, None)
+    i2 = block1.emit(Operation, 'zf', [i1, zx], Unit(), None, None)
+    i3 = block1.emit(Cast, '$cast', [zx], MachineInt(), None, None)
+    i4 = block1.emit(Operation, 'zg', [i3, i3], Int(), None, None)
+    block1.next = Return(i4, None)
+    graph = Graph('f', [zx], block0)
+    opt = LocalOptimizer(graph, fakecodegen)
+    assert opt.optimize({block1})
+    assert block0.operations == [i1]
+    assert i2.args == [i1, zx]
+    assert i4.args == [zx, zx]
+    assert opt.changed_blocks == {block1}
+
+    opt = LocalOptimizer(graph, fakecodegen)
+    assert opt.optimize({block0})
+    assert block0.operations == []
+    # the user of the replaced cast in the other block is marked as changed
+    assert i2.args == [zx, zx]
+    assert opt.changed_blocks == {block0, block1}
+
+def test_sccp_loop():
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block0.next = Goto(block1, None)
+    i1 = block1.emit_phi([block0, block2], [BooleanConstant.FALSE, None], Bool())
+    block1.next = ConditionalGoto(i1, block3, block2, None)
+    i3 = block2.emit(Operation, '@not', [i1], Bool(), None, None)
+    i4 = block2.emit(Operation, '@not', [i3], Bool(), None, None)
+    i5 = block2.emit(Operation, 'zf', [i3], Unit(), None, None)
+    i1.prevvalues[1] = i4
+    block2.next = Goto(block1, None)
+    block3.next = Return(UnitConstant.UNIT, None)
+    graph = Graph('f', [], block0, has_loop=True)
+    assert sccp(graph, fakecodegen)
+    assert block1.operations == []
+    assert isinstance(block1.next, Goto) and block1.next.target is block2
+    assert block2.operations == [i5]
+    assert i5.args == [BooleanConstant.TRUE]
+    assert not sccp(graph, fakecodegen)
+
+def test_sccp_not_constant():
+    zb = Argument('zb', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block0.next = ConditionalGoto(zb, block1, block2, None)
+    block1.next = Goto(block2, None)
+    i1 = block2.emit_phi([block0, block1], [BooleanConstant.FALSE, BooleanConstant.TRUE], Bool())
+    block2.next = Return(i1, None)
+    graph = Graph('f', [zb], block0)
+    assert not sccp(graph, fakecodegen)
+    assert block2.operations == [i1]
+
+def test_sccp_folds_arithmetic():
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block0.next = Goto(block1, None)
+    i1 = block1.emit_phi([block0, block2], [MachineIntConstant(0), None], MachineInt())
+    i2 = block1.emit(Operation, '@gt', [i1, MachineIntConstant(5)], Bool(), None, None)
+    block1.next = ConditionalGoto(i2, block3, block2, None)
+    i3 = block2.emit(Operation, '@add_i_i_must_fit', [i1, MachineIntConstant(0)], MachineInt(), None, None)
+    i4 = block2.emit(Operation, 'zf', [i3], Unit(), None, None)
+    i1.prevvalues[1] = i3
+    block2.next = Goto(block1, None)
+    block3.next = Return(UnitConstant.UNIT, None)
+    graph = Graph('f', [], block0, has_loop=True)
+    assert sccp(graph, fakecodegen)
+    assert block1.operations == []
+    assert isinstance(block1.next, Goto) and block1.next.target is block2
+    assert block2.operations == [i4]
+    assert i4.args[0].number == 0
+
+def test_gvn_loop_header():
+    zb = Argument('zb', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    i1 = block0.emit(Operation, '@not', [zb], Bool(), None, None)
+    i2 = block0.emit(Operation, 'zf', [i1], Unit(), None, None)
+    block0.next = Goto(block1, None)
+    i3 = block1.emit(Operation, '@not', [zb], Bool(), None, None)
+    block1.next = ConditionalGoto(i3, block2, block3, None)
+    i4 = block2.emit(Operation, '@not', [zb], Bool(), None, None)
+    i5 = block2.emit(Operation, 'zf', [i4], Unit(), None, None)
+    block2.next = Goto(block1, None)
+    block3.next = Return(i3, None)
+    graph = Graph('f', [zb], block0, has_loop=True)
+    assert gvn(graph, fakecodegen)
+    assert block1.operations == []
+    assert block2.operations == [i5]
+    assert i5.args == [i1]
+    assert block1.next.booleanvalue is i1
+    assert block3.next.value is i1
+    assert not gvn(graph, fakecodegen)
+    graph.check()
+
+def test_gvn_no_sibling_replacement():
+    zb = Argument('zb', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block0.next = ConditionalGoto(zb, block1, block2, None)
+    i1 = block1.emit(Operation, '@not', [zb], Bool(), None, None)
+    block1.next = Return(i1, None)
+    i2 = block2.emit(Operation, '@not', [zb], Bool(), None, None)
+    block2.next = Return(i2, None)
+    graph = Graph('f', [zb], block0)
+    assert not gvn(graph, fakecodegen)
+
+def test_licm():
+    zb = Argument('zb', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block0.next = Goto(block1, None)
+    i1 = block1.emit_phi([block0, block2], [MachineIntConstant(0), None], MachineInt())
+    i2 = block1.emit(GlobalRead, 'zR', [], MachineInt(), None, None)
+    i3 = block1.emit(Operation, '@not', [zb], Bool(), None, None)
+    block1.next = ConditionalGoto(i3, block2, block3, None)
+    i4 = block2.emit(Operation, 'zf', [i1, i2], MachineInt(), None, None)
+    i1.prevvalues[1] = i4
+    block2.next = Goto(block1, None)
+    block3.next = Return(i1, None)
+    graph = Graph('f', [zb], block0, has_loop=True)
+    assert licm(graph, fakecodegen)
+    assert block0.operations == [i3]
+    # zf could write the register
+    assert block1.operations == [i1, i2]
+    assert not licm(graph, fakecodegen)
+    graph.check()
+
+def test_licm_global_read_new_preheader():
+    zb = Argument('zb', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block0.next = ConditionalGoto(zb, block1, block3, None)
+    i1 = block1.emit_phi([block0, block2], [BooleanConstant.FALSE, None], Bool())
+    i2 = block1.emit(GlobalRead, 'zR', [], Bool(), None, None)
+    block1.next = ConditionalGoto(i1, block3, block2, None)
+    i3 = block2.emit(Operation, '@not', [i2], Bool(), None, None)
+    i1.prevvalues[1] = i3
+    block2.next = Goto(block1, None)
+    block3.next = Return(UnitConstant.UNIT, None)
+    graph = Graph('f', [zb], block0, has_loop=True)
+    assert licm(graph, fakecodegen)
+    preheader = block0.next.truetarget
+    assert preheader is not block1
+    assert preheader.operations == [i2]
+    assert preheader.next.target is block1
+    assert i1.prevblocks == [preheader, block2]
+    assert block1.operations == [i1]
+    graph.check()
+
+def test_licm_nested_loops():
+    zb = Argument('zb', Bool())
+    zc = Argument('zc', Bool())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    block3 = Block()
+    block4 = Block()
+    block5 = Block()
+    block0.next = Goto(block1, None)
+    # outer loop header
+    i1 = block1.emit(GlobalRead, 'zR', [], Bool(), None, None)
+    block1.next = ConditionalGoto(zb, block2, block5, None)
+    # only reachable from the inner loop through its new preheader
+    block2.emit(GlobalWrite, 'zR', [zc], Bool(), None, None)
+    block2.next = ConditionalGoto(zc, block3, block5, None)
+    # inner loop header
+    i2 = block3.emit(GlobalRead, 'zS', [], Bool(), None, None)
+    block3.next = ConditionalGoto(zc, block4, block1, None)
+    i3 = block4.emit(Operation, '@not', [i2], Bool(), None, None)
+    block4.next = Goto(block3, None)
+    block5.next = Return(i1, None)
+    graph = Graph('f', [zb, zc], block0, has_loop=True)
+    assert licm(graph, fakecodegen)
+    preheader = block2.next.truetarget
+    assert preheader is not block3
+    assert preheader.operations == [i2]
+    # the outer loop writes zR, its read stays in the loop
+    assert block1.operations == [i1]
+    assert block0.operations == []
+    graph.check()
+
+def test_compile_decision_trees():
+    zop = Argument('zop', SmallFixedBitVector(32))
+    block0 = Block()
+    i1 = block0.emit(Operation, '@vector_subrange_fixed_bv_i_i', [zop, MachineIntConstant(6), MachineIntConstant(0)], SmallFixedBitVector(7))
+    # 0x13 is there twice, the second comparison can never be true
+    constants = [0x33, 0x13, 0x03, 0x23, 0x37, 0x17, 0x6f, 0x67, 0x63, 0x13, 0x73]
+    returnblock = Block()
+    chainblocks = [block0] + [Block() for const in constants[1:]]
+    lastblock = Block()
+    for index, const in enumerate(constants):
+        block = chainblocks[index]
+        nextblock = (chainblocks + [lastblock])[index + 1]
+        cond = block.emit(Operation, '@eq_bits_bv_bv', [i1, SmallBitVectorConstant(const, SmallFixedBitVector(7))], Bool())
+        block.next = ConditionalGoto(cond, returnblock, nextblock)
+    lastblock.next = Goto(returnblock)
+    # all the comparisons jump to the same block, with different values
+    values = [MachineIntConstant(index) for index in range(len(constants))]
+    phi = returnblock.emit_phi(chainblocks + [lastblock], values + [MachineIntConstant(-1)], MachineInt())
+    returnblock.next = Return(phi)
+    graph = Graph('g', [zop], block0)
+    graph.check()
+
+    def run(x):
+        env = {i1: r_uint(x)}
+        block = graph.startblock
+        prevblock = None
+        count = 0
+        while 1:
+            for op in block.operations:
+                if isinstance(op, Phi):
+                    env[op] = op.prevvalues[op.prevblocks.index(prevblock)]
+                elif op.name == '@eq_bits_bv_bv':
+                    count += 1
+                    env[op] = env[op.args[0]] == op.args[1].value
+                elif op.name == '@ult_bits_bv_bv':
+                    count += 1
+                    env[op] = env[op.args[0]] < op.args[1].value
+            prevblock = block
+            if isinstance(block.next, Return):
+                return env[block.next.value].number, count
+            if isinstance(block.next, Goto):
+                block = block.next.target
+            elif env[block.next.booleanvalue]:
+                block = block.next.truetarget
+            else:
+                block = block.next.falsetarget
+
+    expected = [constants.index(x) if x in constants else -1 for x in range(128)]
+    assert [run(x)[0] for x in range(128)] == expected
+    assert compile_decision_trees(graph, fakecodegen)
+    graph.check()
+    assert [run(x)[0] for x in range(128)] == expected
+    assert max(run(x)[1] for x in range(128)) <= 5
+
+def test_ir_classes_have_no_instance_dict():
+    import cPickle
+    a = Argument('a', MachineInt())
+    block = Block()
+    op = block.emit(FieldAccess, 'zfield', [a], MachineInt(), None, None)
+    block.next = Return(op)
+    graph = Graph('f', [a], block)
+    for value in [a, op, block, block.next, MachineIntConstant(1), SmallBitVectorConstant(1, SmallFixedBitVector(4)),
+                  BooleanConstant.TRUE, UnitConstant.UNIT, Phi([block], [a], MachineInt())]:
+        assert not hasattr(value, '__dict__')
+    assert type(op) is FieldAccess
+    # the serialized form of graphs, with the constants in it, can be pickled
+    data = serialize_graph(graph)
+    assert repr(cPickle.loads(cPickle.dumps(data, -1))) == repr(data)
+
+def test_use_register_storage():
+    class StorageCodeGen(FakeCodeGen):
+        storage_registers = {"zvr": "_reg_zvr"}
+    typ = BigFixedBitVector(256)
+    zs = Argument('zs', SmallFixedBitVector(8))
+    block = Block()
+    i1 = block.emit(GlobalRead, 'zvr', [], typ)
+    i2 = block.emit(Cast, '$cast', [i1], GenericBitVector())
+    i3 = block.emit(Operation, '@vector_subrange_o_i_i_unwrapped_res', [i2, MachineIntConstant(15), MachineIntConstant(8)], SmallFixedBitVector(8))
+    i4 = block.emit(Cast, '$cast', [zs], GenericBitVector())
+    i5 = block.emit(Operation, '@vector_update_subrange_o_i_i_o', [i2, MachineIntConstant(7), MachineIntConstant(0), i4], GenericBitVector())
+    i6 = block.emit(Cast, '$cast', [i5], typ)
+    block.emit(GlobalWrite, 'zvr', [i6], typ)
+    block.next = Return(i3)
+    graph = Graph('f', [zs], block)
+    assert use_register_storage(graph, StorageCodeGen())
+    graph.check()
+    compare(graph, """
+zs = Argument('zs', SmallFixedBitVector(8))
+block0 = Block()
+i1 = block0.emit(Operation, '@helper_register_subrange_o_i_i_unwrapped_res', [StringConstant('_reg_zvr'), MachineIntConstant(15), MachineIntConstant(8)], SmallFixedBitVector(8), None, None)
+i2 = block0.emit(Cast, '$cast', [zs], GenericBitVector(), None, None)
+i3 = block0.emit(Operation, '@helper_register_update_subrange_o_i_i_o', [StringConstant('_reg_zvr'), MachineIntConstant(7), MachineIntConstant(0), i2], Unit(), None, None)
+block0.next = Return(i1, None)
+graph = Graph('f', [zs], block0)
+""")
+
+def test_use_register_storage_keeps_unrelated_ops():
+    class StorageCodeGen(FakeCodeGen):
+        storage_registers = {"zvr": "_reg_zvr"}
+    typ = BigFixedBitVector(256)
+    zs = Argument('zs', SmallFixedBitVector(8))
+    zg = Argument('zg', GenericBitVector())
+    block = Block()
+    i1 = block.emit(GlobalRead, 'zvr', [], typ)
+    i2 = block.emit(Cast, '$cast', [i1], GenericBitVector())
+    i3 = block.emit(Operation, '@vector_subrange_o_i_i_unwrapped_res', [i2, MachineIntConstant(15), MachineIntConstant(8)], SmallFixedBitVector(8))
+    # unused before the rewrite, not the business of use_register_storage
+    i4 = block.emit(Cast, '$cast', [zs], GenericBitVector())
+    i5 = block.emit(Operation, '@vector_update_subrange_o_i_i_o', [zg, MachineIntConstant(7), MachineIntConstant(0), i4], GenericBitVector())
+    block.next = Return(i3)
+    graph = Graph('f', [zs, zg], block)
+    assert use_register_storage(graph, StorageCodeGen())
+    assert i1 not in block.operations
+    assert i2 not in block.operations
+    assert block.operations[1:] == [i4, i5]
+
+def test_use_register_storage_write_in_between():
+    class StorageCodeGen(FakeCodeGen):
+        storage_registers = {"zvr": "_reg_zvr"}
+    typ = BigFixedBitVector(256)
+    zv = Argument('zv', typ)
+    block = Block()
+    i1 = block.emit(GlobalRead, 'zvr', [], typ)
+    block.emit(GlobalWrite, 'zvr', [zv], typ)
+    i2 = block.emit(Cast, '$cast', [i1], GenericBitVector())
+    i3 = block.emit(Operation, '@vector_subrange_o_i_i_unwrapped_res', [i2, MachineIntConstant(15), MachineIntConstant(8)], SmallFixedBitVector(8))
+    block.next = Return(i3)
+    graph = Graph('f', [zv], block)
+    # the read must see the value from before the write
+    assert not use_register_storage(graph, StorageCodeGen())
@@ -69,6 +69,54 @@ def test_full_nand():
     t = Translation(main, [])
     t.rtype() # check that it's rpython
 
+def _make_nand_codegen(**kwargs):
+    from pydrofoil.infer import infer
+    with open(cir, "rb") as f:
+        s = f.read()
+    support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
+    ast = parse.parser.parse(parse.lexer.lex(s))
+    infer(ast)
+    c = make_codegen(support_code, **kwargs)
+    ast.make_code(c)
+    return c, c.getcode()
+
+def test_nand_call_profile(tmpdir):
+    from pydrofoil.test.nand2tetris import supportcodenand
+    from pydrofoil.callprofile import CallProfile
+    c, res = _make_nand_codegen(instrument_calls=True)
+    assert "call_profile_counts[" in res
+    # the instrumented build inlines nothing, to count all the calls
+    assert not c.inlinable_functions
+    d = {}
+    exec compile(res, "instrumented", "exec") in d
+    supportcodenand.load_rom(sumrom)
+    machine = d['Machine']()
+    d['func_zmymain'](machine, rarithmetic.r_uint(2000), False)
+    filename = str(tmpdir.join("nand.profile"))
+    assert machine.write_call_profile(filename)
+    profile = CallProfile.read(filename)
+    assert profile.count("zmymain") == 1
+    assert profile.count("zdecode") > 1000
+    assert profile.is_cold("zmain")
+
+    # the profile drives the inlining decisions of the next build. the
+    # functions that are inlined without a profile and that were called
+    # are still inlined
+    c, _ = _make_nand_codegen()
+    inlined_without_profile = set(c.inlinable_functions)
+    assert inlined_without_profile
+    c, res = _make_nand_codegen(call_profile=profile)
+    assert "call_profile_counts" not in res
+    called = [name for name in inlined_without_profile if not profile.is_cold(name)]
+    assert called
+    for name in called:
+        assert name in c.inlinable_functions
+    d = {}
+    exec compile(res, "profiled", "exec") in d
+    machine = d['Machine']()
+    d['func_zmymain'](machine, rarithmetic.r_uint(2000), False)
+    assert supportcodenand.my_read_mem(machine, 17) == 5050
+
 def test_real(capsys):
     support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
     res = parse_and_make_code('''
@@ -339,3 +387,138 @@ files "x.sail"
     support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
     res = parse_and_make_code(s, support_code)
     assert "machine._reg_zPC = r_uint(0xcafeL)" in res
+
+def test_wide_register_storage():
+    import py
+    s = """
+val zz5i64zDzKz5i = "%i64->%i" : (%i64) ->  %i
+
+val zvector_update_subrange = "vector_update_subrange" : (%bv, %i, %i, %bv) ->  %bv
+
+val zvector_subrange = "vector_subrange" : (%bv, %i, %i) ->  %bv
+
+register zV : %bv256
+
+val zset_element : (%bv8) ->  %unit
+
+fn zset_element(zx) {
+  zz40 : %i `1;
+  zz40 = zz5i64zDzKz5i(15) `2;
+  zz41 : %i `3;
+  zz41 = zz5i64zDzKz5i(8) `4;
+  zz43 : %bv `5;
+  zz43 = zx `5;
+  zz42 : %bv `5;
+  zz42 = zvector_update_subrange(zV, zz40, zz41, zz43) `6;
+  zV = zz42 `7;
+  return = () `8;
+  end;
+}
+
+val zget_element : (%unit) ->  %bv8
+
+fn zget_element(zgsz30) {
+  zz40 : %i `1;
+  zz40 = zz5i64zDzKz5i(15) `2;
+  zz41 : %i `3;
+  zz41 = zz5i64zDzKz5i(8) `4;
+  zz42 : %bv `5;
+  zz42 = zvector_subrange(zV, zz40, zz41) `6;
+  return = zz42 `7;
+  end;
+}
+
+val zinitializze_registers : (%unit) ->  %unit
+
+fn zinitializze_registers(zgsz32) {
+  return = () `6;
+  end;
+}
+
+files "x.sail"
+
+"""
+    support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
+    res = parse_and_make_code(s, support_code)
+    # the element is read and updated in place
+    assert "supportcode.helper_register_update_subrange_o_i_i_o(machine, '_reg_zV', 15, 8, " in res
+    assert "supportcode.helper_register_subrange_o_i_i_unwrapped_res(machine, '_reg_zV', 15, 8)" in res
+    d = {}
+    res = py.code.Source(res)
+    exec res.compile() in d
+    machine = d['Machine']()
+    d['func_zset_element'](machine, rarithmetic.r_uint(0xab))
+    assert d['func_zget_element'](machine, ()) == 0xab
+    assert machine._reg_zV.read().tolong() == 0xab00
+    # every machine has its own register storage
+    assert d['Machine']()._reg_zV.read().tolong() == 0
+
+def test_unboxed_int_arguments():
+    import py
+    s = """
+val zz5i64zDzKz5i = "%i64->%i" : (%i64) ->  %i
+
+val zadd_int = "add_int" : (%i, %i) ->  %i
+
+val zz5izDzKz5i64 = "%i->%i64" : (%i) ->  %i64
+
+val zscale : (%i, %i) ->  %i
+
+fn zscale(zx, zy) {
+  zz40 : %i `1;
+  zz40 = zadd_int(zx, zy) `2;
+  zz41 : %i `1;
+  zz41 = zadd_int(zz40, zx) `2;
+  return = zz41 `3;
+  end;
+}
+
+val zmain : (%i64) ->  %i
+
+fn zmain(zn) {
+  zz40 : %i `1;
+  zz40 = zz5i64zDzKz5i(zn) `2;
+  zz41 : %i `1;
+  zz41 = zscale(zz40, zz40) `2;
+  zz42 : %i `1;
+  zz42 = zscale(zz41, zz40) `2;
+  return = zz42 `3;
+  end;
+}
+
+val zinitializze_registers : (%unit) ->  %unit
+
+fn zinitializze_registers(zgsz32) {
+  return = () `6;
+  end;
+}
+
+files "x.sail"
+
+"""
+    support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
+    res = parse_and_make_code(s, support_code, should_inline=lambda name: False)
+    assert "def func_zscale(machine, ival_zx, idata_zx, ival_zy, idata_zy):" in res
+    d = {}
+    res = py.code.Source(res)
+    exec res.compile() in d
+    machine = d['Machine']()
+    assert d['func_zmain'](machine, 5).toint() == 35
+    assert d['func_zmain'](machine, 2 ** 62).tolong() == 7 * 2 ** 62
+    assert d['func_zscale'](machine, 2, None, 3, None).toint() == 7
+
+def test_ast_cache(tmpdir, monkeypatch):
+    support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
+    s = """
+enum zjump {
+  zJDONT,
+  zJGT
+}
+"""
+    res1 = parse_and_make_code(s, support_code, cache_dir=str(tmpdir))
+    assert [p.basename for p in tmpdir.listdir() if p.basename.startswith("ast-")]
+    def fail(*args):
+        assert 0, "should not parse again"
+    monkeypatch.setattr(parse.parser, "parse", fail)
+    res2 = parse_and_make_code(s, support_code, cache_dir=str(tmpdir))
+    assert res1 == res2
@@ -12,7 +12,7 @@ class TBM(mem.BlockMemory):
     BLOCK_MASK = BLOCK_SIZE - 1
 
 
-@pytest.mark.parametrize("memcls", [TBM, mem.FlatMemory])
+@pytest.mark.parametrize("memcls", [TBM, mem.FlatMemory, mem.SparseMemory])
 def test_mem_write_read(memcls):
     mem = memcls()
     assert mem.read(r_uint(1), 1) == 0
@@ -39,55 +39,100 @@ def test_mem_write_read(memcls):
                     assert mem.read(addr, size) == data[offset]
     mem.close()
 
+def _statuses(m):
+    return [m._read_status(i) for i in range(m.size // 8)]
+
 def test_invalidation_logic():
-    m = mem.FlatMemory()
+    m = mem.FlatMemory(size=64 * 1024)
     m.write(0, 8, 0x0a1b2c3d4e5f6789)
     m.write(8, 8, 0xdeaddeaddeaddead)
     assert m._aligned_read(0, 8, False) == 0x0a1b2c3d4e5f6789
-    assert set(m.status) == {mem.MEM_STATUS_NORMAL}
-    v1 = m.version
+    assert set(_statuses(m)) == {mem.MEM_STATUS_NORMAL}
+    v1 = m.pages[0].version
 
     assert m._aligned_read(0, 8, True) == 0x0a1b2c3d4e5f6789
-    v2 = m.version
+    v2 = m.pages[0].version
     # going from normal -> immutable does not change version
     assert v1 is v2
-    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
-    assert set(m.status[1:]) == {mem.MEM_STATUS_NORMAL}
+    assert _statuses(m)[0] == mem.MEM_STATUS_IMMUTABLE
+    assert set(_statuses(m)[1:]) == {mem.MEM_STATUS_NORMAL}
 
     assert m._aligned_read(8, 8, True) == 0xdeaddeaddeaddead
-    v3 = m.version
+    v3 = m.pages[0].version
     assert v2 is v3
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
+    assert _statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
+    assert set(_statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
 
     m.write(8, 8, 0xdeaddeaddeaddead) # same value!
-    v3 = m.version
+    v3 = m.pages[0].version
     assert v2 is v3
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
+    assert _statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
+    assert set(_statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
 
     for val in [1, 2, 3, 4]:
         m.write(8, 8, val) # different value!
-        assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
-        assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
-    v4 = m.version
+        assert _statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
+        assert set(_statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
+    v4 = m.pages[0].version
     assert v4 is not v3
 
     # re-reading as executable does not change the status
     assert m._aligned_read(8, 8, True) == 4
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
-    v5 = m.version
+    assert _statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
+    assert set(_statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
+    v5 = m.pages[0].version
     assert v4 is v5
 
     # writing to a normal word does not change the status or the version
     m._aligned_write(16, 8, 0x17)
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
-    v6 = m.version
+    assert _statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
+    assert set(_statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
+    v6 = m.pages[0].version
     assert v4 is v6
 
 
+def test_invalidation_is_per_page():
+    m = mem.FlatMemory(size=64 * 1024)
+    page_bytes = m.PAGE_SIZE * 8
+    m.write(0, 8, 0x0a1b2c3d4e5f6789)
+    m.write(page_bytes, 8, 0xdeaddeaddeaddead)
+    assert m._aligned_read(0, 8, True) == 0x0a1b2c3d4e5f6789
+    assert m._aligned_read(page_bytes, 8, True) == 0xdeaddeaddeaddead
+    v0 = m.pages[0].version
+    v1 = m.pages[1].version
+    assert v0 is not v1
+
+    # overwriting code on the second page only invalidates that page
+    m.write(page_bytes, 8, 17)
+    assert _statuses(m)[m.PAGE_SIZE] == mem.MEM_STATUS_MUTABLE
+    assert m.pages[0].version is v0
+    assert m.pages[1].version is not v1
+
+    # and the other way around
+    v1 = m.pages[1].version
+    m.write(0, 8, 17)
+    assert m.pages[0].version is not v0
+    assert m.pages[1].version is v1
+
+
+def test_status_bits():
+    m = mem.FlatMemory(size=64 * 1024)
+    # two bits per word
+    assert len(m.status) == 64 * 1024 // 8 // 32
+    for offset in [0, 1, 31, 32, 33, 63, 64, 8191]:
+        assert m._read_status(offset) == mem.MEM_STATUS_NORMAL
+        m._write_status(offset, mem.MEM_STATUS_IMMUTABLE)
+        assert m._read_status(offset) == mem.MEM_STATUS_IMMUTABLE
+        m._write_status(offset, mem.MEM_STATUS_MUTABLE)
+        assert m._read_status(offset) == mem.MEM_STATUS_MUTABLE
+    statuses = _statuses(m)
+    for offset, status in enumerate(statuses):
+        if offset in [0, 1, 31, 32, 33, 63, 64, 8191]:
+            assert status == mem.MEM_STATUS_MUTABLE
+        else:
+            assert status == mem.MEM_STATUS_NORMAL
+
+
 def test_immutable_reads():
     m = mem.FlatMemory()
     m.write(0, 8, 0x0a1b2c3d4e5f6789)
@@ -171,3 +216,137 @@ def test_block_caching_platform():
     assert m.last_block is block1
     assert m.last_block_addr_executable == r_uint(0x200000)
     assert m.last_block_executable is block2
+
+def test_memory_map():
+    regions = [
+        mem.MemoryRegion("rom", 0x1000, 0x100),
+        mem.MemoryRegion("ram", 0x80000000, 0x1000),
+        mem.MemoryRegion("htif", 0x80001000, 16),
+    ]
+    m = mem.MemoryMap(regions)
+    pc = r_uint(0x80000000)
+    assert m.lookup(r_uint(0x1000), 8, pc) == 0
+    assert m.lookup(r_uint(0x10f8), 8, pc) == 0
+    assert m.lookup(r_uint(0x10fc), 8, pc) == -1
+    assert m.lookup(r_uint(0xff8), 8, pc) == -1
+    assert m.lookup(r_uint(0x80000ff8), 8, pc) == 1
+    assert m.lookup(r_uint(0x80001008), 8, pc) == 2
+    assert m.lookup(r_uint(0x80001010), 1, pc) == -1
+    assert m.lookup(r_uint(-8), 8, pc) == -1
+    # the guess for the JIT is the region of the last access
+    assert m.lookup_likely(r_uint(0x80000ff8), 8, pc) == 1
+    assert m._likely_index == 1
+    assert m.lookup_likely(r_uint(0x80001008), 8, pc) == 2
+    assert m._likely_index == 2
+    # a miss does not change the remembered region
+    assert m.lookup_likely(r_uint(0x80001010), 1, pc) == -1
+    assert m._likely_index == 2
+
+def test_split_memory():
+    low = mem.FlatMemory(size=64 * 1024)
+    ram = mem.FlatMemory(size=64 * 1024)
+    m = mem.SplitMemory([
+        mem.MemoryRegion("low", 0, low.size, low),
+        mem.MemoryRegion("ram", 0x80000000, ram.size, ram),
+    ])
+    m.write(r_uint(0x1000), 8, r_uint(0x0102030405060708))
+    m.write(r_uint(0x80000010), 4, r_uint(0xdeadbeef))
+    assert low.read(r_uint(0x1000), 8) == r_uint(0x0102030405060708)
+    assert ram.read(r_uint(0x10), 4) == r_uint(0xdeadbeef)
+    assert m.read(r_uint(0x1000), 8) == r_uint(0x0102030405060708)
+    assert m.read(r_uint(0x80000010), 4) == r_uint(0xdeadbeef)
+    with pytest.raises(ValueError):
+        m.read(r_uint(0x80000000 + ram.size), 8)
+    with pytest.raises(ValueError):
+        m.write(r_uint(low.size), 8, r_uint(0))
+    # the accesses of guest instructions
+    pc = r_uint(0x80000000)
+    m.write_from(pc, r_uint(0x80000018), 8, r_uint(17))
+    assert m.read_from(pc, r_uint(0x80000018), 8) == r_uint(17)
+    assert m.read_from(pc, r_uint(0x1000), 2) == r_uint(0x0708)
+    with pytest.raises(ValueError):
+        m.read_from(pc, r_uint(0x80000000 + ram.size - 4), 8)
+
+def test_sparse_memory_allocates_lazily():
+    m = mem.SparseMemory(1024 * 1024)
+    assert m.chunks == [None] * 16
+    # reading does not allocate
+    assert m.read(r_uint(0x10008), 8) == 0
+    assert m.chunks == [None] * 16
+    m.write(r_uint(0x10008), 8, r_uint(0x0102030405060708))
+    chunk = m.chunks[1]
+    assert isinstance(chunk, mem.FlatMemory)
+    assert chunk.read(r_uint(8), 8) == r_uint(0x0102030405060708)
+    assert m.read(r_uint(0x10008), 8) == r_uint(0x0102030405060708)
+    assert m.chunks[0] is None
+    assert m.chunks[2:] == [None] * 14
+
+    # executing marks the word immutable in the chunk
+    assert m.read(r_uint(0x10008), 8, True) == r_uint(0x0102030405060708)
+    assert chunk._read_status(1) == mem.MEM_STATUS_IMMUTABLE
+    m.write(r_uint(0x10008), 8, r_uint(17))
+    assert chunk._read_status(1) == mem.MEM_STATUS_MUTABLE
+
+    # executing from an untouched chunk allocates it
+    assert m.read(r_uint(0x20000), 4, True) == 0
+    assert m.chunks[2]._read_status(0) == mem.MEM_STATUS_IMMUTABLE
+
+def _split_memory():
+    low = mem.SparseMemory(64 * 1024)
+    high = TBM()
+    return mem.SplitMemory([
+        mem.MemoryRegion("low", 0, low.size, low),
+        mem.MemoryRegion("high", 64 * 1024, 64 * 1024, high),
+    ])
+
+@pytest.mark.parametrize("memfactory", [TBM, mem.FlatMemory, mem.SparseMemory, _split_memory])
+def test_write_read_bytes(memfactory):
+    m = memfactory()
+    for start_addr in [0, 1, 7, 8, 13, TBM.BLOCK_SIZE - 3, 64 * 1024 - 21]:
+        for length in [0, 1, 5, 8, 9, 16, 31, 300]:
+            buf = "".join([chr(random.randrange(256)) for _ in range(length)])
+            m.write_bytes(r_uint(start_addr), buf)
+            assert m.read_bytes(r_uint(start_addr), length) == buf
+            for i in range(length):
+                assert m.read(r_uint(start_addr + i), 1) == r_uint(ord(buf[i]))
+    m.write(r_uint(24), 8, r_uint(0x0102030405060708))
+    assert m.read_bytes(r_uint(24), 8) == "\x08\x07\x06\x05\x04\x03\x02\x01"
+    m.close()
+
+def test_write_bytes_invalidates():
+    m = mem.FlatMemory(size=64 * 1024)
+    m.write_bytes(r_uint(0), "\x13\x00\x00\x00" * 4)
+    assert m.read(r_uint(0), 4, True) == 0x13
+    v = m.pages[0].version
+    m.write_bytes(r_uint(0), "\x13\x00\x00\x00" * 4)
+    assert m.pages[0].version is v
+    m.write_bytes(r_uint(0), "\x17\x00\x00\x00")
+    assert m.pages[0].version is not v
+    assert m.read(r_uint(0), 4, True) == 0x17
+
+def test_split_memory_write_bytes_across_regions():
+    m = _split_memory()
+    low = m.memory_map.regions[0].mem
+    high = m.memory_map.regions[1].mem
+    m.write_bytes(r_uint(64 * 1024 - 4), "abcdefgh")
+    assert low.read_bytes(r_uint(64 * 1024 - 4), 4) == "abcd"
+    assert high.read_bytes(r_uint(0), 4) == "efgh"
+    assert m.read_bytes(r_uint(64 * 1024 - 4), 8) == "abcdefgh"
+    with pytest.raises(ValueError):
+        m.write_bytes(r_uint(128 * 1024 - 4), "abcdefgh")
+
+@pytest.mark.parametrize("memfactory", [TBM, mem.FlatMemory, mem.SparseMemory, _split_memory])
+def test_zero_range(memfactory):
+    m = memfactory()
+    m.write_bytes(r_uint(64 * 1024 - 12), "x" * 24)
+    m.zero_range(r_uint(64 * 1024 - 9), 11)
+    assert m.read_bytes(r_uint(64 * 1024 - 12), 24) == "xxx" + "\x00" * 11 + "x" * 10
+    m.close()
+
+def test_sparse_memory_zero_range_does_not_allocate():
+    m = mem.SparseMemory(1024 * 1024)
+    m.write(r_uint(0x10008), 8, r_uint(0x0102030405060708))
+    m.zero_range(r_uint(0x10000), 0x50000)
+    assert m.read(r_uint(0x10008), 8) == 0
+    assert m.chunks[0] is None
+    assert m.chunks[2:] == [None] * 14
@@ -322,3 +322,42 @@ fn zAESSubBytes(zop) {
   end;
 }
 """))
+
+def test_remove_unreachable_functions():
+    res = parser.parse(lexer.lex("""
+val zf : (%i) -> %i
+
+fn zf(zx) {
+  return = zx `1;
+  end;
+}
+
+val zg : (%i) -> %i
+
+fn zg(zx) {
+  return = zf(zx) `2;
+  end;
+}
+
+val zunused : (%i) -> %i
+
+fn zunused(zx) {
+  return = zg(zx) `3;
+  end;
+}
+
+val zfromregister : (%unit) -> %i
+
+fn zfromregister(zx) {
+  return = 1 `4;
+  end;
+}
+
+register zR : %i {
+  zR = zfromregister(()) `5;
+}
+"""))
+    assert res.remove_unreachable_functions(["zg"]) == 1
+    names = [decl.name for decl in res.declarations if isinstance(decl, Function)]
+    assert names == ["zf", "zg", "zfromregister"]
+    assert len([decl for decl in res.declarations if isinstance(decl, GlobalVal)]) == 4
@@ -745,3 +745,178 @@ def test_spec_bug():
     spec = Specializer(graph, codegen)
     key = ((MachineInt(), 64), (MachineInt(), None))
     res = spec._make_stub(key) # used to crash
+
+
+def _make_pow2_graphs(codegen):
+    graphs = []
+    for i in range(6):
+        block0 = Block()
+        i1 = block0.emit(Operation, '@pow2_i', [MachineIntConstant(i + 30)], Int(), None, None)
+        block0.next = Return(i1, None)
+        graphs.append(Graph('f%s' % i, [], block0))
+    # calls f0, so can't be optimized in the same batch
+    block0 = Block()
+    i1 = block0.emit(Operation, 'f0', [], Int(), None, None)
+    i2 = block0.emit(Operation, 'zz5izDzKz5i64', [i1], MachineInt(), None, None)
+    block0.next = Return(i2, None)
+    graphs.insert(2, Graph('caller', [], block0))
+    for graph in graphs:
+        codegen.schedule_graph_specialization(graph)
+    return graphs
+
+def test_independent_todo_prefix():
+    codegen = FakeCodeGen()
+    codegen.parallelism = 2
+    graphs = _make_pow2_graphs(codegen)
+    assert codegen._independent_todo_prefix() == graphs[:2]
+    codegen.specialization_todo.popleft()
+    assert codegen._independent_todo_prefix() == graphs[1:]
+
+def test_independent_todo_prefix_specializations_and_inlining():
+    codegen = FakeCodeGen()
+    codegen.parallelism = 2
+    graphs = _make_pow2_graphs(codegen)
+    del graphs[2] # drop 'caller'
+    # f4 is a specialization of f3, calling f3 can turn into a call of f4
+    spec = Specializer(graphs[3], codegen)
+    spec.cache[()] = (graphs[4], Int())
+    codegen.specialization_functions['f3'] = spec
+    codegen.specialization_functions['f4'] = spec
+    # g calls f3 and is scheduled after f4
+    block0 = Block()
+    i1 = block0.emit(Operation, 'f3', [], Int(), None, None)
+    block0.next = Return(i1, None)
+    g = Graph('g', [], block0)
+    codegen.schedule_graph_specialization(g)
+    assert codegen._optimization_dependencies(g) == {'f3', 'f4'}
+    todo = codegen.specialization_todo
+    todo.clear()
+    todo.extend([graphs[0], graphs[1], graphs[4], g, graphs[2]])
+    assert codegen._independent_todo_prefix() == [graphs[0], graphs[1], graphs[4]]
+
+    # h calls the inlinable function g, which calls f3
+    block0 = Block()
+    i1 = block0.emit(Operation, 'g', [], Int(), None, None)
+    block0.next = Return(i1, None)
+    h = Graph('h', [], block0)
+    codegen.inlinable_functions['g'] = g
+    assert codegen._optimization_dependencies(h) == {'g', 'f3', 'f4'}
+
+def test_parallel_specialize_all_same_result():
+    serial = FakeCodeGen()
+    serial.should_inline = lambda name: None
+    serial_graphs = _make_pow2_graphs(serial)
+    serial.specialize_all()
+
+    parallel = FakeCodeGen()
+    parallel.should_inline = lambda name: None
+    parallel.parallelism = 3
+    parallel_graphs = _make_pow2_graphs(parallel)
+    parallel.specialize_all()
+    for graph1, graph2 in zip(serial_graphs, parallel_graphs):
+        assert print_graph_construction(graph1) == print_graph_construction(graph2)
+    assert set(parallel.inlinable_functions) == set(serial.inlinable_functions)
+    assert parallel.all_graph_by_name['f1'] is parallel_graphs[1]
+    assert not parallel.specialization_todo
+    assert not parallel.specialization_todo_set
+
+def test_graph_cache(tmpdir, monkeypatch):
+    from pydrofoil import ir
+    cachedir = str(tmpdir.join("graphs"))
+    codegen1 = FakeCodeGen()
+    codegen1.graph_cache_dir = cachedir
+    codegen1.should_inline = lambda name: None
+    graphs1 = _make_pow2_graphs(codegen1)
+    codegen1.specialize_all()
+    assert tmpdir.join("graphs").listdir()
+
+    def optimize(graph, codegen):
+        assert 0, "should come from the cache"
+    codegen2 = FakeCodeGen()
+    codegen2.graph_cache_dir = cachedir
+    codegen2.should_inline = lambda name: None
+    graphs2 = _make_pow2_graphs(codegen2)
+    monkeypatch.setattr(ir, "optimize", optimize)
+    codegen2.specialize_all()
+    for graph1, graph2 in zip(graphs1, graphs2):
+        assert print_graph_construction(graph1) == print_graph_construction(graph2)
+    assert set(codegen1.inlinable_functions) == set(codegen2.inlinable_functions)
+
+def test_graph_cache_key_depends_on_callees(tmpdir):
+    codegen = FakeCodeGen()
+    codegen.graph_cache_dir = str(tmpdir)
+    graphs = _make_pow2_graphs(codegen)
+    caller = graphs[2]
+    key = codegen._graph_cache_key(caller)
+    assert codegen._graph_cache_key(caller) == key
+    assert codegen._graph_cache_key(graphs[1]) != key
+    # changing the called graph changes the key of the caller
+    block = Block()
+    block.next = Return(MachineIntConstant(1), None)
+    graphs[0].startblock = block
+    codegen._finish_optimized_graph(graphs[0], False)
+    assert codegen._graph_cache_key(caller) != key
+
+def test_graph_cache_key_depends_on_config(tmpdir):
+    import os
+    def make_key(**attrs):
+        codegen = FakeCodeGen()
+        codegen.graph_cache_dir = str(tmpdir)
+        for name, value in attrs.items():
+            setattr(codegen, name, value)
+        graphs = _make_pow2_graphs(codegen)
+        return codegen._graph_cache_key(graphs[2])
+    key = make_key()
+    assert make_key() == key
+    assert make_key(promoted_registers={'zPC'}) != key
+    # a should_inline hook defined in another module
+    assert make_key(should_inline=os.path.basename) != key
+    assert make_key(instrument_calls=True) != key
+    # the contents of the call profile matter
+    from pydrofoil.callprofile import CallProfile
+    profile_key = make_key(call_profile=CallProfile.parse("f zpow2 10\n"))
+    assert profile_key != key
+    assert make_key(call_profile=CallProfile.parse("f zpow2 10\n")) == profile_key
+    assert make_key(call_profile=CallProfile.parse("f zpow2 0\n")) != profile_key
+
+def test_deduplicate_specialized_graphs():
+    fakecodegen = FakeCodeGen()
+    fakecodegen.should_inline = lambda x: False
+    za = Argument('za', MachineInt())
+    zb = Argument('zb', MachineInt())
+    block0 = Block()
+    block1 = Block()
+    block2 = Block()
+    i1 = block0.emit(Operation, '@lt', [zb, MachineIntConstant(10)], Bool(), None, None)
+    block0.next = ConditionalGoto(i1, block1, block2)
+    i2 = block1.emit(Operation, '@add_i_i_must_fit', [za, MachineIntConstant(1)], MachineInt(), '`1', 'zz40')
+    block1.next = Return(i2)
+    block2.next = Return(za)
+    graph = Graph('zf', [za, zb], block0)
+    spec = Specializer(graph, fakecodegen)
+    fakecodegen.specialization_functions['zf'] = spec
+    fakecodegen.schedule_graph_specialization(graph)
+
+    zx = Argument('zx', MachineInt())
+    block = Block()
+    i3 = block.emit(Operation, 'zf', [zx, MachineIntConstant(1)], MachineInt(), '`2', 'zz41')
+    i4 = block.emit(Operation, 'zf', [zx, MachineIntConstant(2)], MachineInt(), '`3', 'zz42')
+    i5 = block.emit(Operation, 'zf', [zx, MachineIntConstant(20)], MachineInt(), '`4', 'zz43')
+    i6 = block.emit(Operation, '@add_i_i_must_fit', [i3, i4], MachineInt(), None, None)
+    i7 = block.emit(Operation, '@add_i_i_must_fit', [i6, i5], MachineInt(), None, None)
+    block.next = Return(i7)
+    calling_graph = Graph("zcaller", [zx], block)
+    fakecodegen.schedule_graph_specialization(calling_graph)
+    fakecodegen.specialize_all()
+    assert len(spec.cache) == 3
+    names = [op.name for op in calling_graph.startblock.operations[:3]]
+    assert len(set(names)) == 3
+
+    removed = fakecodegen.deduplicate_specialized_graphs([calling_graph, graph])
+    assert removed == 1
+    names = [op.name for op in calling_graph.startblock.operations[:3]]
+    assert names[0] == names[1] == 'zf_specialized_o_1'
+    assert names[2] == 'zf_specialized_o_20'
+    assert 'zf_specialized_o_2' not in fakecodegen.all_graph_by_name
+    extra = fakecodegen.extract_needed_extra_graphs([calling_graph])
+    assert sorted(g.name for g, _ in extra) == ['zf_specialized_o_1', 'zf_specialized_o_20']
@@ -5,7 +5,7 @@ import sys
 from pydrofoil import supportcode
 from pydrofoil import bitvector
 from pydrofoil.bitvector import Integer, SmallInteger, BigInteger, MININT, SparseBitVector
-from pydrofoil.bitvector import GenericBitVector, SmallBitVector
+from pydrofoil.bitvector import GenericBitVector, SmallBitVector, TwoWordBitVector
 from hypothesis import given, strategies, assume, example, settings
 
 from rpython.rlib.rarithmetic import r_uint, intmask
@@ -233,7 +233,7 @@ def test_sign_extend():
         assert supportcode.sign_extend(machine, c(2, 0b11), Integer.fromint(4)).toint() == 0b1111
 
         assert supportcode.sign_extend(machine, c(2, 0b00), Integer.fromint(100)).tobigint().tolong() == 0
-        assert isinstance(supportcode.sign_extend(machine, bv(2, 0b00), Integer.fromint(100)), SparseBitVector) #test if it returns SparseBitVector
+        assert isinstance(supportcode.sign_extend(machine, bv(2, 0b00), Integer.fromint(100)), TwoWordBitVector) #test if it returns TwoWordBitVector
         assert supportcode.sign_extend(machine, c(2, 0b01), Integer.fromint(100)).tobigint().tolong() == 1
         assert supportcode.sign_extend(machine, c(2, 0b10), Integer.fromint(100)).tobigint().tolong() == 0b1111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111110
         assert supportcode.sign_extend(machine, c(2, 0b11), Integer.fromint(100)).tobigint().tolong() == 0b1111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111111
@@ -366,7 +366,7 @@ def test_vector_subrange():
     b = gbv(128, 0x36000000000000001200L)
     x = b.subrange(66, 0)
     assert x.tolong() == 0x1200
-    assert isinstance(x, bitvector.GenericBitVector)
+    assert isinstance(x, bitvector.TwoWordBitVector)
 
 @given(strategies.data())
 def test_hypothesis_vector_subrange(data):
@@ -1343,7 +1343,7 @@ def test_sparse_vector_subrange():
     r = v.subrange(65, 0)
     assert r.size() == 66
     assert r.toint() == 0b101010101
-    assert isinstance(r, bitvector.SparseBitVector)
+    assert isinstance(r, bitvector.TwoWordBitVector)
 
     v = sbv(100, 0b101010101)
     r = v.subrange(65, 3)
@@ -1355,13 +1355,13 @@ def test_sparse_vector_subrange():
     r = v.subrange(65, 1)
     assert r.size() == 65
     assert r.toint() == 0b10101010
-    assert isinstance(r, bitvector.SparseBitVector)
+    assert isinstance(r, bitvector.TwoWordBitVector)
 
     v = sbv(100, 0b101010101)
     r = v.subrange(99, 0)
     assert r.size() == 100
     assert r.toint() == 0b101010101
-    assert isinstance(r, bitvector.SparseBitVector)
+    assert isinstance(r, bitvector.TwoWordBitVector)
 
 def test_sparse_vector_update():
     v = sbv(100, 1)
@@ -1937,6 +1937,9 @@ def test_hypothesis_int_from_ruint_to_uint_roundtrips(ui):
 def test_hypothesis_int_repr_doesnt_crash(i):
     repr(i)
 
+def twoword_tolong(res):
+    return (int(res.high) << 64) | int(res.low)
+
 def test_efficient_append(monkeypatch):
     tobigint = GenericBitVector.tobigint
     def tolong(res):
@@ -1944,17 +1947,24 @@ def test_efficient_append(monkeypatch):
     monkeypatch.setattr(SmallBitVector, 'tobigint', None)
     monkeypatch.setattr(GenericBitVector, 'tobigint', None)
     monkeypatch.setattr(SparseBitVector, 'tobigint', None)
+    monkeypatch.setattr(TwoWordBitVector, 'tobigint', None)
     v1 = bv(64, 0xa9e3)
     v2 = bv(16, 0x04fb)
     res = v1.append(v2)
-    assert isinstance(res, SparseBitVector)
+    assert isinstance(res, TwoWordBitVector)
     assert res.toint() == 0xa9e304fb
 
     v1 = bv(64, 0xa9e3)
     v2 = bv(56, 0x04fb)
     res = v1.append(v2)
-    assert isinstance(res, GenericBitVector)
-    assert tolong(res) == (0xa9e3 << 56) | 0x04fb
+    assert isinstance(res, TwoWordBitVector)
+    assert twoword_tolong(res) == (0xa9e3 << 56) | 0x04fb
+
+    v1 = bv(64, 0xa9e3)
+    v2 = bv(64, 0x04fb)
+    res = v1.append(v2)
+    assert isinstance(res, TwoWordBitVector)
+    assert twoword_tolong(res) == (0xa9e3 << 64) | 0x04fb
 
     v1 = sbv(128, 0xa9e3)
     v2 = sbv(128, 0x04fb)
@@ -1975,18 +1985,25 @@ def test_efficient_append64(monkeypatch):
     monkeypatch.setattr(SmallBitVector, 'tobigint', None)
     monkeypatch.setattr(GenericBitVector, 'tobigint', None)
     monkeypatch.setattr(SparseBitVector, 'tobigint', None)
+    monkeypatch.setattr(TwoWordBitVector, 'tobigint', None)
 
     v1 = bv(64, 0x0)
     res = v1.append_64(r_uint(0x04fb))
-    assert isinstance(res, SparseBitVector)
-    assert res.val == 0x04fb
+    assert isinstance(res, TwoWordBitVector)
+    assert res.low == 0x04fb
+    assert res.high == 0
 
     v1 = bv(32, 0xa9e3)
     res = v1.append_64(r_uint(0x04fb))
-    assert isinstance(res, GenericBitVector)
-    assert tolong(res) == (0xa9e3 << 64) | 0x04fb
+    assert isinstance(res, TwoWordBitVector)
+    assert twoword_tolong(res) == (0xa9e3 << 64) | 0x04fb
     assert res.size() == 64 + 32
 
+    v1 = bv(100, 0xa9e3)
+    res = v1.append_64(r_uint(0x04fb))
+    assert isinstance(res, GenericBitVector)
+    assert res.data == [r_uint(0x04fb), r_uint(0xa9e3), r_uint(0)]
+
     v1 = sbv(128, 0xa9e3)
     res = v1.append_64(r_uint(0x04fb))
     assert tolong(res) == (0xa9e3 << 64) | 0x04fb
@@ -2001,3 +2018,175 @@ def test_efficient_append64(monkeypatch):
     v1 = GenericBitVector(128, [r_uint(0), r_uint(0xa9e3)])
     res = v1.append_64(r_uint(0x04fb))
     assert res.data == [r_uint(0x04fb), r_uint(0), r_uint(0xa9e3)]
+
+def _make_twoword_bitvector(data, width=-1):
+    if width == -1:
+        width = data.draw(strategies.integers(65, 128))
+    value = data.draw(strategies.integers(0, 2**width-1))
+    return bitvector.from_bigint(width, rbigint.fromlong(value))
+
+def test_twoword_constructors():
+    assert isinstance(bv(100, 5), TwoWordBitVector)
+    assert isinstance(bv(129, 5), SparseBitVector)
+    res = bitvector.from_bigint(128, rbigint.fromlong(-1))
+    assert isinstance(res, TwoWordBitVector)
+    assert res.low == res.high == r_uint(-1)
+    res = bitvector.from_bigint(70, rbigint.fromlong(-2))
+    assert res.tolong() == 2 ** 70 - 2
+    assert Integer.fromint(-1).slice(100, 0).tolong() == 2 ** 100 - 1
+    assert isinstance(Integer.fromint(-1).slice(100, 0), TwoWordBitVector)
+
+@given(strategies.data())
+def test_twoword_hypothesis_binops(data):
+    v1 = _make_twoword_bitvector(data)
+    width = v1.size()
+    kind = data.draw(strategies.integers(0, 2))
+    if kind == 0:
+        v2 = _make_twoword_bitvector(data, width)
+    elif kind == 1:
+        v2 = _make_sparse_bitvector(data, width)
+    else:
+        value = data.draw(strategies.integers(0, 2**width-1))
+        v2 = GenericBitVector.from_bigint(width, rbigint.fromlong(value))
+    a = v1.tolong()
+    b = v2.tolong()
+    mask = 2 ** width - 1
+    for x, y, n1, n2 in [(v1, v2, a, b), (v2, v1, b, a)]:
+        assert x.add_bits(y).tolong() == (n1 + n2) & mask
+        assert x.sub_bits(y).tolong() == (n1 - n2) & mask
+        assert x.xor(y).tolong() == n1 ^ n2
+        assert x.and_(y).tolong() == n1 & n2
+        assert x.or_(y).tolong() == n1 | n2
+        assert x.eq(y) == (n1 == n2)
+    assert v1.invert().tolong() == ~a & mask
+    assert v1.unsigned().tolong() == a
+    signed = a - 2 ** width if a >> (width - 1) else a
+    assert v1.signed().tolong() == signed
+
+@given(strategies.data())
+def test_twoword_hypothesis_int_ops(data):
+    v = _make_twoword_bitvector(data)
+    width = v.size()
+    a = v.tolong()
+    i = data.draw(ints)
+    c = Integer.fromlong(i)
+    mask = 2 ** width - 1
+    assert v.add_int(c).tolong() == (a + i) & mask
+    assert v.sub_int(c).tolong() == (a - i) & mask
+
+@given(strategies.data())
+def test_twoword_hypothesis_shifts(data):
+    v = _make_twoword_bitvector(data)
+    width = v.size()
+    a = v.tolong()
+    shift = data.draw(strategies.integers(0, 140))
+    mask = 2 ** width - 1
+    assert v.lshift(shift).tolong() == (a << shift) & mask
+    assert v.rshift(shift).tolong() == a >> shift
+    signed = a - 2 ** width if a >> (width - 1) else a
+    assert v.arith_rshift(shift).tolong() == (signed >> shift) & mask
+
+@given(strategies.data())
+def test_twoword_hypothesis_subrange_extend(data):
+    v = _make_twoword_bitvector(data)
+    width = v.size()
+    a = v.tolong()
+    lower = data.draw(strategies.integers(0, width - 1))
+    upper = data.draw(strategies.integers(lower, width - 1))
+    subwidth = upper - lower + 1
+    res = v.subrange(upper, lower)
+    assert res.size() == subwidth
+    assert res.tolong() == (a >> lower) & (2 ** subwidth - 1)
+    if subwidth <= 64:
+        assert v.subrange_unwrapped_res(upper, lower) == res.tolong()
+    assert v.truncate(subwidth).tolong() == a & (2 ** subwidth - 1)
+    target = data.draw(strategies.integers(width, 300))
+    assert v.zero_extend(target).tolong() == a
+    signed = a - 2 ** width if a >> (width - 1) else a
+    assert v.sign_extend(target).tolong() == signed & (2 ** target - 1)
+    pos = data.draw(strategies.integers(0, width - 1))
+    assert v.read_bit(pos) == bool((a >> pos) & 1)
+    assert v.update_bit(pos, 1).tolong() == a | (1 << pos)
+    assert v.update_bit(pos, 0).tolong() == a & ~(1 << pos)
+
+@given(strategies.data())
+def test_twoword_hypothesis_update_subrange(data):
+    v = _make_twoword_bitvector(data)
+    width = v.size()
+    a = v.tolong()
+    lower = data.draw(strategies.integers(0, width - 1))
+    upper = data.draw(strategies.integers(lower, width - 1))
+    subwidth = upper - lower + 1
+    replace_bv = make_bitvector(data, subwidth)
+    res = v.update_subrange(upper, lower, replace_bv)
+    assert isinstance(res, TwoWordBitVector)
+    submask = (2 ** subwidth - 1) << lower
+    assert res.tolong() == (a & ~submask) | (replace_bv.tolong() << lower)
+
+@given(strategies.data())
+def test_twoword_hypothesis_append_pack(data):
+    v = _make_twoword_bitvector(data)
+    other = make_bitvector(data)
+    res = v.append(other)
+    assert res.size() == v.size() + other.size()
+    assert res.tolong() == (v.tolong() << other.size()) | other.tolong()
+    res = other.append(v)
+    assert res.tolong() == (other.tolong() << v.size()) | v.tolong()
+    v2 = bitvector.BitVector.unpack(*v.pack())
+    assert isinstance(v2, TwoWordBitVector)
+    assert v2.eq(v)
+
+def test_bitvector_register():
+    reg = bitvector.BitVectorRegister(256)
+    assert reg.read().tolong() == 0
+    reg.update_subrange(71, 64, SmallBitVector(8, r_uint(0xab)))
+    reg.update_subrange(131, 124, SmallBitVector(8, r_uint(0xcd)))
+    value = (0xcd << 124) | (0xab << 64)
+    assert reg.read().tolong() == value
+    assert reg.subrange_unwrapped_res(71, 64) == 0xab
+    assert reg.subrange(131, 124).touint() == 0xcd
+    res = reg.subrange(191, 64)
+    assert isinstance(res, TwoWordBitVector)
+    assert res.tolong() == value >> 64
+
+def test_bitvector_register_copy_on_write():
+    reg = bitvector.BitVectorRegister(256)
+    reg.update_subrange(63, 0, SmallBitVector(64, r_uint(1)))
+    # the read value must not change when the register is updated later
+    bv = reg.read()
+    reg.update_subrange(63, 0, SmallBitVector(64, r_uint(2)))
+    assert bv.tolong() == 1
+    assert reg.read().tolong() == 2
+    # same for a written value
+    bv = GenericBitVector(256, [r_uint(5), r_uint(0), r_uint(0), r_uint(0)])
+    reg.write(bv)
+    reg.update_subrange(255, 192, SmallBitVector(64, r_uint(7)))
+    assert bv.tolong() == 5
+    assert reg.read().tolong() == (7 << 192) | 5
+    # and for copies
+    reg2 = reg.copy()
+    reg2.update_subrange(7, 0, SmallBitVector(8, r_uint(0)))
+    assert reg.read().tolong() == (7 << 192) | 5
+    assert reg2.read().tolong() == 7 << 192
+    reg2.write(SparseBitVector(256, r_uint(3)))
+    assert reg2.read().tolong() == 3
+
+@given(strategies.data())
+def test_bitvector_register_hypothesis(data):
+    width = data.draw(strategies.integers(129, 600))
+    value = _make_generic_bitvector(data, width)
+    reg = bitvector.BitVectorRegister(width)
+    reg.write(value)
+    for i in range(data.draw(strategies.integers(1, 5))):
+        lower = data.draw(strategies.integers(0, width - 1))
+        upper = data.draw(strategies.integers(lower, width - 1))
+        subwidth = upper - lower + 1
+        replace_bv = make_bitvector(data, subwidth)
+        value = value.update_subrange(upper, lower, replace_bv)
+        reg.update_subrange(upper, lower, replace_bv)
+        assert reg.read().eq(value)
+    lower = data.draw(strategies.integers(0, width - 1))
+    upper = data.draw(strategies.integers(lower, width - 1))
+    assert reg.subrange(upper, lower).eq(value.subrange(upper, lower))
+    if upper - lower < 64:
+        assert reg.subrange_unwrapped_res(upper, lower) == value.subrange_unwrapped_res(upper, lower)
@@ -3,3 +3,10 @@ from pydrofoil import types
 def test_unique():
     assert types.SmallFixedBitVector(6).width == 6
     assert types.SmallFixedBitVector(6) is types.SmallFixedBitVector(6)
+
+def test_pickle_keeps_identity():
+    import cPickle
+    for typ in [types.SmallFixedBitVector(6), types.Int(), types.MachineInt(),
+                types.Struct('s', ('a', 'b'), (types.Int(), types.Bool())),
+                types.Function(types.Tuple((types.Int(), )), types.Bool())]:
+        assert cPickle.loads(cPickle.dumps(typ, -1)) is typ
@@ -7,6 +7,7 @@ def unique(cls):
         if res is not None:
             return res
         res = object.__new__(cls, *args)
+        res._unique_args = args
         instances[args] = res
         return res
     cls.__new__ = staticmethod(__new__)
@@ -24,6 +25,12 @@ def singleton(cls):
 class Type(object):
     __metaclass__ = extendabletype
     uninitialized_value = '"uninitialized_value"' # often fine for rpython!
+    _unique_args = ()
+
+    def __reduce__(self):
+        # types are compared by identity, so unpickling has to go through the
+        # constructor to return the unique instance
+        return type(self), self._unique_args
 
 
 @unique
@@ -166,7 +173,7 @@ class BigFixedBitVector(Type):
         # size known at compile time
         assert width > 64
         self.width = width
-        self.uninitialized_value = "bitvector.SparseBitVector(%s, r_uint(0))" % width
+        self.uninitialized_value = "bitvector.from_ruint(%s, r_uint(0))" % width
 
     def __repr__(self):
         return "BigFixedBitVector(%s)" % (self.width, )
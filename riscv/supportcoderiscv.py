@@ -1,7 +1,6 @@
 import os
 
 from pydrofoil.supportcode import *
-from pydrofoil.bitvector import Integer
 from pydrofoil import elf
 from pydrofoil import mem as mem_mod
 
@@ -10,6 +9,7 @@ from rpython.rlib.objectmodel import we_are_translated, always_inline, specializ
 from rpython.rlib.jit import JitDriver, promote
 from rpython.rlib.rarithmetic import r_uint, intmask, ovfcheck
 from rpython.rlib.rrandom import Random
+from rpython.rlib.rstring import StringBuilder
 from rpython.rlib import jit
 from rpython.rlib import rsignal
 
@@ -25,7 +25,7 @@ with open(os.path.join(os.path.dirname(__file__), "riscv_model_version")) as f:
 
 
 def write_mem(machine, addr, content): # write a single byte
-    jit.promote(machine.g).mem.write(addr, 1, content)
+    jit.promote(machine.g).mem.write_from(machine._reg_zPC, addr, 1, content)
     return True
 
 @always_inline
@@ -33,11 +33,11 @@ def write_mem(machine, addr, content): # write a single byte
 def platform_read_mem(machine, read_kind, addr_size, addr, n):
     assert n <= 8
     addr = addr.touint()
-    res = jit.promote(machine.g).mem.read(addr, n)
+    res = jit.promote(machine.g).mem.read_from(machine._reg_zPC, addr, n)
     return bitvector.SmallBitVector(n*8, res) # breaking abstracting a bit, but much more efficient
 
 def platform_read_mem_o_i_bv_i(machine, read_kind, addr_size, addr, n):
-    return jit.promote(machine.g).mem.read(addr, n)
+    return jit.promote(machine.g).mem.read_from(machine._reg_zPC, addr, n)
 
 @always_inline
 def platform_write_mem(machine, write_kind, addr_size, addr, n, data):
@@ -45,29 +45,12 @@ def platform_write_mem(machine, write_kind, addr_size, addr, n, data):
     assert n <= 8
     assert addr_size == 64
     assert data.size() == n * 8
-    jit.promote(machine.g).mem.write(addr.touint(), n, data.touint())
+    jit.promote(machine.g).mem.write_from(machine._reg_zPC, addr.touint(), n, data.touint())
     return True
 
 # rough memory layout:
 # | rom | clint | .... | ram <htif inside> ram
 
-@jit.not_in_trace
-def _observe_addr_range(machine, pc, addr, width, ranges):
-    index = _find_index(ranges, addr, width)
-    jit.promote(machine.g)._mem_addr_range_next = index
-
-@jit.elidable
-def _get_likely_addr_range(g, pc, ranges):
-    # not really at all elidable, but it does not matter. the result is only
-    # used to produce some guards
-    return g._mem_addr_range_next
-
-def _find_index(ranges, addr, width):
-    for index, (start, stop) in enumerate(ranges):
-        if start <= addr and addr + width < stop:
-            return index
-    return -1
-
 @specialize.argtype(0)
 def promote_addr_region(machine, addr, width, offset, executable_flag):
     g = jit.promote(machine.g)
@@ -76,15 +59,11 @@ def promote_addr_region(machine, addr, width, offset, executable_flag):
     jit.jit_debug("promote_addr_region", width, executable_flag, jit.isconstant(width))
     if not jit.we_are_jitted() or jit.isconstant(addr) or not jit.isconstant(width):
         return
-    if executable_flag:
+    if executable_flag or width > 8:
         return
-    pc = machine._reg_zPC
-    _observe_addr_range(machine, pc, addr, width, g._mem_ranges)
-    range_index = _get_likely_addr_range(g, pc, g._mem_ranges)
-    if range_index < 0 or width > 8:
-        return
-    # the next line produces two guards
-    if g._mem_ranges[range_index][0] <= addr and addr < g._mem_ranges[range_index][1] - width:
+    # produces a single guard that addr is in the same region as when this
+    # instruction was traced
+    if g._mem_map.lookup_likely(r_uint(addr), width, machine._reg_zPC) >= 0:
         if width == 8 and addr & ((r_uint(1)<<63) | 0b111) == 0:
             # it's aligned and the highest bit is not set. tell the jit that the
             # last three bits and the highest bit are zero. can be removed with
@@ -104,13 +83,13 @@ class Globals(object):
         'rv_clint_base?', 'rv_clint_size?', 'rv_htif_tohost?',
         'rv_rom_base?', 'rv_rom_size?', 'mem?',
         'rv_insns_per_tick?',
-        '_mem_ranges?[*]',
+        '_mem_map?',
         'rv64'
     ]
 
     def __init__(self, rv64=True):
         self.rv64 = rv64
-        self._mem_addr_range_next = -1
+        self._mem_map = None
         self.mem = None
         self.rv_enable_pmp                  = False
         self.rv_enable_zfinx                = False
@@ -155,16 +134,28 @@ class Globals(object):
 
         self.cpu_hz = 1000000000 # 1 GHz
 
-    def _init_ranges(self):
-        self._mem_ranges = [
-            (intmask(self.rv_rom_base), intmask(self.rv_rom_base + self.rv_rom_size)),
-            (intmask(self.rv_clint_base), intmask(self.rv_clint_base + self.rv_clint_size)),
-            (intmask(self.rv_ram_base), intmask(self.rv_htif_tohost)),
-            (intmask(self.rv_htif_tohost), intmask(self.rv_htif_tohost + 16)),
-            (intmask(self.rv_htif_tohost + 16), intmask(self.rv_ram_base + self.rv_ram_size)),
+    def memory_regions(self):
+        """ The memory map of the platform, as seen by the guest. """
+        return [
+            mem_mod.MemoryRegion("rom", self.rv_rom_base, self.rv_rom_size),
+            mem_mod.MemoryRegion("clint", self.rv_clint_base, self.rv_clint_size),
+            mem_mod.MemoryRegion("ram", self.rv_ram_base, self.rv_htif_tohost - self.rv_ram_base),
+            mem_mod.MemoryRegion("htif", self.rv_htif_tohost, 16),
+            mem_mod.MemoryRegion("ram", self.rv_htif_tohost + 16,
+                self.rv_ram_base + self.rv_ram_size - self.rv_htif_tohost - 16),
         ]
-        for a, b in self._mem_ranges:
-            assert b >= 8
+
+    def backed_memory_regions(self, low_mem, ram):
+        """ The regions of the memory map that are backed by host memory. The
+        rom (and the unused clint addresses) are part of the low memory, the
+        htif lives inside the ram. """
+        return [
+            mem_mod.MemoryRegion("low", 0, low_mem.size, low_mem),
+            mem_mod.MemoryRegion("ram", self.rv_ram_base, self.rv_ram_size, ram),
+        ]
+
+    def _init_ranges(self):
+        self._mem_map = mem_mod.MemoryMap(self.memory_regions())
 
     def _create_dtb(self):
         from pydrofoil.dtb import DeviceTree
@@ -348,24 +339,21 @@ def init_sail_reset_vector(machine, entry):
 
 
     rv_rom_base = DEFAULT_RSTVEC
-    addr = r_uint(rv_rom_base)
+    rom = StringBuilder()
     for i, fourbytes in enumerate(reset_vec):
         for j in range(4):
-            write_mem(machine, addr, fourbytes & 0xff) # little endian
-            addr += 1
+            rom.append(chr(intmask(fourbytes & 0xff))) # little endian
             fourbytes >>= 8
         assert fourbytes == 0
     if machine.g.dtb:
-        for i, char in enumerate(machine.g.dtb):
-            write_mem(machine, addr, r_uint(ord(char)))
-            addr += 1
+        rom.append(machine.g.dtb)
 
     align = 0x1000
     # zero-fill to page boundary
+    addr = r_uint(rv_rom_base + rom.getlength())
     rom_end = r_uint((addr + align - 1) / align * align)
-    for i in range(intmask(addr), rom_end):
-        write_mem(machine, addr, 0)
-        addr += 1
+    rom.append_multiple_char('\x00', intmask(rom_end - addr))
+    machine.g.mem.write_bytes(r_uint(rv_rom_base), rom.build())
 
     # set rom size
     rv_rom_size = rom_end - rv_rom_base
@@ -430,6 +418,7 @@ Run the Pydrofoil RISC-V emulator on elf_file.
 --dump <file>                   load elf file disassembly from file
 -b/--device-tree-blob <file>    load dtb from file (usually not needed, Pydrofoil has a dtb built-in)
 --disable-vext                  disable vector extension
+--call-profile <file>           write the call counts of an instrumented build to file
 --version                       print the version of pydrofoil-riscv
 --help                          print this information and exit
 """
@@ -521,6 +510,8 @@ def _main(argv, *machineclasses):
 
     print_kips = parse_flag(argv, "--print-kips")
 
+    call_profile_file = parse_args(argv, "--call-profile")
+
     rv32 = parse_flag(argv, "--rv32")
     if rv32:
         assert len(machineclasses) == 2
@@ -578,6 +569,11 @@ def _main(argv, *machineclasses):
         machine.run_sail(limit, print_kips)
         if i:
             init_sail(machine, entry)
+    if call_profile_file:
+        if machine.write_call_profile(call_profile_file):
+            print "written call profile", call_profile_file
+        else:
+            print "can't write call profile, the code was generated without call counting"
     #flush_logs()
     #close_logs()
     return 0
@@ -596,9 +592,9 @@ def load_sail(machine, fn):
     oldmem = g.mem
     if oldmem:
         oldmem.close()
-    mem1 = mem_mod.FlatMemory(False)
-    mem2 = mem_mod.FlatMemory(False, g.rv_ram_size)
-    mem = mem_mod.SplitMemory(mem1, 0, mem1.size, mem2, g.rv_ram_base, g.rv_ram_size)
+    low_mem = mem_mod.SparseMemory()
+    ram = mem_mod.SparseMemory(g.rv_ram_size)
+    mem = mem_mod.SplitMemory(g.backed_memory_regions(low_mem, ram))
     g.mem = mem
     with open(fn, "rb") as f:
         entrypoint = elf.elf_read_process_image(mem, f) # load process image
@@ -694,8 +690,10 @@ def get_main(outriscv, rv64):
         def init_model(self):
             return outriscv.func_zinit_model(self, ())
 
-        def step(self, *args):
-            return outriscv.func_zstep(self, *args)
+        def step(self, step_no):
+            # Int arguments are passed unboxed, see
+            # emitfunction.unboxed_int_parameters
+            return outriscv.func_zstep(self, step_no, None)
 
         def run_sail(self, insn_limit, do_show_times):
             step_no = 0
@@ -729,7 +727,7 @@ def get_main(outriscv, rv64):
                     continue
                 # run a Sail step
                 prev_pc = self._reg_zPC
-                stepped = self.step(Integer.fromint(step_no))
+                stepped = self.step(step_no)
                 if self.have_exception:
                     print "ended with exception!"
                     print self.current_exception